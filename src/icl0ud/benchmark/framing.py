@@ -0,0 +1,108 @@
+"""Benchmark for splitting a received byte stream into APS frames.
+
+Pushes a multi-megabyte stream of APSNotification frames through
+APSFrameBuffer in differently sized chunks, simulating data arriving in
+small TLS records.
+
+Usage (from src/):
+
+    python -m icl0ud.benchmark.framing [--size MB] [--parse] [--legacy]
+"""
+import argparse
+import time
+from datetime import datetime
+
+from icl0ud.push.framing import APSFrameBuffer
+from icl0ud.push.messages import APSNotification
+from icl0ud.push.parser import APSParser
+
+
+CHUNK_SIZES = (1, 16, 16 * 1024)
+PAYLOAD_SIZES = (64, 512, 4 * 1024, 60 * 1024)  # fields are limited to 64 KB
+
+
+def buildStream(size):
+    """Build a stream of notification frames at least size bytes long."""
+    frames = []
+    length = 0
+    i = 0
+    while length < size:
+        payloadSize = PAYLOAD_SIZES[i % len(PAYLOAD_SIZES)]
+        notification = APSNotification(
+            recipientPushToken='\x42' * 32,
+            topic='\x23' * 20,
+            payload='x' * payloadSize,
+            messageId='\x00\x00\x00\x01',
+            expires=datetime(2011, 10, 30, 15, 52, 20),
+            timestamp=datetime(2011, 10, 29, 15, 52, 20, 335509),
+            storageFlags='\x00',
+        )
+        frame = notification.marshal()
+        frames.append(frame)
+        length += len(frame)
+        i += 1
+    return ''.join(frames), len(frames)
+
+
+def splitFrames(stream, chunkSize, parser=None):
+    frameBuffer = APSFrameBuffer()
+    count = 0
+    for offset in xrange(0, len(stream), chunkSize):
+        frameBuffer.append(stream[offset:offset + chunkSize])
+        for frame in frameBuffer.frames():
+            if parser is not None:
+                parser.parseMessage(frame)
+            count += 1
+    return count
+
+
+def splitFramesLegacy(stream, chunkSize, parser=None):
+    """The string concatenating implementation MessageProxy used before."""
+    if parser is None:
+        parser = APSParser()
+    buff = ''
+    count = 0
+    for offset in xrange(0, len(stream), chunkSize):
+        buff = buff + stream[offset:offset + chunkSize]
+        while parser.isMessageComplete(buff):
+            length = parser.messageLength(buff)
+            buff = buff[length:]
+            count += 1
+    return count
+
+
+def run(stream, frameCount, chunkSize, split, parser):
+    start = time.time()
+    count = split(stream, chunkSize, parser)
+    duration = time.time() - start
+    assert count == frameCount, 'expected %d frames, got %d' % (frameCount,
+                                                                count)
+    print '%8d byte chunks: %8.3fs %8.2f MB/s %10.0f frames/s' % (
+        chunkSize,
+        duration,
+        len(stream) / duration / 1024 / 1024,
+        count / duration)
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    argParser.add_argument('--size', type=int, default=4,
+                           help='stream size in MB (default: 4)')
+    argParser.add_argument('--parse', action='store_true',
+                           help='also parse each frame into an APSMessage')
+    argParser.add_argument('--legacy', action='store_true',
+                           help='benchmark the old string concatenating '
+                                'implementation (slow for small chunks)')
+    args = argParser.parse_args()
+
+    stream, frameCount = buildStream(args.size * 1024 * 1024)
+    print 'stream: %d bytes, %d frames' % (len(stream), frameCount)
+
+    split = splitFramesLegacy if args.legacy else splitFrames
+    for chunkSize in CHUNK_SIZES:
+        parser = APSParser() if args.parse else None
+        run(stream, frameCount, chunkSize, split, parser)
+
+
+if __name__ == '__main__':
+    main()
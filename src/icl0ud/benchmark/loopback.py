@@ -0,0 +1,306 @@
+"""Replay APS traffic through InterceptServerFactory over loopback TLS.
+
+Devices connect to the proxy on 127.0.0.1 and send their frames, the proxy
+connects to a fake courier on 127.0.0.1, which answers with the server
+frames of the device connecting. Certificates for a CA, the proxy, the
+courier and the devices are generated in a temporary directory.
+
+See icl0ud.benchmark.replay.
+"""
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+from OpenSSL import crypto, SSL
+from twisted.internet import defer, protocol, ssl, task
+
+from icl0ud.push.capture import DIRECTION_DEVICE
+from icl0ud.push.intercept import (InterceptClientContextFactory,
+                                   InterceptServerContextFactory,
+                                   InterceptServerFactory,
+                                   getTLSConnection, keepSessionResumable)
+
+
+KEY_BITS = 2048
+
+
+def createCertificate(commonName, issuer=None, serial=1):
+    """Create a key and a certificate signed by issuer, a (cert, key) tuple.
+
+    The certificate is self-signed if issuer is None.
+    """
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, KEY_BITS)
+    cert = crypto.X509()
+    cert.set_version(2)
+    cert.set_serial_number(serial)
+    cert.get_subject().CN = commonName
+    cert.gmtime_adj_notBefore(-3600)
+    cert.gmtime_adj_notAfter(24 * 3600)
+    cert.set_pubkey(key)
+    if issuer is None:
+        cert.add_extensions([crypto.X509Extension('basicConstraints', True,
+                                                  'CA:TRUE')])
+        issuer = (cert, key)
+    cert.set_issuer(issuer[0].get_subject())
+    cert.sign(issuer[1], 'sha256')
+    return cert, key
+
+
+def writePem(path, cert, key=None):
+    with open(path, 'w') as f:
+        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+        if key is not None:
+            f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+
+
+class Certificates(object):
+    """Certificates for a loopback setup, stored in a temporary directory."""
+
+    def __init__(self, deviceCount):
+        self.directory = tempfile.mkdtemp(prefix='pushproxy-loopback-')
+        self.deviceDir = os.path.join(self.directory, 'device')
+        os.mkdir(self.deviceDir)
+
+        ca = createCertificate('pushproxy loopback CA')
+        self.caChain = os.path.join(self.directory, 'ca.pem')
+        writePem(self.caChain, ca[0])
+
+        self.server = os.path.join(self.directory, 'server.pem')
+        writePem(self.server, *createCertificate('courier.push.apple.com',
+                                                 ca, serial=2))
+        self.courier = os.path.join(self.directory, 'courier.pem')
+        writePem(self.courier, *createCertificate('localhost', ca, serial=3))
+
+        self.devices = []
+        for i in xrange(deviceCount):
+            deviceId = str(uuid.uuid4()).upper()
+            writePem(self.devicePath(deviceId),
+                     *createCertificate(deviceId, ca, serial=4 + i))
+            self.devices.append(deviceId)
+
+    def devicePath(self, deviceId):
+        return os.path.join(self.deviceDir, deviceId + '.pem')
+
+    def remove(self):
+        shutil.rmtree(self.directory)
+
+
+class CourierContextFactory(InterceptServerContextFactory):
+    """Requests client certificates without verifying them."""
+
+    def __init__(self, cert):
+        InterceptServerContextFactory.__init__(self, cert, None,
+                                               ticketKeyLifetime=0)
+
+    def cacheContext(self):
+        if self._context is None:
+            ssl.DefaultOpenSSLContextFactory.cacheContext(self)
+            self._context.set_verify(SSL.VERIFY_PEER, lambda *args: True)
+            self._context.set_session_id(b'courier')
+
+
+class FakeCourier(protocol.Protocol):
+    """Sends the server frames of the connecting device on its first data."""
+
+    def __init__(self):
+        self.deviceId = None
+
+    def dataReceived(self, data):
+        run = self.factory.run
+        if self.deviceId is None:
+            cert = self.transport.getPeerCertificate()
+            self.deviceId = cert.get_subject().CN
+            self.transport.write(run.serverData[self.deviceId])
+            run.courierContextFactory.recordHandshake(
+                getTLSConnection(self.transport))
+        run.courierReceived(len(data))
+
+    def connectionLost(self, reason):
+        keepSessionResumable(self.transport)
+        self.factory.run.connectionClosed()
+
+
+class ReplayDevice(protocol.Protocol):
+    def __init__(self, run, deviceId):
+        self.run = run
+        self.deviceId = deviceId
+        self.firstByteReceived = False
+
+    def connectionMade(self):
+        self.run.devices.append(self)
+        self.transport.write(self.run.deviceData[self.deviceId])
+
+    def dataReceived(self, data):
+        if not self.firstByteReceived:
+            self.firstByteReceived = True
+            self.run.contextFactories[self.deviceId].saveSession(
+                self.transport)
+            self.run.firstByte(self.deviceId)
+        self.run.deviceReceived(len(data))
+
+    def connectionLost(self, reason):
+        keepSessionResumable(self.transport)
+        self.run.connectionClosed()
+
+
+class DeviceFactory(protocol.ClientFactory):
+    def __init__(self, run, deviceId):
+        self.run = run
+        self.deviceId = deviceId
+
+    def buildProtocol(self, addr):
+        return ReplayDevice(self.run, self.deviceId)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.run.fail(reason)
+
+
+class LoopbackRun(object):
+    """Replays records, grouped by connection, with one device each.
+
+    Each round connects all devices, waits for all frames and disconnects
+    them again. Devices resume their TLS sessions in later rounds.
+    """
+
+    def __init__(self, reactor, records, handlers):
+        self.reactor = reactor
+        self.handlers = handlers
+        connectionIds = sorted(set([r.connectionId for r in records]))
+        self.certificates = Certificates(len(connectionIds))
+        deviceIds = dict(zip(connectionIds, self.certificates.devices))
+        self.contextFactories = dict([
+            (deviceId, InterceptClientContextFactory(
+                self.certificates.devicePath(deviceId),
+                self.certificates.caChain))
+            for deviceId in self.certificates.devices])
+
+        self.deviceData = dict([(d, []) for d in self.certificates.devices])
+        self.serverData = dict([(d, []) for d in self.certificates.devices])
+        for record in records:
+            deviceId = deviceIds[record.connectionId]
+            if record.direction == DIRECTION_DEVICE:
+                self.deviceData[deviceId].append(record.frame)
+            else:
+                self.serverData[deviceId].append(record.frame)
+        for data in (self.deviceData, self.serverData):
+            for deviceId, frames in data.items():
+                data[deviceId] = ''.join(frames)
+
+    def listen(self):
+        courierFactory = protocol.Factory()
+        courierFactory.protocol = FakeCourier
+        courierFactory.run = self
+        self.courierContextFactory = CourierContextFactory(
+            self.certificates.courier)
+        self.courierPort = self.reactor.listenSSL(
+            0, courierFactory, self.courierContextFactory,
+            interface='127.0.0.1')
+
+        self.proxyFactory = InterceptServerFactory(
+            hosts=('127.0.0.1',),
+            port=self.courierPort.getHost().port,
+            serverCert=self.certificates.server,
+            clientCertDir=self.certificates.deviceDir,
+            caCertChain=self.certificates.caChain,
+            serverChain=self.certificates.caChain,
+            dispatchHandlers=self.handlers,
+            statsInterval=0)
+        self.proxyPort = self.reactor.listenSSL(
+            0, self.proxyFactory,
+            self.proxyFactory.getServerContextFactory(),
+            interface='127.0.0.1')
+
+    def runRound(self):
+        """Connect all devices, fires with the round's duration."""
+        self.pendingCourierBytes = sum(map(len, self.deviceData.values()))
+        self.pendingDeviceBytes = sum(map(len, self.serverData.values()))
+        self.devices = []
+        self.connectStarted = {}
+        self.timesToFirstByte = []
+        self.done = defer.Deferred()
+
+        self.started = time.time()
+        for deviceId in self.certificates.devices:
+            self.connectStarted[deviceId] = time.time()
+            self.reactor.connectSSL('127.0.0.1',
+                                    self.proxyPort.getHost().port,
+                                    DeviceFactory(self, deviceId),
+                                    self.contextFactories[deviceId])
+        return self.done
+
+    def firstByte(self, deviceId):
+        self.timesToFirstByte.append(time.time() -
+                                     self.connectStarted[deviceId])
+
+    def courierReceived(self, length):
+        self.pendingCourierBytes -= length
+        self.checkDone()
+
+    def deviceReceived(self, length):
+        self.pendingDeviceBytes -= length
+        self.checkDone()
+
+    def checkDone(self):
+        if self.pendingCourierBytes <= 0 and self.pendingDeviceBytes <= 0 \
+           and not self.done.called:
+            self.duration = time.time() - self.started
+            self.done.callback(self.duration)
+
+    def fail(self, reason):
+        if not self.done.called:
+            self.done.errback(reason)
+
+    def disconnect(self):
+        """Disconnect all devices, fires once courier connections are closed.
+        """
+        # Device and courier side of each connection
+        self.openConnections = 2 * len(self.devices)
+        self.closed = defer.Deferred()
+        for device in self.devices:
+            device.transport.loseConnection()
+        return self.closed
+
+    def connectionClosed(self):
+        self.openConnections -= 1
+        if self.openConnections == 0:
+            self.closed.callback(None)
+
+    def stop(self):
+        self.certificates.remove()
+        return defer.gatherResults([self.proxyPort.stopListening(),
+                                    self.courierPort.stopListening()])
+
+
+@defer.inlineCallbacks
+def _run(reactor, records, handlers, rounds):
+    from icl0ud.benchmark.replay import percentile, reportThroughput
+
+    run = LoopbackRun(reactor, records, handlers)
+    run.listen()
+    byteCount = sum([len(record.frame) for record in records])
+    try:
+        for i in xrange(rounds):
+            duration = yield run.runRound()
+            yield run.disconnect()
+
+            print 'round %d' % (i + 1)
+            reportThroughput(records, byteCount, duration)
+            samples = sorted(run.timesToFirstByte)
+            print 'time to first byte: ' + ', '.join(
+                ['p%d %.1fms' % (p, percentile(samples, p) * 1000)
+                 for p in (50, 90, 99, 100)])
+            handshakes, resumed = \
+                run.proxyFactory.getServerContextFactory().resetStats()
+            print 'TLS handshakes: %d, resumed: %d' % (handshakes, resumed)
+            handshakes, resumed = run.courierContextFactory.resetStats()
+            print 'courier TLS handshakes: %d, resumed: %d' % (handshakes,
+                                                              resumed)
+    finally:
+        yield run.stop()
+
+
+def main(records, handlers, rounds=1):
+    task.react(_run, (records, handlers, rounds))
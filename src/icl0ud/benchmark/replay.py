@@ -0,0 +1,312 @@
+"""Replay APS traffic through the proxy and report its throughput.
+
+Frames are read from a capture file written by CaptureHandler, or generated
+if no file is given. By default they are fed through MessageProxy, APSParser
+and BaseDispatch in-process using fake transports, reporting per stage
+latencies. With --loopback they are sent through a real
+InterceptServerFactory over TLS on 127.0.0.1 to a local fake courier.
+
+Usage (from src/):
+
+    python -m icl0ud.benchmark.replay [options] [<capture file>]
+"""
+import argparse
+import gc
+import resource
+import time
+from datetime import datetime
+from hashlib import sha1
+from struct import pack
+from timeit import default_timer
+
+from twisted.internet import address
+
+from icl0ud.push import messages
+from icl0ud.push.capture import (CaptureReader, CaptureRecord,
+                                 DIRECTION_DEVICE, DIRECTION_SERVER)
+from icl0ud.push.dispatch import LoggingHandler, LOG_FULL, LOG_METADATA
+from icl0ud.push.intercept import (InterceptClient, InterceptClientFactory,
+                                   InterceptServer, InterceptServerFactory)
+from icl0ud.push.notification_sender import PushNotificationSender
+from icl0ud.push.pushtoken_handler import PushTokenHandler
+
+
+STAGES = ('framing', 'parse', 'dispatch', 'forward')
+PERCENTILES = (50, 90, 99, 100)
+PAYLOAD_SIZES = (64, 256, 1024, 4096)
+
+
+def syntheticRecords(connections=100, notifications=50):
+    """Generate CaptureRecords of typical connections.
+
+    Each connection connects, gets a keep-alive response and receives
+    notifications, which the device acknowledges.
+    """
+    expires = datetime(2011, 10, 30, 15, 52, 20)
+    timestamp = datetime(2011, 10, 29, 15, 52, 20, 335509)
+    for connectionId in xrange(connections):
+        token = sha1(str(connectionId)).digest() + '\x00' * 12
+
+        def record(direction, message):
+            return CaptureRecord(0, connectionId, direction,
+                                 message.marshal())
+
+        yield record(DIRECTION_DEVICE, messages.APSConnect(
+            pushToken=token,
+            state='\x01',
+            presenceFlags='\x00\x00\x00\x02'))
+        yield record(DIRECTION_SERVER, messages.APSConnectResponse(
+            response='\x00',
+            pushToken=token,
+            messageSize='\x10\x00',
+            unknown5='\x00\x02'))
+        yield record(DIRECTION_DEVICE, messages.APSKeepAlive(
+            carrier='31038',
+            softwareVersion='6.1.1',
+            softwareBuild='10B145',
+            hardwareVersion='iPhone4,1',
+            keepAliveInterval='10'))
+        yield record(DIRECTION_SERVER, messages.APSKeepAliveResponse())
+        for i in xrange(notifications):
+            messageId = pack('!L', i)
+            payloadSize = PAYLOAD_SIZES[i % len(PAYLOAD_SIZES)]
+            yield record(DIRECTION_SERVER, messages.APSNotification(
+                recipientPushToken=token,
+                topic=sha1('com.apple.mobileme.fmip').digest(),
+                payload='{"aps": {"alert": "%s"}}' % ('x' * payloadSize),
+                messageId=messageId,
+                expires=expires,
+                timestamp=timestamp,
+                storageFlags='\x00'))
+            yield record(DIRECTION_DEVICE, messages.APSNotificationResponse(
+                messageId=messageId,
+                deliveryStatus='\x00'))
+
+
+def buildHandlers(logLevel):
+    pushTokenHandler = PushTokenHandler()
+    handlers = [pushTokenHandler, PushNotificationSender(pushTokenHandler)]
+    if logLevel is not None:
+        handlers.append(LoggingHandler(level=logLevel))
+    return handlers
+
+
+class ReplayTransport(object):
+    """Transport counting written bytes instead of sending them."""
+
+    def __init__(self, sessionno):
+        self.sessionno = sessionno
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def writeSequence(self, data):
+        for chunk in data:
+            self.write(chunk)
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def loseConnection(self):
+        pass
+
+    def getPeer(self):
+        return address.IPv4Address('TCP', '127.0.0.1', 0)
+
+
+class StageTimer(object):
+    """Collect per call latencies of the proxy's processing stages.
+
+    framing is the time spent in dataReceived outside of the other stages.
+    """
+
+    def __init__(self):
+        self.samples = dict([(stage, []) for stage in STAGES])
+        self._nested = 0
+
+    def wrap(self, stage, f):
+        samples = self.samples[stage]
+
+        def timed(*args, **kwargs):
+            start = default_timer()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                duration = default_timer() - start
+                samples.append(duration)
+                self._nested += duration
+        return timed
+
+    def wrapDataReceived(self, f):
+        samples = self.samples['framing']
+
+        def timed(data):
+            self._nested = 0
+            start = default_timer()
+            f(data)
+            samples.append(default_timer() - start - self._nested)
+        return timed
+
+    def instrument(self, proxy):
+        proxy._parser.parseMessage = self.wrap('parse',
+                                               proxy._parser.parseMessage)
+        proxy.dispatch = self.wrap('dispatch', proxy.dispatch)
+        proxy.sendToPeer = self.wrap('forward', proxy.sendToPeer)
+        proxy.dataReceived = self.wrapDataReceived(proxy.dataReceived)
+
+
+class ReplayFactory(object):
+    """The write queue configuration of an InterceptServerFactory."""
+
+    writeDelay = InterceptServerFactory.writeDelay
+    writeBatchSize = InterceptServerFactory.writeBatchSize
+
+
+class ReplayConnection(object):
+    """A device and a server side proxy connected to each other."""
+
+    def __init__(self, connectionId, handlers, timer=None):
+        self.device = InterceptServer()
+        self.device.factory = ReplayFactory()
+        self.device.transport = ReplayTransport(connectionId)
+        self.device.addHandlers(handlers)
+
+        self.server = InterceptClient()
+        self.server.factory = InterceptClientFactory(self.device)
+        self.server.transport = ReplayTransport(connectionId)
+        self.server.addHandlers(handlers)
+
+        self.device.setPeer(self.server)
+        self.server.setPeer(self.device)
+        if timer is not None:
+            timer.instrument(self.device)
+            timer.instrument(self.server)
+
+    def dataReceived(self, direction, data):
+        # Each record was read at once, its frames are written at the end
+        # of the reactor iteration.
+        if direction == DIRECTION_DEVICE:
+            self.device.dataReceived(data)
+            self.server.flushWrites()
+        else:
+            self.server.dataReceived(data)
+            self.device.flushWrites()
+
+
+def replay(records, handlers, timer=None):
+    """Feed records through the proxy, return the number of forwarded bytes.
+    """
+    connections = {}
+    forwarded = 0
+    for record in records:
+        connection = connections.get(record.connectionId)
+        if connection is None:
+            connection = connections[record.connectionId] = \
+                ReplayConnection(record.connectionId, handlers, timer)
+        connection.dataReceived(record.direction, record.frame)
+    for connection in connections.itervalues():
+        forwarded += connection.device.transport.written
+        forwarded += connection.server.transport.written
+    return forwarded
+
+
+def percentile(sortedSamples, percent):
+    if not sortedSamples:
+        return 0
+    index = int(round(percent / 100.0 * (len(sortedSamples) - 1)))
+    return sortedSamples[index]
+
+
+def formatRate(count, duration):
+    return '%.0f' % (count / duration) if duration else 'inf'
+
+
+def reportThroughput(records, byteCount, duration):
+    print 'messages: %d in %.3fs, %s messages/s, %.2f MB/s' % (
+        len(records),
+        duration,
+        formatRate(len(records), duration),
+        byteCount / duration / 1024 / 1024 if duration else 0)
+
+
+def reportStages(timer):
+    print '%-10s %8s ' % ('stage', 'calls') + \
+          ' '.join(['%9s' % ('p%d us' % p) for p in PERCENTILES])
+    for stage in STAGES:
+        samples = sorted(timer.samples[stage])
+        print '%-10s %8d ' % (stage, len(samples)) + \
+              ' '.join(['%9.1f' % (percentile(samples, p) * 1e6)
+                        for p in PERCENTILES])
+
+
+def runInProcess(records, logLevel, stages):
+    if logLevel is not None:
+        # Format log events like production would, but don't write them
+        from twisted.python import log
+        from icl0ud.logger import PushLogObserver
+        log.startLoggingWithObserver(PushLogObserver(open('/dev/null',
+                                                          'w')).emit,
+                                     setStdout=False)
+
+    byteCount = sum([len(record.frame) for record in records])
+    timer = StageTimer() if stages else None
+
+    gc.collect()
+    objectsBefore = len(gc.get_objects())
+    start = time.time()
+    replay(records, buildHandlers(logLevel), timer)
+    duration = time.time() - start
+    gc.collect()
+    objectsAfter = len(gc.get_objects())
+
+    reportThroughput(records, byteCount, duration)
+    if timer is not None:
+        reportStages(timer)
+    # Python 2 can't count allocations, report what the replay retained.
+    print 'retained objects: %d, max RSS: %d KB' % (
+        objectsAfter - objectsBefore,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    argParser.add_argument('capture', nargs='?',
+                           help='capture file, generates traffic if missing')
+    argParser.add_argument('--connections', type=int, default=100,
+                           help='generated connections (default: 100)')
+    argParser.add_argument('--notifications', type=int, default=50,
+                           help='generated notifications per connection '
+                                '(default: 50)')
+    argParser.add_argument('--log', choices=(LOG_FULL, LOG_METADATA),
+                           help='add a LoggingHandler with this level')
+    argParser.add_argument('--no-stages', dest='stages',
+                           action='store_false',
+                           help="don't measure per stage latencies")
+    argParser.add_argument('--loopback', action='store_true',
+                           help='replay through TLS connections on '
+                                '127.0.0.1 to a fake courier')
+    argParser.add_argument('--rounds', type=int, default=1,
+                           help='reconnect all devices this many times '
+                                'with --loopback (default: 1)')
+    args = argParser.parse_args()
+
+    if args.capture:
+        with open(args.capture, 'rb') as fd:
+            records = list(CaptureReader(fd))
+    else:
+        records = list(syntheticRecords(args.connections,
+                                        args.notifications))
+
+    if args.loopback:
+        from icl0ud.benchmark import loopback
+        loopback.main(records, buildHandlers(args.log), args.rounds)
+    else:
+        runInProcess(records, args.log, args.stages)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,161 @@
 import sys
+import threading
+import traceback
+from Queue import Queue
 
-from twisted.python import log, logfile, util
+from twisted.python import log, logfile, threadable, util
 
 
 class PushLogObserver(log.FileLogObserver):
     """Logger that doesn't output system context"""
     def emit(self, eventDict):
+        util.untilConcludes(self.write, self.formatEvent(eventDict))
+        util.untilConcludes(self.flush)
+
+    def formatEvent(self, eventDict):
         text = log.textFromEventDict(eventDict)
         if text is None:
             text = '<no text>'
 
         timeStr = self.formatTime(eventDict['time'])
         fmtDict = {'time': timeStr, 'text': text}
-        output = log._safeFormat('%(time)s %(text)s\n', fmtDict)
-        util.untilConcludes(self.write, output)
+        return log._safeFormat('%(time)s %(text)s\n', fmtDict)
+
+
+class BufferedPushLogObserver(PushLogObserver):
+    """PushLogObserver writing lines in batches from a writer thread.
+
+    Lines are collected in memory and handed to the writer thread once
+    bufferSize bytes are pending or flushInterval seconds after the first
+    pending line, whichever comes first. stop() writes pending lines and
+    waits for the writer thread, it is called on reactor shutdown.
+    """
+
+    def __init__(self, f, bufferSize=64 * 1024, flushInterval=1.0,
+                 clock=None):
+        PushLogObserver.__init__(self, f)
+        self.bufferSize = bufferSize
+        self.flushInterval = flushInterval
+        self._clock = clock
+        self._lines = []
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._delayedFlush = None
+        self._queue = Queue()
+        self._writer = None
+        self._stopped = False
+
+    @property
+    def clock(self):
+        if self._clock is None:
+            # Import late, twistd may not have installed a reactor yet
+            from twisted.internet import reactor
+            self._clock = reactor
+        return self._clock
+
+    def start(self):
+        """Start the writer thread once the reactor runs.
+
+        Lines are written inline before. twistd creates the observer
+        before forking to daemonize, a thread started here wouldn't exist
+        in the daemon.
+        """
+        from twisted.internet import reactor
+        reactor.callWhenRunning(self._startWriter)
+        reactor.addSystemEventTrigger('after', 'shutdown', self.stop)
+
+    def _startWriter(self):
+        if self._stopped:
+            return
+        self._writer = threading.Thread(target=self._writeBatches,
+                                        name='PushLogObserver writer')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def stop(self):
+        # Lines emitted after stopping are written right away
+        self._stopped = True
+        self.flushBuffer()
+        with self._lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            self._queue.put(None)
+            writer.join()
+
+    def emit(self, eventDict):
+        line = self.formatEvent(eventDict)
+        with self._lock:
+            self._lines.append(line)
+            self._pending += len(line)
+            pending = self._pending
+        if pending >= self.bufferSize or self._stopped:
+            if self._inIOThread():
+                self.flushBuffer()
+            else:
+                # The delayed flush belongs to the reactor thread, it
+                # finds nothing left to write
+                self._writeBuffer()
+        elif self._delayedFlush is None:
+            self._scheduleFlush()
+
+    def _inIOThread(self):
+        # ioThread is None until the reactor runs
+        return threadable.ioThread is None or threadable.isInIOThread()
+
+    def _scheduleFlush(self):
+        if not self._inIOThread():
+            from twisted.internet import reactor
+            reactor.callFromThread(self._scheduleFlush)
+        elif self._delayedFlush is None:
+            self._delayedFlush = self.clock.callLater(self.flushInterval,
+                                                      self.flushBuffer)
+
+    def flushBuffer(self):
+        """Write pending lines, called in the reactor thread."""
+        if self._delayedFlush is not None:
+            if self._delayedFlush.active():
+                self._delayedFlush.cancel()
+            self._delayedFlush = None
+        self._writeBuffer()
+
+    def _writeBuffer(self):
+        with self._lock:
+            if not self._lines:
+                return
+            batch = ''.join(self._lines)
+            self._lines = []
+            self._pending = 0
+            # Under the lock, other threads may write inline too
+            if self._writer is None:
+                self._write(batch)
+            else:
+                self._queue.put(batch)
+
+    def _write(self, batch):
+        util.untilConcludes(self.write, batch)
         util.untilConcludes(self.flush)
 
+    def _writeBatches(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            try:
+                self._write(batch)
+            except Exception:
+                # Logging the error would end up here again
+                traceback.print_exc(file=sys.__stderr__)
+
+
+class WorkerLogObserver(PushLogObserver):
+    """Writes lines without time, WorkerSupervisor logs them with its own."""
+
+    def formatEvent(self, eventDict):
+        text = log.textFromEventDict(eventDict)
+        if text is None:
+            text = '<no text>'
+        return text + '\n'
+
 
 def stdoutLogger():
     # catch sys.stdout before twisted overwrites it
@@ -25,4 +165,10 @@ def stdoutLogger():
 def fileLogger():
     logFile = logfile.LogFile.fromFullPath('data/push.log',
                                            rotateLength=10000000)  # 10 MB
-    return PushLogObserver(logFile).emit
+    observer = BufferedPushLogObserver(logFile)
+    observer.start()
+    return observer.emit
+
+
+def workerLogger():
+    return WorkerLogObserver(sys.stdout).emit
@@ -0,0 +1,181 @@
+"""Compact binary capture format for intercepted APS traffic.
+
+A capture file starts with FILE_MAGIC, followed by blocks. Each block has a
+BLOCK_HEADER (flags, data length) and contains one or more records, zlib
+compressed if the BLOCK_COMPRESSED flag is set. A record is a RECORD_HEADER
+(timestamp, connection id, direction) followed by the raw APS frame, which
+carries its own length.
+
+Files are append-only, a new file header marks a restart of the writer.
+
+Usage (from src/), prints the records of a capture file:
+
+    python -m icl0ud.push.capture <capture file>
+"""
+import sys
+import time
+import zlib
+from collections import namedtuple
+from struct import Struct
+
+from icl0ud.push.dispatch import BaseHandler, LoggingHandler
+from icl0ud.push.framing import HEADER, HEADER_LENGTH
+from icl0ud.utils.hexdump import hexdump
+
+
+FILE_MAGIC = 'APSCAP\x00\x01'  # name, format version
+BLOCK_HEADER = Struct('!BL')  # flags, data length
+RECORD_HEADER = Struct('!dLB')  # timestamp, connection id, direction
+
+BLOCK_COMPRESSED = 0x01
+
+DIRECTION_DEVICE = 0  # sent by the device
+DIRECTION_SERVER = 1  # sent by the push server
+DIRECTIONS = {'device': DIRECTION_DEVICE, 'server': DIRECTION_SERVER}
+SOURCES = dict([(v, k) for k, v in DIRECTIONS.items()])
+
+
+CaptureRecord = namedtuple('CaptureRecord',
+                           'timestamp connectionId direction frame')
+
+
+class CaptureFormatError(Exception):
+    pass
+
+
+class CaptureWriter(object):
+    """Write records in blocks to a file object opened for appending.
+
+    Records are buffered until blockSize bytes are pending or flushInterval
+    seconds passed since the first pending record.
+    """
+
+    def __init__(self, fd, compress=False, blockSize=64 * 1024,
+                 flushInterval=1.0, clock=None):
+        self.fd = fd
+        self.compress = compress
+        self.blockSize = blockSize
+        self.flushInterval = flushInterval
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self._records = []
+        self._pending = 0
+        self._delayedFlush = None
+        self.fd.write(FILE_MAGIC)
+
+    def write(self, connectionId, direction, frame, timestamp=None):
+        if timestamp is None:
+            timestamp = self.clock.seconds()
+        self._records.append(RECORD_HEADER.pack(timestamp,
+                                                connectionId,
+                                                direction))
+        self._records.append(frame)
+        self._pending += RECORD_HEADER.size + len(frame)
+        if self._pending >= self.blockSize:
+            self.flush()
+        elif self._delayedFlush is None:
+            self._delayedFlush = self.clock.callLater(self.flushInterval,
+                                                      self.flush)
+
+    def flush(self):
+        if self._delayedFlush is not None:
+            if self._delayedFlush.active():
+                self._delayedFlush.cancel()
+            self._delayedFlush = None
+        if not self._records:
+            return
+        data = ''.join(self._records)
+        self._records = []
+        self._pending = 0
+        flags = 0
+        if self.compress:
+            data = zlib.compress(data)
+            flags |= BLOCK_COMPRESSED
+        self.fd.write(BLOCK_HEADER.pack(flags, len(data)) + data)
+        self.fd.flush()
+
+    def close(self):
+        self.flush()
+        self.fd.close()
+
+
+class CaptureReader(object):
+    """Iterate over the CaptureRecords of a capture file object."""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __iter__(self):
+        self._readMagic('')
+        while True:
+            header = self.fd.read(BLOCK_HEADER.size)
+            if not header:
+                return
+            if header == FILE_MAGIC[:BLOCK_HEADER.size]:
+                self._readMagic(header)
+                continue
+            if len(header) < BLOCK_HEADER.size:
+                raise CaptureFormatError('Truncated block header')
+            flags, length = BLOCK_HEADER.unpack(header)
+            data = self.fd.read(length)
+            if len(data) < length:
+                raise CaptureFormatError('Truncated block')
+            if flags & BLOCK_COMPRESSED:
+                data = zlib.decompress(data)
+            for record in self.parseBlock(data):
+                yield record
+
+    def _readMagic(self, start):
+        rest = self.fd.read(len(FILE_MAGIC) - len(start))
+        if start + rest != FILE_MAGIC:
+            raise CaptureFormatError('Unknown file format or version')
+
+    def parseBlock(self, data):
+        offset = 0
+        while offset < len(data):
+            timestamp, connectionId, direction = \
+                RECORD_HEADER.unpack_from(data, offset)
+            offset += RECORD_HEADER.size
+            length = HEADER.unpack_from(data, offset)[1] + HEADER_LENGTH
+            yield CaptureRecord(timestamp, connectionId, direction,
+                                data[offset:offset + length])
+            offset += length
+
+
+class CaptureHandler(BaseHandler):
+    """Write all messages to a capture file, see CaptureWriter.
+
+    Pending records are written on reactor shutdown.
+    """
+
+    def __init__(self, fd, compress=False, reactor=None, **kwargs):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.writer = CaptureWriter(fd, compress=compress, clock=reactor,
+                                    **kwargs)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def handle(self, source, msg, deviceProtocol):
+        self.writer.write(deviceProtocol.transport.sessionno,
+                          DIRECTIONS[source],
+                          msg.rawData)
+
+    def close(self):
+        self.writer.close()
+
+
+def main(args):
+    with open(args[0], 'rb') as fd:
+        for record in CaptureReader(fd):
+            source = SOURCES[record.direction]
+            print '%s [#%d] %s' % (
+                time.strftime('%Y-%m-%d %H:%M:%S',
+                              time.localtime(record.timestamp)),
+                record.connectionId,
+                LoggingHandler.sourcePrefixMap[source])
+            hexdump(record.frame)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
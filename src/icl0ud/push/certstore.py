@@ -0,0 +1,132 @@
+import os
+from collections import namedtuple
+
+from OpenSSL import crypto
+from twisted.internet import task
+from twisted.python import log
+
+
+DeviceCertificate = namedtuple('DeviceCertificate',
+                               'path mtime certificate privateKey')
+
+
+class DeviceCertificateStore(object):
+    """Parsed device certificates of a directory, by common name.
+
+    The directory contains a <common name>.pem file with certificate and
+    private key per device. It is indexed by start() and updated on changes
+    if inotify is available, otherwise rescanned every rescanInterval
+    seconds. get() never touches the disk.
+    """
+
+    def __init__(self, certDir, rescanInterval=60, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.certDir = certDir
+        self.rescanInterval = rescanInterval
+        self.reactor = reactor
+        self._certificates = {}
+        # common name -> mtime of a file that couldn't be loaded
+        self._invalid = {}
+        self._rescanCall = None
+        self._notifier = None
+
+    def __len__(self):
+        return len(self._certificates)
+
+    def get(self, commonName):
+        """Return the DeviceCertificate of commonName or None."""
+        return self._certificates.get(commonName)
+
+    def start(self):
+        self.scan()
+        self._watch()
+        # Rescans stat every file on the reactor thread, only needed when
+        # changes aren't reported
+        if self._notifier is None and self.rescanInterval:
+            self._rescanCall = task.LoopingCall(self.scan)
+            self._rescanCall.clock = self.reactor
+            self._rescanCall.start(self.rescanInterval, now=False)
+
+    def stop(self):
+        if self._rescanCall is not None:
+            self._rescanCall.stop()
+            self._rescanCall = None
+        if self._notifier is not None:
+            self._notifier.loseConnection()
+            self._notifier = None
+
+    def scan(self):
+        try:
+            fileNames = os.listdir(self.certDir)
+        except OSError:
+            log.err(None, 'Unable to list device certificates')
+            return
+        commonNames = set()
+        for fileName in fileNames:
+            commonName = self.update(fileName)
+            if commonName is not None:
+                commonNames.add(commonName)
+        for commonName in set(self._certificates) - commonNames:
+            del self._certificates[commonName]
+
+    def update(self, fileName):
+        """Load, reload or remove the certificate of a file in certDir.
+
+        Returns its common name if the file contains a certificate.
+        """
+        commonName, extension = os.path.splitext(fileName)
+        if extension != '.pem':
+            return None
+        path = os.path.join(self.certDir, fileName)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self._certificates.pop(commonName, None)
+            return None
+        cached = self._certificates.get(commonName)
+        if cached is not None and cached.mtime == mtime:
+            return commonName
+        if self._invalid.get(commonName) == mtime:
+            return None
+        try:
+            with open(path) as f:
+                data = f.read()
+            self._certificates[commonName] = DeviceCertificate(
+                path,
+                mtime,
+                crypto.load_certificate(crypto.FILETYPE_PEM, data),
+                crypto.load_privatekey(crypto.FILETYPE_PEM, data))
+        except (IOError, crypto.Error):
+            log.err(None, 'Unable to load device certificate %s' % path)
+            self._certificates.pop(commonName, None)
+            self._invalid[commonName] = mtime
+            return None
+        self._invalid.pop(commonName, None)
+        return commonName
+
+    def _watch(self):
+        try:
+            from twisted.internet import inotify
+            from twisted.python.filepath import FilePath
+        except ImportError:
+            # Not on Linux, rely on rescans
+            return
+        mask = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | \
+            inotify.IN_DELETE | inotify.IN_MOVED_FROM
+        notifier = None
+        try:
+            notifier = inotify.INotify(self.reactor)
+            notifier.startReading()
+            notifier.watch(FilePath(self.certDir), mask=mask,
+                           callbacks=[self._changed])
+        except Exception as e:
+            log.msg('Unable to watch %s, rescanning every %ss: %s' %
+                    (self.certDir, self.rescanInterval, e))
+            if notifier is not None:
+                notifier.loseConnection()
+            return
+        self._notifier = notifier
+
+    def _changed(self, ignored, path, mask):
+        self.update(path.basename())
@@ -1,3 +1,4 @@
+import random
 import traceback
 
 from twisted.python import log
@@ -5,6 +6,11 @@ from twisted.python import log
 from icl0ud.utils.hexdump import hexdump
 
 
+# LoggingHandler levels
+LOG_FULL = 'full'  # decoded messages
+LOG_METADATA = 'metadata'  # message type, size and push token prefix
+
+
 class BaseDispatch(object):
     """Message dispatching mix-in"""
 
@@ -19,19 +25,49 @@ class BaseDispatch(object):
 
     def addHandler(self, handler):
         self.handlers.add(handler)
+        self._dispatchTable = None
 
     def removeHandlers(self, handlers):
         map(self.removeHandler, handlers)
 
     def removeHandler(self, handler):
-        self.handlers.pop(handler)
+        self.handlers.discard(handler)
+        self._dispatchTable = None
+
+    def _getDispatchTable(self):
+        """Return handlers by message type and handlers for all types.
+
+        Built once after handlers changed, based on their messageTypes.
+        """
+        if getattr(self, '_dispatchTable', None) is None:
+            allTypesHandlers = [handler for handler in self.handlers
+                                if handler.messageTypes is None]
+            handlersByType = {}
+            for handler in self.handlers:
+                for messageType in handler.messageTypes or ():
+                    handlersByType.setdefault(messageType,
+                                              list(allTypesHandlers)) \
+                                  .append(handler)
+            self._dispatchTable = (handlersByType, allTypesHandlers)
+        return self._dispatchTable
+
+    def handlersForType(self, messageType):
+        handlersByType, allTypesHandlers = self._getDispatchTable()
+        return handlersByType.get(messageType, allTypesHandlers)
+
+    def isDispatched(self, messageType):
+        """Check whether any handler wants messages of messageType."""
+        return bool(self.handlersForType(messageType))
 
     def dispatch(self, source, message):
         forwardMessage = True
 
-        for handler in self.handlers:
+        handlers = self.handlersForType(message.type)
+        if not handlers:
+            return forwardMessage
+        deviceProtocol = self.getDeviceProtocol()
+        for handler in handlers:
             try:
-                deviceProtocol = self.getDeviceProtocol()
                 result = handler.handle(source, message, deviceProtocol)
                 if not result in (True, None):
                     log.msg('BaseDispatch: Skipping message forward ' +
@@ -45,18 +81,68 @@ class BaseDispatch(object):
                 forwardMessage = False
         return forwardMessage
 
+    def dispatchConnectionLost(self, source, reason):
+        deviceProtocol = self.getDeviceProtocol()
+        for handler in self.handlers:
+            try:
+                handler.connectionLost(source, deviceProtocol, reason)
+            except Exception:
+                log.err(handler.__class__.__name__ + ': ' + \
+                        traceback.format_exc())
+
 
 class BaseHandler(object):
+    # Message type bytes the handler wants to see, None for all messages.
+    # handle() is only called for these, messages of other types are
+    # forwarded without being parsed.
+    messageTypes = None
+
     def handle(self, source, *args, **kwargs):
         raise NotImplementedError()
 
+    def connectionLost(self, source, deviceProtocol, reason):
+        """Called when the device (source 'device') or push server (source
+        'server') connection of deviceProtocol is closed."""
+
+    def describe(self):
+        """Return lines of statistics for the log."""
+        return []
+
+
+class MessageLogEntry(object):
+    """Log line for a message, only formatted when written to the log."""
+    __slots__ = ('direction', 'message', 'level')
+
+    def __init__(self, direction, message, level=LOG_FULL):
+        self.direction = direction
+        self.message = message
+        self.level = level
+
+    def __str__(self):
+        if self.level == LOG_METADATA:
+            return self.direction + ' ' + self.message.formatSummary()
+        return self.direction + ' ' + str(self.message)
+
 
 class LoggingHandler(BaseHandler):
     sourcePrefixMap = {'server': '<-', 'device': '->'}
 
+    def __init__(self, level=LOG_FULL, sampleRate=1.0, messageTypes=None):
+        """
+        level: LOG_FULL or LOG_METADATA, which doesn't decode payloads
+        sampleRate: fraction of messages to log
+        messageTypes: message types to log, None for all
+        """
+        self.level = level
+        self.sampleRate = sampleRate
+        self.messageTypes = messageTypes
+
     def handle(self, source, msg, deviceProtocol):
-        direction = self.sourcePrefixMap[source]
-        deviceProtocol.log(direction + ' ' + str(msg))
+        if self.sampleRate < 1 and random.random() >= self.sampleRate:
+            return
+        deviceProtocol.log(MessageLogEntry(self.sourcePrefixMap[source],
+                                           msg,
+                                           self.level))
 
 
 class HexdumpHandler(LoggingHandler):
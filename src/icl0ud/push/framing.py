@@ -0,0 +1,75 @@
+from struct import Struct
+
+
+HEADER = Struct('!BL')  # message type, payload length
+HEADER_LENGTH = HEADER.size
+FIELD_HEADER = Struct('!BH')  # field type, content length
+FIELD_HEADER_LENGTH = FIELD_HEADER.size
+
+
+class APSFrameBuffer(object):
+    """Receive buffer splitting a byte stream into APS frames.
+
+    Received data is appended to a single bytearray, complete frames are
+    handed out as memoryviews into it. The consumed part at the start of the
+    buffer is only dropped when new data arrives, so a frame is never copied
+    while it is waiting for its remaining bytes.
+
+    Views returned by frames() must not be kept after the next append(),
+    copy them with tobytes() if needed.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._start = 0  # offset of the first unconsumed byte
+        # end offset of the next frame, as soon as its header is complete
+        self._frameEnd = HEADER_LENGTH
+
+    def __len__(self):
+        return len(self._buffer) - self._start
+
+    def append(self, data):
+        if self._start:
+            self._compact()
+        self._buffer.extend(data)
+
+    def _compact(self):
+        try:
+            del self._buffer[:self._start]
+        except BufferError:
+            # A consumer still holds a view of an old frame, the buffer can't
+            # be resized. Leave it to the consumer and continue with a copy
+            # of the unconsumed data.
+            self._buffer = bytearray(memoryview(self._buffer)[self._start:])
+        self._frameEnd -= self._start
+        self._start = 0
+
+    def pendingFrameLength(self):
+        """Return the payload length the next frame's header declares.
+
+        None if the header isn't complete yet.
+        """
+        if len(self) < HEADER_LENGTH:
+            return None
+        return HEADER.unpack_from(self._buffer, self._start)[1]
+
+    def frames(self, maxLength=None):
+        """Yield a memoryview for each complete frame in the buffer.
+
+        Stops at a frame whose header declares more than maxLength bytes,
+        which stays in the buffer, see pendingFrameLength.
+        """
+        buff = self._buffer
+        end = len(buff)
+        while end >= self._frameEnd:
+            start = self._start
+            length = HEADER.unpack_from(buff, start)[1]
+            if maxLength is not None and length > maxLength:
+                return
+            frameEnd = start + length + HEADER_LENGTH
+            if frameEnd > end:
+                self._frameEnd = frameEnd
+                return
+            self._start = frameEnd
+            self._frameEnd = frameEnd + HEADER_LENGTH
+            yield memoryview(buff)[start:frameEnd]
@@ -0,0 +1,141 @@
+"""Injection of notifications by local producers over a Unix socket.
+
+Producers send APS frames of type APSNotification, containing exactly the
+recipientPushToken, topic and payload fields, see marshalNotification. The
+frames are checked and forwarded as they are, the proxy only appends the
+message id, expiry, timestamp and storage flags, see
+PushNotificationSender.sendFrames.
+
+For each frame the proxy answers with one status byte, in the order the
+frames were received: STATUS_CODES of the sender's statuses or
+STATUS_INVALID.
+"""
+from twisted.internet import defer
+from twisted.internet.protocol import Factory, Protocol
+from twisted.python import log
+
+from icl0ud.push.framing import APSFrameBuffer, HEADER, HEADER_LENGTH
+from icl0ud.push.messages import APSNotification
+from icl0ud.push.notification_sender import (STATUS_SENT,
+                                             STATUS_UNKNOWN_TOKEN,
+                                             RECIPIENT_FIELD, TOPIC_FIELD,
+                                             PAYLOAD_FIELD,
+                                             notificationFields)
+from icl0ud.push.parser import FIELD_HEADER, FIELD_HEADER_LENGTH
+
+
+STATUS_CODES = {
+    STATUS_SENT: '\x00',
+    STATUS_UNKNOWN_TOKEN: '\x01',
+}
+STATUS_INVALID = '\x02'
+
+INJECTED_FIELDS = (RECIPIENT_FIELD, TOPIC_FIELD, PAYLOAD_FIELD)
+
+
+def marshalNotification(pushToken, topic, payload):
+    """Return the frame a producer sends for a notification."""
+    fields = notificationFields(pushToken, topic, payload)
+    return HEADER.pack(APSNotification.type, len(fields)) + fields
+
+
+def parseFrame(frame):
+    """Return (pushToken, fields) of an injected frame, None if invalid.
+
+    frame is a string or memoryview of a complete frame, fields its
+    marshalled fields.
+    """
+    messageType, length = HEADER.unpack_from(frame)
+    if messageType != APSNotification.type:
+        return None
+    end = HEADER_LENGTH + length
+    offset = HEADER_LENGTH
+    contents = {}  # field type -> (offset, length) of its content
+    while offset < end:
+        if offset + FIELD_HEADER_LENGTH > end:
+            return None
+        fieldType, fieldLength = FIELD_HEADER.unpack_from(frame, offset)
+        offset += FIELD_HEADER_LENGTH
+        if fieldType not in INJECTED_FIELDS or fieldType in contents:
+            return None
+        contents[fieldType] = (offset, fieldLength)
+        offset += fieldLength
+    if offset != end or len(contents) != len(INJECTED_FIELDS):
+        return None
+    tokenOffset, tokenLength = contents[RECIPIENT_FIELD]
+    if not tokenLength:
+        return None
+    pushToken = frame[tokenOffset:tokenOffset + tokenLength]
+    fields = frame[HEADER_LENGTH:end]
+    if isinstance(frame, memoryview):
+        pushToken, fields = pushToken.tobytes(), fields.tobytes()
+    return (pushToken, fields)
+
+
+class InjectionProtocol(Protocol):
+    """Passes the frames received at once to the sender in one call."""
+
+    def connectionMade(self):
+        self._buffer = APSFrameBuffer()
+        # Fires once the statuses of earlier frames are written
+        self._replies = defer.succeed(None)
+
+    def dataReceived(self, data):
+        if self.transport.disconnecting:
+            return
+        self._buffer.append(data)
+        replies = []
+        frames = []
+        positions = []  # index in replies of each frame in frames
+        # Frames longer than maxFrameLength aren't waited for or parsed
+        for frame in self._buffer.frames(self.factory.maxFrameLength):
+            parsed = parseFrame(frame)
+            if parsed is None:
+                replies.append(STATUS_INVALID)
+            else:
+                positions.append(len(replies))
+                replies.append(None)
+                frames.append(parsed)
+        if self._nextFrameTooLong():
+            log.msg('InjectionProtocol: Frame longer than %d bytes, '
+                    'closing connection' % self.factory.maxFrameLength)
+            self.transport.loseConnection()
+        if not replies:
+            return
+
+        if frames:
+            d = defer.maybeDeferred(self.factory.notificationSender.sendFrames,
+                                    frames)
+        else:
+            d = defer.succeed([])
+        d.addCallback(self._statusCodes, positions, replies)
+        self._replies.addCallback(lambda ignored: d)
+        self._replies.addCallback(self.transport.write)
+        self._replies.addErrback(self._failed)
+
+    def _nextFrameTooLong(self):
+        length = self._buffer.pendingFrameLength()
+        return length is not None and length > self.factory.maxFrameLength
+
+    def _statusCodes(self, statuses, positions, replies):
+        for position, status in zip(positions, statuses):
+            replies[position] = STATUS_CODES[status]
+        return ''.join(replies)
+
+    def _failed(self, reason):
+        log.err(reason, 'Sending injected notifications failed')
+        self.transport.loseConnection()
+
+
+class InjectionFactory(Factory):
+    """Accepts producer connections.
+
+    notificationSender is a PushNotificationSender or, with workers, the
+    supervisor's NotificationRouter.
+    """
+
+    protocol = InjectionProtocol
+    maxFrameLength = 64 * 1024
+
+    def __init__(self, notificationSender):
+        self.notificationSender = notificationSender
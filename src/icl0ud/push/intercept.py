@@ -1,14 +1,139 @@
-import os
-import random
 import traceback
 from uuid import UUID
 
-from OpenSSL import SSL
-from twisted.internet import reactor, ssl, protocol
+from OpenSSL import SSL, crypto
+from twisted.internet import reactor, ssl, protocol, task
+from twisted.protocols.tls import TLSMemoryBIOProtocol
 from twisted.python import log
+from zope.interface import implementer
 
+from icl0ud.push.certstore import DeviceCertificateStore
 from icl0ud.push.dispatch import BaseDispatch
+from icl0ud.push.framing import APSFrameBuffer
 from icl0ud.push.parser import APSParser
+from icl0ud.push.upstream import UpstreamSelector
+
+try:
+    from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+    _implementsClientConnectionCreator = \
+        implementer(IOpenSSLClientConnectionCreator)
+except ImportError:
+    # Twisted < 14.0 only calls getContext
+    _implementsClientConnectionCreator = lambda cls: cls
+
+try:
+    from twisted.internet.interfaces import IHandshakeListener
+    _implementsHandshakeListener = implementer(IHandshakeListener)
+except ImportError:
+    IHandshakeListener = None
+    _implementsHandshakeListener = lambda cls: cls
+
+try:
+    # Only needed by pyOpenSSL releases without Connection.session_reused
+    from OpenSSL._util import lib as _lib
+except ImportError:
+    _lib = None
+
+
+def getTLSConnection(transport):
+    """Return the OpenSSL connection of a TLS transport, or None."""
+    try:
+        handle = transport.getHandle()
+    except AttributeError:
+        return None
+    if isinstance(handle, SSL.Connection):
+        return handle
+    return None
+
+
+def sessionReused(tlsConnection):
+    """Return whether a TLS connection resumed an earlier session."""
+    if hasattr(tlsConnection, 'session_reused'):
+        return bool(tlsConnection.session_reused())
+    try:
+        return bool(_lib.SSL_session_reused(tlsConnection._ssl))
+    except AttributeError:
+        # Private API, gone or renamed
+        return False
+
+
+def keepSessionResumable(transport):
+    """Keep the TLS session of a closed connection resumable.
+
+    OpenSSL drops sessions of connections that were not shut down cleanly,
+    which is how most devices and courier connections end.
+    """
+    tlsConnection = getTLSConnection(transport)
+    if tlsConnection is not None:
+        tlsConnection.set_shutdown(SSL.SENT_SHUTDOWN | SSL.RECEIVED_SHUTDOWN)
+
+
+def unregisterProducer(transport):
+    """Unregister the producer of a transport that may be closed already.
+
+    TLS transports don't close while a producer is registered, closed TCP
+    transports with TLS fail to unregister it.
+    """
+    if not getattr(transport, 'disconnected', False):
+        transport.unregisterProducer()
+
+
+def setBufferSize(transport, bufferSize):
+    """Set the bytes a transport buffers before pausing its producer.
+
+    TLSMemoryBIOProtocol, the device transport in workers, registers
+    producers with the transport it wraps, which buffers the encrypted data.
+    """
+    if isinstance(transport, TLSMemoryBIOProtocol):
+        transport = transport.transport
+    transport.bufferSize = bufferSize
+
+
+class WriteQueue(object):
+    """Gathers data written to a transport into one writeSequence call.
+
+    Data is written maxDelay seconds after the first pending write, at the
+    end of the reactor iteration for 0, or as soon as maxSize bytes are
+    pending. A TLS transport encrypts the data of one writeSequence call in
+    as few records as possible.
+    """
+
+    def __init__(self, transport, maxDelay=0, maxSize=16 * 1024,
+                 clock=None):
+        if clock is None:
+            clock = reactor
+        self.transport = transport
+        self.maxDelay = maxDelay
+        self.maxSize = maxSize
+        self.clock = clock
+        self._pending = []
+        self._pendingSize = 0
+        self._delayedFlush = None
+
+    def write(self, data):
+        self._pending.append(data)
+        self._pendingSize += len(data)
+        if self._pendingSize >= self.maxSize:
+            self.flush()
+        elif self._delayedFlush is None:
+            self._delayedFlush = self.clock.callLater(self.maxDelay,
+                                                      self.flush)
+
+    def flush(self):
+        if self._delayedFlush is not None:
+            if self._delayedFlush.active():
+                self._delayedFlush.cancel()
+            self._delayedFlush = None
+        if self._pending:
+            self.transport.writeSequence(self._pending)
+            self._pending = []
+            self._pendingSize = 0
+
+    def discard(self):
+        """Drop pending data, the transport is closed."""
+        self._pending = []
+        self._pendingSize = 0
+        self.flush()
 
 
 class MessageProxy(protocol.Protocol, BaseDispatch, object):
@@ -16,79 +141,215 @@ class MessageProxy(protocol.Protocol, BaseDispatch, object):
     peer_type = None  # device or server
 
     def __init__(self):
-        self._parser = APSParser()
+        # Most messages are only forwarded, decode fields on demand.
+        self._parser = APSParser(lazy=True)
         self._source = None
-        self._buffer = b''
+        self._frameBuffer = APSFrameBuffer()
+        self._writeQueue = None
 
     def setPeer(self, peer):
         self.peer = peer
 
     def dataReceived(self, data):
-        buff = self._buffer + data
-
-        while self._parser.isMessageComplete(buff):
-            message, length = self._parser.parseMessage(buff)
-            messageData = buff[:length]
-            buff = buff[length:]
-            self.handleMessage(message, messageData)
-
-        self._buffer = buff
-
-    def handleMessage(self, message, data):
+        self._frameBuffer.append(data)
+        for frame in self._frameBuffer.frames():
+            if not self.isDispatched(ord(frame[0])):
+                # No handler is interested, don't bother parsing
+                self.sendToPeer(frame.tobytes())
+                continue
+            message, length = self._parser.parseMessage(frame)
+            self.handleMessage(message)
+
+    def handleMessage(self, message):
         forward = self.dispatch(self.peer_type, message)
         if forward:
-            self.sendToPeer(data)
+            # The frame it was parsed from, unless a handler changed it
+            self.sendToPeer(message.marshal())
 
     def sendToPeer(self, data):
-        self.peer.transport.write(data)
+        self.peer.write(data)
+
+    def write(self, data):
+        """Write data to the transport, see WriteQueue.
+
+        The queue is configured by writeDelay and writeBatchSize of the
+        device's InterceptServerFactory.
+        """
+        if self._writeQueue is None:
+            factory = self.getDeviceProtocol().factory
+            self._writeQueue = WriteQueue(self.transport,
+                                          maxDelay=factory.writeDelay,
+                                          maxSize=factory.writeBatchSize)
+        self._writeQueue.write(data)
+
+    def flushWrites(self):
+        if self._writeQueue is not None:
+            self._writeQueue.flush()
 
     def connectionLost(self, reason):
-        # TODO notify handlers
+        keepSessionResumable(self.transport)
+        if self._writeQueue is not None:
+            self._writeQueue.discard()
+        self.dispatchConnectionLost(self.peer_type, reason)
         # FIXME fix this shutdown
         if self.peer is not None:
+            unregisterProducer(self.peer.transport)
+            self.peer.flushWrites()
             self.peer.transport.loseConnection()
             self.peer = None
         else:
             log.msg("Unable to connect to peer: %s" % (reason,))
 
 
+@_implementsHandshakeListener
 class InterceptClient(MessageProxy):
-    """Proxy Client, captures iCloud-to-client traffic."""
+    """Proxy Client, captures iCloud-to-client traffic.
+
+    The connection starts as plain TCP, TLS is started with the device's
+    certificate once it is known, see InterceptClientFactory. The device is
+    attached once the TLS handshake is done, so the device can retry another
+    host if it fails.
+    """
     peer_type = 'server'
+    _sessionSaved = False
 
     def connectionMade(self):
-        self.peer.connectedToServer(self)
+        self.factory.tcpConnected(self)
+
+    def handshakeCompleted(self):
+        self.factory.connected(self)
+
+    def dataReceived(self, data):
+        if not self._sessionSaved:
+            # The handshake is done, TLS 1.3 session tickets arrive before
+            # any data.
+            self._sessionSaved = True
+            self.saveSession()
+        super(InterceptClient, self).dataReceived(data)
+
+    def saveSession(self):
+        contextFactory = self.getDeviceProtocol().clientContextFactory
+        if contextFactory is not None:
+            contextFactory.saveSession(self.transport)
 
     def getDeviceProtocol(self):
         return self.factory.deviceProtocol
 
 
 class InterceptClientFactory(protocol.ClientFactory):
+    """Connects a device to host, reporting the outcome to upstream.
+
+    The TCP connection may be opened before the device's TLS handshake is
+    done. TLS is started by startTLS() or, if that was called before, once
+    the TCP connection is established.
+    """
 
     protocol = InterceptClient
 
-    def __init__(self, deviceProtocol):
+    def __init__(self, deviceProtocol, host=None, upstream=None):
         self.deviceProtocol = deviceProtocol
+        self.host = host
+        self.upstream = upstream
+        self.connector = None
+        self.client = None
+        self.contextFactory = None
+        self.handshakeDone = False
+        self.aborted = False
+        self.started = reactor.seconds()
+        self._tcpLatency = None
+        self._tlsStarted = None
 
     def buildProtocol(self, *args, **kw):
         prot = protocol.ClientFactory.buildProtocol(self, *args, **kw)
-        prot.setPeer(self.deviceProtocol)
         prot.addHandlers(self.dispatchHandlers)
         return prot
 
+    def tcpConnected(self, prot):
+        self.client = prot
+        self._tcpLatency = reactor.seconds() - self.started
+        if self.contextFactory is not None:
+            self._startTLS()
+
+    def startTLS(self, contextFactory):
+        if self.contextFactory is not None:
+            return
+        self.contextFactory = contextFactory
+        if self.client is not None:
+            self._startTLS()
+
+    def _startTLS(self):
+        self._tlsStarted = reactor.seconds()
+        self.client.transport.startTLS(self.contextFactory)
+        if IHandshakeListener is None:
+            # Older Twisted releases don't report completed handshakes, data
+            # is buffered until the handshake is done.
+            self.client.handshakeCompleted()
+
+    def connected(self, prot):
+        self.handshakeDone = True
+        if self.upstream is not None:
+            # Don't count the time waiting for the device's handshake
+            latency = self._tcpLatency + reactor.seconds() - self._tlsStarted
+            self.upstream.connectSucceeded(self.host, latency)
+        prot.setPeer(self.deviceProtocol)
+        self.deviceProtocol.connectedToServer(prot)
+
+    def abort(self):
+        """Close the connection, the device is gone."""
+        self.aborted = True
+        if self.client is not None:
+            self.client.transport.loseConnection()
+        elif self.connector is not None:
+            self.connector.stopConnecting()
+
     def clientConnectionFailed(self, connector, reason):
-        self.deviceProtocol.transport.loseConnection()
+        # Stopping it would raise NotConnectingError now
+        self.connector = None
+        self.failed(reason)
+
+    def clientConnectionLost(self, connector, reason):
+        self.connector = None
+        if not self.handshakeDone:
+            self.failed(reason)
+
+    def failed(self, reason):
+        if self.aborted:
+            return
+        if self.upstream is not None:
+            self.upstream.connectFailed(self.host)
+        self.deviceProtocol.connectToServerFailed(self.host, reason)
 
     def setDispatchHandlers(self, handlers):
         self.dispatchHandlers = handlers
 
 
+def loadCertificates(path):
+    """Return the X509 certificates in a PEM file."""
+    marker = '-----BEGIN CERTIFICATE-----'
+    with open(path) as f:
+        blocks = f.read().split(marker)[1:]
+    return [crypto.load_certificate(crypto.FILETYPE_PEM, marker + block)
+            for block in blocks]
+
+
+@_implementsClientConnectionCreator
 class InterceptClientContextFactory(ssl.ClientContextFactory):
+    """Client context of a device, created once.
+
+    The TLS session of the last upstream connection is resumed by the next
+    one, see saveSession(). caCerts are the X509 certificates of chain, pass
+    them to avoid reading chain for every device. Likewise cert isn't read
+    if its DeviceCertificate is passed.
+    """
 
-    def __init__(self, cert, chain):
+    def __init__(self, cert, chain, caCerts=None, deviceCertificate=None):
         self.cert = cert
         self.chain = chain
+        self.caCerts = caCerts
+        self.deviceCertificate = deviceCertificate
         self.method = SSL.SSLv23_METHOD
+        self.session = None
+        self._context = None
 
     def _verifyCallback(self, conn, cert, errno, depth, preverifyOk):
         # FIXME we should check the server common name
@@ -97,13 +358,76 @@ class InterceptClientContextFactory(ssl.ClientContextFactory):
         return preverifyOk
 
     def getContext(self):
-        ctx = ssl.ClientContextFactory.getContext(self)
-        ctx.load_verify_locations(self.chain)
-        ctx.use_certificate_file(self.cert)
-        ctx.use_privatekey_file(self.cert)
-        ctx.set_verify(SSL.VERIFY_PEER | SSL.VERIFY_FAIL_IF_NO_PEER_CERT,
-            self._verifyCallback)
-        return ctx
+        if self._context is None:
+            ctx = ssl.ClientContextFactory.getContext(self)
+            if self.caCerts is None:
+                ctx.load_verify_locations(self.chain)
+            else:
+                store = ctx.get_cert_store()
+                for caCert in self.caCerts:
+                    store.add_cert(caCert)
+            if self.deviceCertificate is None:
+                ctx.use_certificate_file(self.cert)
+                ctx.use_privatekey_file(self.cert)
+            else:
+                ctx.use_certificate(self.deviceCertificate.certificate)
+                ctx.use_privatekey(self.deviceCertificate.privateKey)
+            ctx.set_verify(SSL.VERIFY_PEER | SSL.VERIFY_FAIL_IF_NO_PEER_CERT,
+                self._verifyCallback)
+            ctx.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+            self._context = ctx
+        return self._context
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        # Used by Twisted >= 14.0 instead of getContext
+        conn = SSL.Connection(self.getContext(), None)
+        if self.session is not None:
+            conn.set_session(self.session)
+        return conn
+
+    def saveSession(self, transport):
+        tlsConnection = getTLSConnection(transport)
+        if tlsConnection is not None:
+            self.session = tlsConnection.get_session()
+
+
+class ClientContextCache(object):
+    """InterceptClientContextFactory of each device, by common name.
+
+    Certificates are looked up in a DeviceCertificateStore, the CA chain is
+    parsed once for all devices. A device's context factory is recreated if
+    the store reloaded its certificate.
+    """
+
+    def __init__(self, certificates, caCertChain):
+        self.certificates = certificates
+        self.caCertChain = caCertChain
+        self._caCerts = None
+        self._contextFactories = {}  # common name -> (certificate, factory)
+
+    def getContextFactory(self, commonName):
+        certificate = self.certificates.get(commonName)
+        if certificate is None:
+            self._contextFactories.pop(commonName, None)
+            raise Exception('Device certificate is missing: %s' % commonName)
+
+        cached = self._contextFactories.get(commonName)
+        if cached is not None and cached[0] is certificate:
+            return cached[1]
+        if self._caCerts is None:
+            self._caCerts = loadCertificates(self.caCertChain)
+        contextFactory = InterceptClientContextFactory(
+            cert=certificate.path,
+            chain=self.caCertChain,
+            caCerts=self._caCerts,
+            deviceCertificate=certificate,
+        )
+        self._contextFactories[commonName] = (certificate, contextFactory)
+        return contextFactory
+
+
+def dispatchSSLInfo(conn, where, ret):
+    conn.get_app_data().SSLInfoCallback(conn, where, ret)
 
 
 class InterceptServer(MessageProxy):
@@ -116,7 +440,12 @@ class InterceptServer(MessageProxy):
         super(InterceptServer, self).__init__(*args, **kwargs)
         self.clientContextFactory = None
         self.deviceCommonName = None
-        self._peerSendBuffer = b''
+        self.disconnected = False
+        # Chunks received before the push server connection is established
+        self._peerSendBuffer = []
+        self._peerSendBufferSize = 0
+        self._triedHosts = []
+        self._clientFactory = None
 
     def SSLInfoCallback(self, conn, where, ret):
         # TODO check why this callback is called two times with HANDSHAKE_DONE
@@ -132,6 +461,7 @@ class InterceptServer(MessageProxy):
                     cert = self.transport.getPeerCertificate()
                 subject = dict(cert.get_subject().get_components())
                 self.deviceCommonName = subject['CN']
+                self.factory.getServerContextFactory().recordHandshake(conn)
                 self.log('SSL handshake done: Device: %s' %
                          self.deviceCommonName)
                 self.connectToServer()
@@ -141,35 +471,97 @@ class InterceptServer(MessageProxy):
                 log.err(traceback.format_exc())
 
     def connectionMade(self):
-        try:
-            # Twisted < 11.1
-            sslContext = self.transport.socket.get_context()
-        except AttributeError:
-            # Twisted >= 11.1
-            # TODO Don't use private attribute _tlsConnection
-            sslContext = self.transport._tlsConnection.get_context()
-        sslContext.set_info_callback(self.SSLInfoCallback)
+        tlsConnection = getTLSConnection(self.transport)
+        # The context is shared by all connections, the callback looks up
+        # the protocol of the connection it is called for.
+        tlsConnection.set_app_data(self)
+        tlsConnection.get_context().set_info_callback(dispatchSSLInfo)
         peer = self.transport.getPeer()
         self.log('New connection from %s:%d' % (peer.host, peer.port))
+        if self.factory.speculativeConnect:
+            # Connect while the device handshake is in progress
+            self.connectUpstream()
+
+    def connectionLost(self, reason):
+        self.disconnected = True
+        try:
+            if self.peer is None and self._clientFactory is not None:
+                self._clientFactory.abort()
+        finally:
+            # Handlers must learn about the device in any case
+            super(InterceptServer, self).connectionLost(reason)
 
     def connectToServer(self):
         # Don't read anything from the connecting client until we have
         # somewhere to send it to.
         self.transport.pauseProducing()
-        clientFactory = self.getClientFactory()
-        host = random.choice(self.factory.hosts)
+        try:
+            contextFactory = self.getClientContextFactory()
+        except Exception:
+            # Without a device certificate the speculative connection is
+            # of no use
+            if self._clientFactory is not None:
+                self._clientFactory.abort()
+                self._clientFactory = None
+            raise
+        if self._clientFactory is None:
+            self.connectUpstream()
+        self._clientFactory.startTLS(contextFactory)
+
+    def connectUpstream(self):
+        """Open a TCP connection to a push server.
+
+        TLS is started once the device certificate is known.
+        """
+        host = self.factory.upstream.choose(exclude=self._triedHosts)
+        self._triedHosts.append(host)
+        self._clientFactory = self.getClientFactory(host)
         self.log('Connecting to push server: %s:%d' %
                  (host, self.factory.port))
-        reactor.connectSSL(host,
-                           self.factory.port,
-                           clientFactory,
-                           self.getClientContextFactory())
+        self._clientFactory.connector = reactor.connectTCP(
+            host,
+            self.factory.port,
+            self._clientFactory,
+            timeout=self.factory.connectTimeout)
+
+    def connectToServerFailed(self, host, reason):
+        self.log('Connecting to push server %s failed: %s' %
+                 (host, reason.getErrorMessage()))
+        if self.disconnected:
+            return
+        attempts = min(self.factory.maxConnectAttempts,
+                       len(self.factory.hosts))
+        if len(self._triedHosts) < attempts:
+            contextFactory = self._clientFactory.contextFactory
+            self.connectUpstream()
+            if contextFactory is not None:
+                self._clientFactory.startTLS(contextFactory)
+        else:
+            self.transport.loseConnection()
 
     def connectedToServer(self, peer):
+        if self.disconnected:
+            # The device gave up while connecting
+            peer.transport.loseConnection()
+            return
         self.setPeer(peer)
+        self.registerPeerProducers()
         self.flushSendBuffer()
         self.transport.resumeProducing()
 
+    def registerPeerProducers(self):
+        """Stop reading from either side while the other can't keep up.
+
+        A transport pauses its producer once more than bufferSize bytes wait
+        to be written and resumes it when they are written.
+        """
+        bufferSize = self.factory.writeBufferSize
+        for consumer, producer in ((self.transport, self.peer.transport),
+                                   (self.peer.transport, self.transport)):
+            if bufferSize is not None:
+                setBufferSize(consumer, bufferSize)
+            consumer.registerProducer(producer, True)
+
     def getDeviceProtocol(self):
         return self
 
@@ -177,39 +569,48 @@ class InterceptServer(MessageProxy):
         # This happens if connectToserver is not called fast enough to stop
         # the transport from producing. We send the buffer once the client
         # connection is established.
-        if self.peer is None:
-            self._peerSendBuffer += data
-        else:
+        if self.peer is not None:
             super(InterceptServer, self).sendToPeer(data)
+            return
+        size = self._peerSendBufferSize + len(data)
+        if size <= self.factory.maxPendingBytes:
+            self._peerSendBuffer.append(data)
+        elif self._peerSendBufferSize <= self.factory.maxPendingBytes:
+            self.log('Closing connection, more than %d bytes received '
+                     'before connecting to push server' %
+                     self.factory.maxPendingBytes)
+            self.transport.loseConnection()
+        self._peerSendBufferSize = size
 
     def flushSendBuffer(self):
-        self.sendToPeer(self._peerSendBuffer)
-        self._peerSendBuffer = b''
+        self.peer.transport.writeSequence(self._peerSendBuffer)
+        self._peerSendBuffer = []
+        self._peerSendBufferSize = 0
 
-    def getClientFactory(self, ):
-        f = self.clientProtocolFactory(deviceProtocol=self)
+    def getClientFactory(self, host=None):
+        f = self.clientProtocolFactory(deviceProtocol=self, host=host,
+                                       upstream=self.factory.upstream)
         f.setDispatchHandlers(self.factory.dispatchHandlers)
         return f
 
     def getClientContextFactory(self):
-        certDir = self.factory.clientCertDir
         # ensure this is a valid UUID, if not this throws an exception
         UUID(self.deviceCommonName)
 
-        cert = os.path.join(certDir, self.deviceCommonName + '.pem')
-        if not os.path.isfile(cert):
-            raise Exception('Device certificate is missing: %s' % cert)
-
         if self.clientContextFactory is None:
-            self.clientContextFactory = InterceptClientContextFactory(
-                cert=cert,
-                chain=self.factory.caCertChain,
-            )
+            self.clientContextFactory = \
+                self.factory.clientContexts.getContextFactory(
+                    self.deviceCommonName)
         return self.clientContextFactory
 
     def log(self, msg):
-        prefix = '[#%d] ' % self.transport.sessionno
-        log.msg(prefix + msg)
+        # msg may be any object, it is only converted to a string when an
+        # observer emits the event. Passing log_format keeps Twisted >= 15.2
+        # from formatting the event right away.
+        log.msg(format='[#%(sessionno)d] %(text)s',
+                log_format='[#{sessionno}] {text}',
+                sessionno=self.transport.sessionno,
+                text=msg)
 
 
 class InterceptServerFactory(protocol.Factory):
@@ -217,10 +618,31 @@ class InterceptServerFactory(protocol.Factory):
     protocol = InterceptServer
     serverContextFactory = None
 
+    # Seconds to wait for a courier connection
+    connectTimeout = 10
+    # Courier hosts to try before dropping a device
+    maxConnectAttempts = 3
+    # Open the courier TCP connection when a device connects instead of
+    # after its TLS handshake
+    speculativeConnect = True
+    # Bytes a device may send before its push server connection is
+    # established
+    maxPendingBytes = 256 * 1024
+    # Bytes buffered for writing to a device or push server before reading
+    # from its peer is paused, None keeps the transport's default
+    writeBufferSize = None
+    # Frames written to a connection within writeDelay seconds, up to
+    # writeBatchSize bytes, are written at once, see WriteQueue. The default
+    # gathers the frames of one reactor iteration into one TLS record.
+    writeDelay = 0
+    writeBatchSize = 16 * 1024
+
     def __init__(self, hosts, port, serverCert, clientCertDir, caCertChain,
-        serverChain, dispatchHandlers=[]):
+        serverChain, dispatchHandlers=[], sessionCache=True,
+        statsInterval=600):
         self.hosts = hosts
         self.port = port
+        self.upstream = UpstreamSelector(hosts)
         # Passing through the complete configuration seems quite ugly. Maybe
         # implement a Service?
         # The courier.push.apple.com server certificate
@@ -233,6 +655,39 @@ class InterceptServerFactory(protocol.Factory):
         self.serverChain = serverChain
 
         self.dispatchHandlers = dispatchHandlers
+        self.deviceCertificates = DeviceCertificateStore(clientCertDir)
+        self.clientContexts = ClientContextCache(self.deviceCertificates,
+                                                 caCertChain)
+        # Resume TLS sessions of reconnecting devices
+        self.sessionCache = sessionCache
+        # Seconds between TLS session and courier host statistics in the
+        # log, 0 disables them
+        self.statsInterval = statsInterval
+        self._statsCall = None
+
+    def startFactory(self):
+        self.deviceCertificates.start()
+        log.msg('Loaded %d device certificates' % len(self.deviceCertificates))
+        if self.statsInterval:
+            self._statsCall = task.LoopingCall(self.logStats)
+            self._statsCall.start(self.statsInterval, now=False)
+
+    def stopFactory(self):
+        self.deviceCertificates.stop()
+        if self._statsCall is not None:
+            self._statsCall.stop()
+            self._statsCall = None
+
+    def logStats(self):
+        handshakes, resumed = self.getServerContextFactory().resetStats()
+        if handshakes:
+            log.msg('TLS handshakes: %d, resumed: %d (%.1f%%)' %
+                    (handshakes, resumed, 100.0 * resumed / handshakes))
+        for line in self.upstream.describe():
+            log.msg('Push server %s' % line)
+        for handler in self.dispatchHandlers:
+            for line in handler.describe():
+                log.msg('%s: %s' % (handler.__class__.__name__, line))
 
     def buildProtocol(self, *args):
         p = protocol.Factory.buildProtocol(self, *args)
@@ -243,31 +698,80 @@ class InterceptServerFactory(protocol.Factory):
         if self.serverContextFactory is None:
             self.serverContextFactory = InterceptServerContextFactory(
                 self.serverCert,
-                self.serverChain
+                self.serverChain,
+                sessionCache=self.sessionCache,
             )
         return self.serverContextFactory
 
 
 class InterceptServerContextFactory(ssl.DefaultOpenSSLContextFactory):
-    def __init__(self, cert, chain):
+    """Server context shared by all device connections.
+
+    Devices reconnecting within sessionTimeout seconds resume their TLS
+    session, by session id or session ticket, and skip the full handshake
+    including client certificate verification. OpenSSL generates the ticket
+    keys per context, so the context is replaced after ticketKeyLifetime
+    seconds. Sessions of the old context are then renegotiated in full.
+    """
+
+    sessionIdContext = b'pushproxy'
+
+    def __init__(self, cert, chain, sessionCache=True, sessionTimeout=3600,
+                 ticketKeyLifetime=12 * 3600, clock=None):
         self.chain = chain
         self.cert = cert
+        self.sessionCache = sessionCache
+        self.sessionTimeout = sessionTimeout
+        self.ticketKeyLifetime = ticketKeyLifetime
+        self.clock = clock or reactor
+        self.handshakes = 0
+        self.resumedHandshakes = 0
         ssl.DefaultOpenSSLContextFactory.__init__(self, cert, cert)
 
-    def getContext(self):
-        ctx = ssl.DefaultOpenSSLContextFactory.getContext(self)
+    def cacheContext(self):
+        if self._context is not None:
+            return
+        ssl.DefaultOpenSSLContextFactory.cacheContext(self)
+        ctx = self._context
         ctx.set_verify(SSL.VERIFY_PEER | SSL.VERIFY_FAIL_IF_NO_PEER_CERT,
             self._verifyCallback)
         ctx.load_verify_locations(self.chain)
         ctx.use_certificate_chain_file(self.cert)
 
-        # Disable session cache - we don't want to configure it and
-        # performance is not important.
-        # Should fix 'session id context uninitialized' errors.
-        # Requires pyOpenSSL >= 0.14
-        ctx.set_session_cache_mode(SSL.SESS_CACHE_OFF)
+        if self.sessionCache:
+            # Required for caching sessions of verified client certificates,
+            # avoids 'session id context uninitialized' errors.
+            ctx.set_session_id(self.sessionIdContext)
+            ctx.set_session_cache_mode(SSL.SESS_CACHE_SERVER)
+            ctx.set_timeout(self.sessionTimeout)
+        else:
+            # Requires pyOpenSSL >= 0.14
+            ctx.set_session_cache_mode(SSL.SESS_CACHE_OFF)
+            ctx.set_options(SSL.OP_NO_TICKET)
+        self._contextCreated = self.clock.seconds()
 
-        return ctx
+    def getContext(self):
+        if self.sessionCache and self.ticketKeyLifetime and \
+           self.clock.seconds() - self._contextCreated >= \
+           self.ticketKeyLifetime:
+            self.rotateTicketKeys()
+        return self._context
+
+    def rotateTicketKeys(self):
+        """Replace the context, which has new session ticket keys."""
+        self._context = None
+        self.cacheContext()
+
+    def recordHandshake(self, conn):
+        self.handshakes += 1
+        if sessionReused(conn):
+            self.resumedHandshakes += 1
+
+    def resetStats(self):
+        """Return (handshakes, resumed handshakes) and reset them."""
+        stats = (self.handshakes, self.resumedHandshakes)
+        self.handshakes = self.resumedHandshakes = 0
+        return stats
 
     def _verifyCallback(self, conn, cert, errno, depth, preverifyOk):
         # The following intermediate certificate expired on Apr 16 22:54:46 2014 GMT
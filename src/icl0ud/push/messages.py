@@ -3,12 +3,14 @@ import time
 from collections import namedtuple
 from datetime import datetime, timedelta
 from pprint import pformat
-from struct import pack, unpack
+from struct import Struct, unpack
 from StringIO import StringIO
 
 import biplist
 from twisted.python import log
 
+from icl0ud.push.framing import (HEADER, HEADER_LENGTH, FIELD_HEADER,
+                                 FIELD_HEADER_LENGTH)
 from topics import topicForHash
 
 
@@ -26,24 +28,181 @@ def indentLines(string):
     return '\n'.join(map(lambda s: FIELD_INDENTATION + s, string.split('\n')))
 
 
+DATETIME32 = Struct('!I')  # seconds
+DATETIME64 = Struct('!Q')  # nanoseconds
+
+
+def encodeDatetime32(value):
+    if isinstance(value, str):
+        return value
+    return DATETIME32.pack(int(time.mktime(value.timetuple())))
+
+
+def encodeDatetime64(value):
+    if isinstance(value, str):
+        return value
+    # Computed as a float like before, which rounds to a multiple of 256ns
+    return DATETIME64.pack(int(int(time.mktime(value.timetuple())) * 1e9 +
+                               value.microsecond * 1000))
+
+
+# Field type -> function returning the marshalled content of a value, other
+# types are marshalled as they are
+FIELD_ENCODERS = {
+    'datetime32': encodeDatetime32,
+    'datetime64': encodeDatetime64,
+}
+
+
+class APSMessageType(type):
+    """Metaclass for messages, stores field values in generated __slots__.
+
+    Each message class gets a slot for every field in its fieldMapping not
+    already defined by a base class, in addition to the slots it declares
+    itself. Messages therefore don't carry a per-instance __dict__.
+
+    The class' _marshalPlan lists (field type, name, encoder) of its fields
+    in the order marshal writes them, see FIELD_ENCODERS.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        inheritedSlots = set()
+        for base in bases:
+            for cls in base.__mro__:
+                inheritedSlots.update(cls.__dict__.get('__slots__', ()))
+
+        fieldMapping = namespace.get('fieldMapping')
+        if fieldMapping is None:
+            fieldMapping = bases[0].fieldMapping
+        slots = list(namespace.get('__slots__', ()))
+        for type_, fieldInfo in sorted(fieldMapping.iteritems()):
+            if fieldInfo.name not in inheritedSlots and \
+               fieldInfo.name not in slots:
+                slots.append(fieldInfo.name)
+        namespace['__slots__'] = tuple(slots)
+        namespace['_fieldTypesByName'] = dict(
+            [(fieldInfo.name, type_)
+             for type_, fieldInfo in fieldMapping.iteritems()])
+        namespace['_marshalPlan'] = tuple(
+            [(type_, fieldInfo.name, FIELD_ENCODERS.get(fieldInfo.type))
+             for type_, fieldInfo in sorted(fieldMapping.iteritems())])
+        return super(APSMessageType, mcs).__new__(mcs, name, bases, namespace)
+
+
+class _MessageTypeAttribute(object):
+    """Message type of APSMessage instances created with a type_ argument.
+
+    Subclasses override this by setting type to their message type.
+    """
+
+    def __get__(self, message, cls):
+        if message is None:
+            return None
+        return message._type
+
+
 class APSMessage(object):
-    type = None
+    __metaclass__ = APSMessageType
+    # fields: list of (type, content) tuples, only created on access
+    # _frame: the wire data the message was parsed from, if retained
+    # _rawFields: (type, offset, length) of each field in _frame for lazily
+    #             parsed messages, see fromFrame
+    # _modified: names of the fields assigned since _frame was set, or None
+    __slots__ = ('_type', 'source', 'fields', '_frame', '_rawFields',
+                 '_modified')
+
+    type = _MessageTypeAttribute()
     knownValues = {}
     fieldMapping = {}
 
     def __init__(self, type_=None, source=None, **kwargs):
-        if type_ is None and self.type is None:
+        # Skips __setattr__, a new message has no frame to keep in sync
+        set_ = object.__setattr__
+        set_(self, '_type', type_)
+        if self.type is None:
             raise Exception("APSMessage without type created. " +
                             "Either use subclass or type_ argument.")
-        if type_ is not None:
-            self.type = type_
-        self.fields = []
-        self.source = source
-        self.rawData = None
-        for fieldType, fieldInfo in self.fieldMapping.iteritems():
-            value = kwargs.get(fieldInfo.name, None)
-            setattr(self, fieldInfo.name, value)
-            setattr(self, fieldInfo.name + '_fieldInfo', fieldInfo)
+        set_(self, 'source', source)
+        set_(self, '_frame', None)
+        set_(self, '_rawFields', None)
+        set_(self, '_modified', None)
+        # Fields not passed are None, see __getattr__
+        fieldTypesByName = self._fieldTypesByName
+        for name, value in kwargs.iteritems():
+            if name in fieldTypesByName:
+                set_(self, name, value)
+
+    @classmethod
+    def fromFrame(cls, type_, frame, rawFields):
+        """Create a message decoding its fields from frame on first access.
+
+        rawFields is a list of (field type, offset, length) tuples pointing
+        into frame. Decoded values are stored on the instance, so each field
+        is only decoded once.
+        """
+        message = cls.__new__(cls)
+        message._type = type_
+        message.source = None
+        message._frame = frame
+        message._rawFields = rawFields
+        message._modified = None
+        return message
+
+    @property
+    def rawData(self):
+        """The frame the message was parsed from, None if not retained."""
+        return self._frame
+
+    @rawData.setter
+    def rawData(self, data):
+        self._frame = data
+        self._modified = None
+
+    def __setattr__(self, name, value):
+        if name in self._fieldTypesByName:
+            if self._modified is None:
+                object.__setattr__(self, '_modified', set())
+            self._modified.add(name)
+        object.__setattr__(self, name, value)
+
+    def __getattr__(self, name):
+        # Only called for slots which are not set yet: fields of lazily
+        # parsed messages which haven't been accessed yet, fields missing
+        # from the message and the fields list.
+        if name == 'fields':
+            if self._rawFields is None:
+                value = []
+            else:
+                value = [(type_, self._frame[offset:offset + length])
+                         for type_, offset, length in self._rawFields]
+        else:
+            type_ = self._fieldTypesByName.get(name)
+            if type_ is None:
+                raise AttributeError(name)
+            if self._rawFields is None:
+                value = None
+            else:
+                value = self.decodeField(type_)
+        # Decoding doesn't modify the message
+        object.__setattr__(self, name, value)
+        return value
+
+    def rawFieldContents(self, type_):
+        return [self._frame[offset:offset + length]
+                for fieldType, offset, length in self._rawFields
+                if fieldType == type_]
+
+    def decodeField(self, type_):
+        """Decode a field of a lazily parsed message, see addField."""
+        contents = self.rawFieldContents(type_)
+        if not contents:
+            return None
+        content = contents[-1]
+        self.checkKnownValues(type_, content)
+        fieldInfo = self.fieldMapping[type_]
+        if fieldInfo.type:
+            content = self.unmarshalType(fieldInfo.type, content)
+        return content
 
     def __str__(self):
         return self.__repr__()
@@ -67,7 +226,6 @@ class APSMessage(object):
             fieldInfo = self.fieldMapping[type_]
             if fieldInfo.type:
                 content = self.unmarshalType(fieldInfo.type, content)
-                setattr(self, fieldInfo.name + '_marshalled', content)
             setattr(self, fieldInfo.name, content)
         self.checkKnownValues(type_, content)
 
@@ -117,32 +275,125 @@ class APSMessage(object):
                     value.encode('hex')))
 
     def marshal(self):
-        marshalledFields = []
+        """Return the frame of the message.
+
+        A parsed message returns the frame it was parsed from as long as
+        none of its fields are assigned, fields changed in place aren't
+        noticed. Assigned fields are patched into a copy of the frame, see
+        patchFrame. Other messages marshal the fields not set to None by
+        field type, see _marshalPlan. Lists are marshalled as one field per
+        item, like the topics of APSTopics.
+        """
+        if self._frame is not None:
+            if self._modified is None:
+                return self._frame
+            return self.patchFrame()
+        packFieldHeader = FIELD_HEADER.pack
+        parts = [None]  # the header, once the length is known
+        length = 0
+        for type_, name, encode in self._marshalPlan:
+            content = getattr(self, name)
+            if content is None:
+                continue
+            if content.__class__ is list:
+                length += self._appendRepeatedField(parts, type_, content,
+                                                    encode)
+                continue
+            if encode is not None:
+                content = encode(content)
+            parts.append(packFieldHeader(type_, len(content)))
+            parts.append(content)
+            length += FIELD_HEADER_LENGTH + len(content)
+        parts[0] = HEADER.pack(self.type, length)
+        return ''.join(parts)
+
+    def patchFrame(self):
+        """Return the frame with the assigned fields replaced.
+
+        Fields keep their order, unknown fields are kept. The fields between
+        assigned ones are copied from the frame as they are, without being
+        decoded. All fields of an assigned type are replaced by its new
+        value at the position of the first one, fields set to None are
+        removed and fields the frame didn't have are appended.
+        """
+        frame = self._frame
+        modified = self._modified
+        fieldMapping = self.fieldMapping
+        parts = [None]  # the header, once the length is known
+        length = 0
+        copyStart = HEADER_LENGTH  # start of the fields to copy unchanged
+        written = set()  # types of assigned fields already written
+        for type_, offset, fieldLength in self.frameFields():
+            fieldInfo = fieldMapping.get(type_)
+            if fieldInfo is None or fieldInfo.name not in modified:
+                continue
+            fieldStart = offset - FIELD_HEADER_LENGTH
+            if copyStart < fieldStart:
+                parts.append(frame[copyStart:fieldStart])
+                length += fieldStart - copyStart
+            copyStart = offset + fieldLength
+            if type_ not in written:
+                written.add(type_)
+                length += self._appendRepeatedField(
+                    parts, type_, [getattr(self, fieldInfo.name)],
+                    FIELD_ENCODERS.get(fieldInfo.type))
+        if copyStart < len(frame):
+            parts.append(frame[copyStart:])
+            length += len(frame) - copyStart
+        for type_, name, encode in self._marshalPlan:
+            if name in modified and type_ not in written:
+                length += self._appendRepeatedField(
+                    parts, type_, [getattr(self, name)], encode)
+        parts[0] = HEADER.pack(self.type, length)
+        return ''.join(parts)
+
+    def frameFields(self):
+        """Return (field type, offset, length) of each field in the frame."""
+        if self._rawFields is not None:
+            return self._rawFields
+        frame = self._frame
+        unpackFieldHeader = FIELD_HEADER.unpack_from
+        rawFields = []
+        offset = HEADER_LENGTH
+        while offset < len(frame):
+            fieldType, fieldLength = unpackFieldHeader(frame, offset)
+            offset += FIELD_HEADER_LENGTH
+            rawFields.append((fieldType, offset, fieldLength))
+            offset += fieldLength
+        return rawFields
+
+    def _appendRepeatedField(self, parts, type_, values, encode):
+        """Append a field for each value to parts, return their length."""
         length = 0
-        for type_, fieldInfo in self.fieldMapping.iteritems():
-            fieldValue = getattr(self, fieldInfo.name)
-            if fieldValue is None:  # ignore fields set to None
+        for content in values:
+            if content is None:
                 continue
-            if not fieldInfo.type or fieldInfo.type in ('str', 'hex'):
-                content = fieldValue
-            elif fieldInfo.type in('datetime32', 'datetime64'):
-                if type(fieldValue) == str:
-                    content = fieldValue
-                elif fieldInfo.type == 'datetime32':
-                    content = pack('!I', int(time.mktime(fieldValue.timetuple())))
-                elif fieldInfo.type == 'datetime64':
-                    content = pack('!Q', int(time.mktime(fieldValue.timetuple()))
-                                         * 1e9 + fieldValue.microsecond * 1000)
-            fieldLength = len(content)
-            marshalledFields.append(chr(type_) +
-                                    pack('!H', fieldLength) +
-                                    content)
-            length += fieldLength + 3
-
-        return chr(self.type) + pack('!I', length) + ''.join(marshalledFields)
+            if content.__class__ is list:
+                length += self._appendRepeatedField(parts, type_, content,
+                                                    encode)
+                continue
+            if encode is not None:
+                content = encode(content)
+            parts.append(FIELD_HEADER.pack(type_, len(content)))
+            parts.append(content)
+            length += FIELD_HEADER_LENGTH + len(content)
+        return length
+
+    def formatSummary(self):
+        """Describe the message without decoding its payload."""
+        summary = '%s(0x%02x)' % (self.__class__.__name__, self.type)
+        if self.rawData is not None:
+            summary += ' %d bytes' % len(self.rawData)
+        for name in ('pushToken', 'recipientPushToken'):
+            if name in self._fieldTypesByName:
+                token = getattr(self, name)
+                if token:
+                    summary += ' token: %s' % token[:4].encode('hex')
+                break
+        return summary
 
     def fieldInfo(self, name):
-        return getattr(self, name + '_fieldInfo')
+        return self.fieldMapping[self._fieldTypesByName[name]]
 
     FIELD_FORMATTERS = {
         'datetime32': lambda v: v.strftime(DATE_FORMAT),
@@ -162,8 +413,7 @@ class APSMessage(object):
 class APSConnectBase(APSMessage):
     """Base class for APSConnect and APSConnectResponse
 
-    Used by pushtoken_handler to filter messages which define push tokens
-    for a connection.
+    Both define push tokens for a connection.
     """
     pass
 
@@ -261,6 +511,11 @@ class APSTopics(APSMessage):
         else:
             super(APSTopics, self).addField(type_, content)
 
+    def decodeField(self, type_):
+        if type_ in (2, 3, 4, 5):
+            return self.rawFieldContents(type_)
+        return super(APSTopics, self).decodeField(type_)
+
     def __str__(self):
         return ('%s for token %s\n' % (self.__class__.__name__,
                                        self.formatField('pushToken')) +
@@ -284,6 +539,7 @@ class APSTopics(APSMessage):
 
 
 class APSNotification(APSMessage):
+    __slots__ = ('biplist',)
     type = 0x0a
     fieldMapping = {
         1: Field('recipientPushToken'),
@@ -304,14 +560,24 @@ class APSNotification(APSMessage):
         super(APSNotification, self).__init__(*args, **kwargs)
         self.biplist = None
 
+    def __getattr__(self, name):
+        if name == 'biplist' and self._rawFields is not None:
+            self.biplist = self.decodeBiplist()
+            return self.biplist
+        return super(APSNotification, self).__getattr__(name)
+
     def parsingFinished(self):
+        self.biplist = self.decodeBiplist()
+
+    def decodeBiplist(self):
         # decode iMessage biplist payload
         iMessageTopic = 'e4e6d952954168d0a5db02dbaf27cc35fc18d159' \
                          .decode('hex')
         if self.topic == iMessageTopic \
             or self.recipientPushToken == iMessageTopic:
 
-            self.biplist = biplist.readPlist(StringIO(self.payload))
+            return biplist.readPlist(StringIO(self.payload))
+        return None
 
     def __str__(self):
         return ('{name} {topic}\n' +
@@ -1,54 +1,242 @@
+import heapq
 import random
-from datetime import datetime, timedelta
+from datetime import datetime
 from struct import pack
 
+from twisted.internet import task
 from twisted.spread import pb
 
-from icl0ud.push.dispatch import BaseHandler
+from icl0ud.push.dispatch import BaseHandler, MessageLogEntry
+from icl0ud.push.framing import HEADER, HEADER_LENGTH
 from icl0ud.push.messages import APSNotification, APSNotificationResponse
+from icl0ud.push.parser import FIELD_HEADER, FIELD_HEADER_LENGTH
 
 # FIXME rename this module
 
+# Per notification results of sendNotifications
+STATUS_SENT = 'notification sent'
+STATUS_UNKNOWN_TOKEN = 'unknown push token'
+STATUS_INVALID = 'invalid notification'
+
+# Field types of APSNotification
+RECIPIENT_FIELD = 1
+TOPIC_FIELD = 2
+PAYLOAD_FIELD = 3
+MESSAGE_ID_FIELD = 4
+
+# Longest field content the field header can describe
+MAX_FIELD_LENGTH = 0xFFFF
+
+
+def marshalField(type_, content):
+    return FIELD_HEADER.pack(type_, len(content)) + content
+
+
+def notificationFields(pushToken, topic, payload):
+    """Marshal the fields of a notification a sender of it chooses."""
+    return (marshalField(RECIPIENT_FIELD, pushToken) +
+            marshalField(TOPIC_FIELD, topic) +
+            marshalField(PAYLOAD_FIELD, payload))
+
+
+def isValidNotification(notification):
+    """Return whether a (pushToken, topic, payload) tuple can be sent."""
+    if not isinstance(notification, (tuple, list)) or len(notification) != 3:
+        return False
+    for content in notification:
+        if not isinstance(content, str) or len(content) > MAX_FIELD_LENGTH:
+            return False
+    return bool(notification[0])
+
+
+class MessageIdTracker(object):
+    """Ids of sent notifications awaiting a response, until they expire.
+
+    Ids are kept in buckets of bucketSize seconds by expiry time, expired
+    buckets are dropped as a whole when ids are added.
+    """
+
+    def __init__(self, bucketSize=60, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.bucketSize = bucketSize
+        self.clock = clock
+        self._messageIds = {}  # message id -> bucket
+        self._buckets = {}  # bucket -> set of message ids
+        self._bucketHeap = []
+
+    def __len__(self):
+        return len(self._messageIds)
+
+    def __contains__(self, messageId):
+        return messageId in self._messageIds
+
+    def add(self, messageId, expires):
+        """Track messageId until expires, in seconds since the epoch."""
+        self.expire()
+        self.remove(messageId)
+        # The first bucket ending after expires
+        bucket = int(expires // self.bucketSize) + 1
+        messageIds = self._buckets.get(bucket)
+        if messageIds is None:
+            messageIds = self._buckets[bucket] = set()
+            heapq.heappush(self._bucketHeap, bucket)
+        messageIds.add(messageId)
+        self._messageIds[messageId] = bucket
+
+    def remove(self, messageId):
+        """Stop tracking messageId, return whether it was tracked."""
+        bucket = self._messageIds.pop(messageId, None)
+        if bucket is None:
+            return False
+        self._buckets[bucket].discard(messageId)
+        return True
+
+    def expire(self):
+        current = self.clock.seconds() // self.bucketSize
+        while self._bucketHeap and self._bucketHeap[0] <= current:
+            bucket = heapq.heappop(self._bucketHeap)
+            for messageId in self._buckets.pop(bucket):
+                del self._messageIds[messageId]
+
 
 class PushNotificationSender(BaseHandler, pb.Root):
-    def __init__(self, tokenHandler):
+    messageTypes = (APSNotificationResponse.type,)
+
+    # Seconds until injected notifications expire
+    notificationLifetime = 24 * 3600
+    # Notifications sendNotifications marshals before writing them
+    batchSize = 500
+
+    def __init__(self, tokenHandler, clock=None):
         self._tokenHandler = tokenHandler
-        self._messageIds = {}
+        self._messageIds = MessageIdTracker(clock=clock)
+        self.clock = self._messageIds.clock
+        self._cooperator = task.Cooperator(
+            scheduler=lambda f: self.clock.callLater(0, f))
+        # Start anywhere, the push server's message ids start at 0
+        self._nextMessageId = random.randint(0, 2 ** 32 - 1)
 
     def handle(self, source, message, deviceProtocol):
-        if not isinstance(message, APSNotificationResponse):
-            return True
-        if message.messageId in self._messageIds:
+        if self._messageIds.remove(message.messageId):
             deviceProtocol.log('PushNotificationSender: Found message with ' +
                                'self-issued response token: %s'
                                 % repr(message))
-            del self._messageIds[message.messageId]
             return False
         return True
 
+    def isConnected(self, pushToken):
+        """Return whether the device of pushToken is connected."""
+        return self._tokenHandler.hasToken(pushToken)
+
     def sendMessageToDevice(self, pushToken, message):
         deviceProtocol = self._tokenHandler.deviceProtocolForToken(pushToken)
         data = message.marshal()
-        deviceProtocol.log('PushNotificationSender: Sending to device: ' +
-                           str(message))
-        deviceProtocol.transport.write(data)
+        deviceProtocol.log(MessageLogEntry(
+            'PushNotificationSender: Sending to device:', message))
+        deviceProtocol.write(data)
 
     def generatemessageId(self):
-        token = None
-        while token in self._messageIds or token is None:
-            token = pack("!L", random.randint(0, 2 ** 32 - 1))
-        self._messageIds[token] = True
-        return token
+        """Return the next message id, unique until 2 ** 32 ids were sent."""
+        messageId = self._nextMessageId
+        self._nextMessageId = (messageId + 1) % 2 ** 32
+        return pack('!L', messageId)
 
-    def remote_sendNotification(self, pushToken, topic, payload):
-        notification = APSNotification(
+    def createNotification(self, pushToken, topic, payload, now):
+        return APSNotification(
             recipientPushToken=pushToken,
             topic=topic,
             payload=payload,
             messageId=self.generatemessageId(),
-            expires=datetime.now() + timedelta(days=1),
-            timestamp=datetime.now(),
+            expires=datetime.fromtimestamp(now + self.notificationLifetime),
+            timestamp=datetime.fromtimestamp(now),
             storageFlags='\x00',
         )
+
+    def remote_sendNotification(self, pushToken, topic, payload):
+        now = self.clock.seconds()
+        notification = self.createNotification(pushToken, topic, payload,
+                                                now)
         self.sendMessageToDevice(pushToken, notification)
-        return 'notification sent'
+        # Responses arrive once the device got it, or not at all
+        self._messageIds.add(notification.messageId,
+                             now + self.notificationLifetime)
+        return STATUS_SENT
+
+    def remote_sendNotifications(self, notifications):
+        """Send a list of (pushToken, topic, payload) tuples.
+
+        Notifications are marshalled batchSize at a time, the ones of a
+        batch are written to each device at once. Batches are sent in turns
+        with other work of the reactor. Fires with a list of STATUS_SENT,
+        STATUS_UNKNOWN_TOKEN or STATUS_INVALID, one per notification.
+        Invalid notifications, see isValidNotification, are skipped.
+        """
+        statuses = []
+
+        def sendBatches():
+            for start in xrange(0, len(notifications), self.batchSize):
+                statuses.extend(self._sendBatch(
+                    notifications[start:start + self.batchSize]))
+                yield None
+        d = self._cooperator.coiterate(sendBatches())
+        d.addCallback(lambda ignored: statuses)
+        return d
+
+    def _sendBatch(self, notifications):
+        valid = map(isValidNotification, notifications)
+        sent = iter(self.sendFrames([
+            (notification[0], notificationFields(*notification))
+            for notification, isValid in zip(notifications, valid)
+            if isValid]))
+        return [next(sent) if isValid else STATUS_INVALID
+                for isValid in valid]
+
+    def sendFrames(self, frames):
+        """Send notifications of which only some fields are marshalled.
+
+        frames is a list of (pushToken, fields) tuples, fields being the
+        marshalled fields returned by notificationFields. The message id,
+        expiry, timestamp and storage flags are appended to them. The
+        frames for a device are written at once. Returns a list of
+        STATUS_SENT or STATUS_UNKNOWN_TOKEN, one per frame.
+        """
+        now = self.clock.seconds()
+        expires = now + self.notificationLifetime
+        # The fields following the message id are the same for all frames
+        trailer = APSNotification(
+            expires=datetime.fromtimestamp(expires),
+            timestamp=datetime.fromtimestamp(now),
+            storageFlags='\x00',
+        ).marshal()[HEADER_LENGTH:]
+        # Length of the message id field and the trailer
+        trailerLength = FIELD_HEADER_LENGTH + 4 + len(trailer)
+        statuses = []
+        messageIds = []
+        writes = {}  # device protocol -> marshalled notifications
+        for pushToken, fields in frames:
+            if not self._tokenHandler.hasToken(pushToken):
+                statuses.append(STATUS_UNKNOWN_TOKEN)
+                continue
+            deviceProtocol = self._tokenHandler.deviceProtocolForToken(
+                pushToken)
+            messageId = self.generatemessageId()
+            writes.setdefault(deviceProtocol, []).extend((
+                HEADER.pack(APSNotification.type,
+                            len(fields) + trailerLength),
+                fields,
+                marshalField(MESSAGE_ID_FIELD, messageId),
+                trailer))
+            messageIds.append(messageId)
+            statuses.append(STATUS_SENT)
+        for deviceProtocol, data in writes.iteritems():
+            deviceProtocol.log('PushNotificationSender: Sending %d '
+                               'notifications to device' % (len(data) / 4))
+            deviceProtocol.write(''.join(data))
+        for messageId in messageIds:
+            self._messageIds.add(messageId, expires)
+        return statuses
+
+    def describe(self):
+        return ['%d sent notifications awaiting a response' %
+                len(self._messageIds)]
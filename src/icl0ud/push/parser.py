@@ -1,31 +1,28 @@
 import inspect
-from struct import unpack
-from StringIO import StringIO
 
 
 from icl0ud.push import messages
+from icl0ud.push.framing import (HEADER, HEADER_LENGTH, FIELD_HEADER,
+                                 FIELD_HEADER_LENGTH)
 
 
 # TODO rename parser to a more appropriate description
 # TODO merge this with messages? - should be implemented analogue to marshalling
 class APSParser(object):
-    def __init__(self):
+    def __init__(self, lazy=False):
+        # lazy: only record field offsets, fields are decoded on first
+        # access, see APSMessage.fromFrame
+        self.lazy = lazy
         self._typeCache = None
 
     def isMessageComplete(self, data):
         # print 'isMessageComplete: data: %s' % data.encode('hex')
-        if len(data) < 5:
+        if len(data) < HEADER_LENGTH:
             return False
-
-        messageLength = self.messageLength(data)
-        dataLength = len(data)
-
-        if dataLength >= messageLength:
-            return True
-        return False
+        return len(data) >= self.messageLength(data)
 
     def messageLength(self, data):
-        return unpack('!L', data[1:5])[0] + 5
+        return HEADER.unpack_from(data)[1] + HEADER_LENGTH
 
     def messageClassForType(self, type_):
         if not self._typeCache:
@@ -39,20 +36,51 @@ class APSParser(object):
     # TODO decide whether to move this to APSMessage
     # - messages also must be marshalled
     def parseMessage(self, data):
-        length = self.messageLength(data)
-        stream = StringIO(data[0:length])
-        messageType = ord(stream.read(1))
-        stream.read(4)  # skip length
-
-        message = self.messageClassForType(messageType)(messageType)
-        while stream.tell() < length:
-            message.addField(*self.parseField(stream))
+        """Parse the frame at the start of data.
+
+        data may be a string or a memoryview, e.g. from APSFrameBuffer.
+        Returns the message and the length of the frame.
+        """
+        messageType, length = HEADER.unpack_from(data)
+        length += HEADER_LENGTH
+        frame = data[0:length]
+        if isinstance(frame, memoryview):
+            frame = frame.tobytes()
+
+        messageClass = self.messageClassForType(messageType)
+        unpackFieldHeader = FIELD_HEADER.unpack_from
+        offset = HEADER_LENGTH
+
+        if self.lazy:
+            fieldMapping = messageClass.fieldMapping
+            rawFields = []
+            unmapped = False
+            while offset < length:
+                fieldType, fieldLength = unpackFieldHeader(frame, offset)
+                offset += FIELD_HEADER_LENGTH
+                rawFields.append((fieldType, offset, fieldLength))
+                offset += fieldLength
+                if fieldType not in fieldMapping:
+                    unmapped = True
+            message = messageClass.fromFrame(messageType, frame, rawFields)
+            if unmapped:
+                # These are never decoded, report them now. Values of mapped
+                # fields are checked once the field is decoded.
+                for fieldType, fieldOffset, fieldLength in rawFields:
+                    if fieldType not in fieldMapping:
+                        message.checkKnownValues(
+                            fieldType,
+                            frame[fieldOffset:fieldOffset + fieldLength])
+            return (message, length)
+
+        message = messageClass(messageType)
+        addField = message.addField
+        while offset < length:
+            fieldType, fieldLength = unpackFieldHeader(frame, offset)
+            offset += FIELD_HEADER_LENGTH
+            addField(fieldType, frame[offset:offset + fieldLength])
+            offset += fieldLength
         message.parsingFinished()
-        message.rawData = data
+        message.rawData = frame
 
         return (message, length)
-
-    def parseField(self, stream):
-        type_ = ord(stream.read(1))
-        length = unpack('!H', stream.read(2))[0]
-        return (type_, stream.read(length))
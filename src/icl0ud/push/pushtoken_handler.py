@@ -1,35 +1,82 @@
+from collections import OrderedDict
+
 from icl0ud.push.dispatch import BaseHandler
-from icl0ud.push.messages import APSConnectBase
+from icl0ud.push.messages import APSConnect, APSConnectResponse
 
 
 class PushTokenHandler(BaseHandler):
+    """Maps push tokens to the protocol of the connected device.
+
+    Tokens are removed when their device disconnects. A device keeps at most
+    maxTokensPerDevice tokens, the ones it used least recently are removed
+    first.
+    """
+
     _debug = False
+    messageTypes = (APSConnect.type, APSConnectResponse.type)
 
-    def __init__(self):
+    def __init__(self, maxTokensPerDevice=32):
         self.tokenProtocolMap = {}
+        # device protocol -> its tokens, least recently used first
+        self._deviceTokens = {}
+        self.maxTokensPerDevice = maxTokensPerDevice
+        self.evictedTokens = 0
+        # Objects with tokenAdded(pushToken) and tokenRemoved(pushToken)
+        # methods, called when a token is added to or removed from the map
+        self.listeners = []
+
+    def __len__(self):
+        return len(self.tokenProtocolMap)
 
     def handle(self, source, message, deviceProtocol):
-        if not isinstance(message, APSConnectBase):
-            return
         self.updatePushToken(deviceProtocol, message.pushToken)
 
     def updatePushToken(self, deviceProtocol, pushToken):
         # FIXME check whether all of this works for multiple users on one Mac
-        # see applepushserviced log, e.g. sending filter message ...
-        # with token ... for user ...
         # - there is one device/root token and another for each user
         # - multiple APSConnect/-Response messages, one for each token
         # - multiple APSTopics messages, one for each token
-        # We need to remove old tokens at some point.
-        # TODO limit tokens per device?
         if pushToken is None:
             return
 
-        if self._debug and not pushToken in self.tokenProtocolMap:
+        previous = self.tokenProtocolMap.get(pushToken)
+        if self._debug and previous is None:
             msg = 'New push token: %s' % pushToken.encode('hex')
             deviceProtocol.log(self.__class__.__name__ + ': ' + msg)
+        if previous is not None and previous is not deviceProtocol:
+            # The device reconnected before its old connection was closed
+            self._deviceTokens[previous].pop(pushToken, None)
 
         self.tokenProtocolMap[pushToken] = deviceProtocol
+        tokens = self._deviceTokens.setdefault(deviceProtocol, OrderedDict())
+        tokens.pop(pushToken, None)
+        tokens[pushToken] = True
+        if previous is None:
+            for listener in self.listeners:
+                listener.tokenAdded(pushToken)
+        while len(tokens) > self.maxTokensPerDevice:
+            evicted, _ = tokens.popitem(last=False)
+            self.evictedTokens += 1
+            self._removeToken(evicted)
+
+    def connectionLost(self, source, deviceProtocol, reason):
+        if source != 'device':
+            return
+        for pushToken in self._deviceTokens.pop(deviceProtocol, ()):
+            self._removeToken(pushToken)
+
+    def _removeToken(self, pushToken):
+        del self.tokenProtocolMap[pushToken]
+        for listener in self.listeners:
+            listener.tokenRemoved(pushToken)
+
+    def hasToken(self, pushToken):
+        return pushToken in self.tokenProtocolMap
 
     def deviceProtocolForToken(self, pushToken):
         return self.tokenProtocolMap[pushToken]
+
+    def describe(self):
+        return ['%d push tokens of %d devices, %d evicted' %
+                (len(self.tokenProtocolMap), len(self._deviceTokens),
+                 self.evictedTokens)]
@@ -0,0 +1,105 @@
+import random
+
+
+class UpstreamHost(object):
+    """Connect statistics of a courier host.
+
+    latency and errorRate are exponentially weighted moving averages of the
+    connect latency in seconds and of failed (1) and successful (0)
+    connects.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.latency = None
+        self.errorRate = 0.0
+        self.consecutiveFailures = 0
+        self.quarantinedUntil = 0
+
+    def __repr__(self):
+        return '<UpstreamHost %s latency=%s errorRate=%.2f>' % (
+            self.host, self.latency, self.errorRate)
+
+
+class UpstreamSelector(object):
+    """Choose courier hosts by connect latency and failures.
+
+    choose() picks two random healthy hosts and returns the one with the
+    lower expected connect time, its latency plus its error rate times
+    failurePenalty. Hosts without measurements count as fast, so they get
+    tried. After quarantineAfter consecutive failures a host is skipped for
+    quarantineTime seconds, doubled for every further failure up to
+    maxQuarantineTime.
+    """
+
+    def __init__(self, hosts, alpha=0.3, failurePenalty=5.0,
+                 quarantineAfter=3, quarantineTime=30,
+                 maxQuarantineTime=600, clock=None, random=random):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.hosts = [UpstreamHost(host) for host in hosts]
+        self._hostsByName = dict([(h.host, h) for h in self.hosts])
+        self.alpha = alpha
+        self.failurePenalty = failurePenalty
+        self.quarantineAfter = quarantineAfter
+        self.quarantineTime = quarantineTime
+        self.maxQuarantineTime = maxQuarantineTime
+        self.clock = clock
+        self.random = random
+
+    def score(self, host):
+        return (host.latency or 0.0) + host.errorRate * self.failurePenalty
+
+    def isQuarantined(self, host):
+        return host.quarantinedUntil > self.clock.seconds()
+
+    def choose(self, exclude=()):
+        """Return a host name, or None if all hosts are excluded."""
+        candidates = [h for h in self.hosts if h.host not in exclude]
+        if not candidates:
+            return None
+        healthy = [h for h in candidates if not self.isQuarantined(h)]
+        if not healthy:
+            # Try the host that is released first rather than none
+            return min(candidates, key=lambda h: h.quarantinedUntil).host
+        if len(healthy) == 1:
+            return healthy[0].host
+        return min(self.random.sample(healthy, 2), key=self.score).host
+
+    def _average(self, average, value):
+        if average is None:
+            return value
+        return average + self.alpha * (value - average)
+
+    def connectSucceeded(self, host, latency):
+        host = self._hostsByName[host]
+        host.latency = self._average(host.latency, latency)
+        host.errorRate = self._average(host.errorRate, 0.0)
+        host.consecutiveFailures = 0
+        host.quarantinedUntil = 0
+
+    def connectFailed(self, host):
+        """Record a failed connect or TLS handshake."""
+        host = self._hostsByName[host]
+        host.errorRate = self._average(host.errorRate, 1.0)
+        host.consecutiveFailures += 1
+        excess = host.consecutiveFailures - self.quarantineAfter
+        if excess >= 0:
+            duration = min(self.quarantineTime * 2 ** excess,
+                           self.maxQuarantineTime)
+            host.quarantinedUntil = self.clock.seconds() + duration
+
+    def describe(self):
+        """Return a line of statistics per host."""
+        lines = []
+        for host in self.hosts:
+            line = '%s: latency %s, error rate %.0f%%' % (
+                host.host,
+                '%.0fms' % (host.latency * 1000)
+                if host.latency is not None else '-',
+                host.errorRate * 100)
+            if self.isQuarantined(host):
+                line += ', quarantined for %ds' % (
+                    host.quarantinedUntil - self.clock.seconds())
+            lines.append(line)
+        return lines
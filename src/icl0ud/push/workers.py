@@ -0,0 +1,435 @@
+"""Accept device connections in several worker processes.
+
+The supervisor opens the device port and starts worker processes, which
+inherit the listening socket and accept device connections from it, so the
+TLS work is spread over several cores. Each worker runs the same
+configuration file and is connected to the supervisor by a Unix socket pair
+speaking Perspective Broker. Workers report the push tokens of their
+devices to the supervisor, which sends injected notifications to the worker
+the device is connected to.
+
+TLS sessions aren't shared between workers: pyOpenSSL can't set session
+ticket keys, so each worker's context has its own, as well as its own
+session cache. Devices resume their session only when they reconnect to the
+same worker.
+
+See src/pushserver.py. Workers are started as
+
+    python -m icl0ud.push.workers <configuration file>
+"""
+import os
+import socket
+import sys
+
+from twisted.application import app, service
+from twisted.internet import defer, error, protocol, reactor
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from twisted.python import log
+from twisted.spread import pb
+
+from icl0ud.push.notification_sender import (STATUS_INVALID, STATUS_SENT,
+                                             STATUS_UNKNOWN_TOKEN,
+                                             isValidNotification)
+
+
+# File descriptors of the listening socket and the supervisor connection in
+# worker processes
+LISTEN_FD = 3
+CONTROL_FD = 4
+WORKER_ENV = 'PUSHPROXY_WORKER'
+
+
+def workerIndex():
+    """Return the index of this worker process, None in other processes."""
+    index = os.environ.get(WORKER_ENV)
+    if index is None:
+        return None
+    return int(index)
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """A worker process, logs its output line by line.
+
+    root is the worker's WorkerRoot once it is connected.
+    """
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.root = None
+        self._partialLines = {}
+
+    def childDataReceived(self, childFD, data):
+        lines = (self._partialLines.get(childFD, '') + data).split('\n')
+        self._partialLines[childFD] = lines.pop()
+        for line in lines:
+            log.msg('[worker %d] %s' % (self.index, line))
+
+    def processEnded(self, reason):
+        self.root = None
+        self.supervisor.workerEnded(self, reason)
+
+
+class TokenRegistry(object):
+    """The worker each push token's device is connected to."""
+
+    def __init__(self):
+        self._workers = {}  # push token -> worker index
+        self._tokens = {}  # worker index -> set of push tokens
+
+    def __len__(self):
+        return len(self._workers)
+
+    def get(self, pushToken):
+        """Return the index of the worker with pushToken or None."""
+        return self._workers.get(pushToken)
+
+    def update(self, index, added, removed):
+        tokens = self._tokens.setdefault(index, set())
+        for pushToken in removed:
+            tokens.discard(pushToken)
+            # The device may have reconnected to another worker
+            if self._workers.get(pushToken) == index:
+                del self._workers[pushToken]
+        for pushToken in added:
+            previous = self._workers.get(pushToken)
+            if previous is not None and previous != index:
+                self._tokens[previous].discard(pushToken)
+            self._workers[pushToken] = index
+            tokens.add(pushToken)
+
+    def removeWorker(self, index):
+        for pushToken in self._tokens.pop(index, ()):
+            if self._workers.get(pushToken) == index:
+                del self._workers[pushToken]
+
+
+class WorkerRegistration(pb.Referenceable):
+    """Lets a worker update the TokenRegistry of its supervisor."""
+
+    def __init__(self, registry, index):
+        self.registry = registry
+        self.index = index
+
+    def remote_updateTokens(self, added, removed):
+        self.registry.update(self.index, added, removed)
+
+
+class WorkerSupervisor(service.Service):
+    """Runs workerCount workers accepting device connections on port.
+
+    Workers run the configuration file configPath, in which workerIndex()
+    returns their index, and are restarted if they exit. router sends
+    notifications to the workers, serve it instead of the
+    PushNotificationSender on the injection port.
+    """
+
+    restartDelay = 1
+
+    def __init__(self, port, workerCount, configPath, interface='',
+                 backlog=50):
+        self.port = port
+        self.workerCount = workerCount
+        self.configPath = os.path.abspath(configPath)
+        self.interface = interface
+        self.backlog = backlog
+        self.workers = {}
+        self.tokens = TokenRegistry()
+        self.router = NotificationRouter(self)
+        self._socket = None
+        self._ended = {}  # index -> Deferred fired once the worker exited
+
+    def startService(self):
+        service.Service.startService(self)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.interface, self.port))
+        self._socket.listen(self.backlog)
+        # Twisted expects adopted sockets to be non-blocking, which is a
+        # property shared with the workers' copies.
+        self._socket.setblocking(False)
+        for index in xrange(self.workerCount):
+            self.startWorker(index)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for worker in self.workers.itervalues():
+            self._ended[worker.index] = defer.Deferred()
+            try:
+                worker.transport.signalProcess('TERM')
+            except error.ProcessExitedAlready:
+                pass
+        self._socket.close()
+        return defer.DeferredList(self._ended.values())
+
+    def startWorker(self, index):
+        control, workerControl = socket.socketpair()
+        control.setblocking(False)
+        workerControl.setblocking(False)
+        worker = WorkerProcess(self, index)
+        env = dict(os.environ)
+        env[WORKER_ENV] = str(index)
+        reactor.spawnProcess(
+            worker,
+            sys.executable,
+            [sys.executable, '-m', 'icl0ud.push.workers', self.configPath],
+            env=env,
+            childFDs={0: 'w', 1: 'r', 2: 'r',
+                      LISTEN_FD: self._socket.fileno(),
+                      CONTROL_FD: workerControl.fileno()})
+        workerControl.close()
+        self.workers[index] = worker
+
+        factory = pb.PBClientFactory()
+        reactor.adoptStreamConnection(control.fileno(), socket.AF_UNIX,
+                                      factory)
+        control.close()
+        d = factory.getRootObject()
+
+        def connected(root):
+            worker.root = root
+            return root.callRemote('setRegistration',
+                                   WorkerRegistration(self.tokens, index))
+        d.addCallback(connected)
+        d.addErrback(log.err, 'Connecting to worker %d failed' % index)
+
+    def workerEnded(self, worker, reason):
+        del self.workers[worker.index]
+        self.tokens.removeWorker(worker.index)
+        ended = self._ended.pop(worker.index, None)
+        if ended is not None:
+            ended.callback(None)
+            return
+        log.msg('Worker %d exited: %s, restarting' %
+                (worker.index, reason.getErrorMessage()))
+        reactor.callLater(self.restartDelay, self._restartWorker,
+                          worker.index)
+
+    def _restartWorker(self, index):
+        if self.running:
+            self.startWorker(index)
+
+
+class NotificationRouter(pb.Root):
+    """Sends injected notifications to the worker with the device.
+
+    Notifications for tokens the workers haven't reported (yet) are sent to
+    all workers, only the one the device is connected to delivers them.
+    """
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+
+    def remote_sendNotification(self, pushToken, topic, payload):
+        index = self.supervisor.tokens.get(pushToken)
+        worker = self.supervisor.workers.get(index)
+        if worker is not None and worker.root is not None:
+            candidates = [worker]
+        else:
+            candidates = [w for w in self.supervisor.workers.itervalues()
+                          if w.root is not None]
+        calls = [worker.root.callRemote('sendNotification',
+                                        pushToken, topic, payload)
+                 for worker in candidates]
+        d = defer.DeferredList(calls, consumeErrors=True)
+        d.addCallback(self._delivered, pushToken)
+        return d
+
+    def remote_sendNotifications(self, notifications):
+        """Like PushNotificationSender.remote_sendNotifications."""
+        # Checked here, invalid ones would count as unknown tokens otherwise
+        valid = [i for i, notification in enumerate(notifications)
+                 if isValidNotification(notification)]
+        d = self._sendToWorkers('sendNotifications',
+                                [notifications[i] for i in valid])
+        d.addCallback(self._withInvalid, valid, len(notifications))
+        return d
+
+    def sendFrames(self, frames):
+        """Like PushNotificationSender.sendFrames, returns a Deferred."""
+        return self._sendToWorkers('sendFrames', frames)
+
+    def _sendToWorkers(self, method, notifications):
+        # Each worker gets one list with the notifications it may deliver,
+        # the push token is the first item of each notification.
+        workers = self.supervisor.workers
+        connected = [w for w in workers.itervalues() if w.root is not None]
+        batches = {}  # worker -> indexes of its notifications
+        for i, notification in enumerate(notifications):
+            pushToken = notification[0]
+            worker = workers.get(self.supervisor.tokens.get(pushToken))
+            if worker is not None and worker.root is not None:
+                candidates = [worker]
+            else:
+                candidates = connected
+            for worker in candidates:
+                batches.setdefault(worker, []).append(i)
+
+        statuses = [STATUS_UNKNOWN_TOKEN] * len(notifications)
+        calls = []
+        for worker, indexes in batches.iteritems():
+            d = worker.root.callRemote(method,
+                                       [notifications[i] for i in indexes])
+            d.addCallback(self._merge, indexes, statuses)
+            d.addErrback(log.err, 'Sending notifications to worker %d failed'
+                         % worker.index)
+            calls.append(d)
+        d = defer.gatherResults(calls)
+        d.addCallback(lambda ignored: statuses)
+        return d
+
+    def _merge(self, workerStatuses, indexes, statuses):
+        for i, status in zip(indexes, workerStatuses):
+            if status == STATUS_SENT:
+                statuses[i] = status
+
+    def _withInvalid(self, validStatuses, valid, count):
+        statuses = [STATUS_INVALID] * count
+        for i, status in zip(valid, validStatuses):
+            statuses[i] = status
+        return statuses
+
+    def _delivered(self, results, pushToken):
+        for success, result in results:
+            if not success:
+                log.err(result, 'Sending notification to worker failed')
+            elif result is not None:
+                return result
+        # Like PushNotificationSender does for unknown tokens
+        raise KeyError(pushToken)
+
+
+class TokenPublisher(object):
+    """Reports push tokens of a worker to the supervisor's TokenRegistry.
+
+    Listens to a PushTokenHandler, changes are sent once per reactor
+    iteration, in batches of at most batchSize tokens.
+    """
+
+    batchSize = 1000
+
+    def __init__(self):
+        self.registration = None
+        self._added = set()
+        self._removed = set()
+        self._delayedFlush = None
+
+    def setRegistration(self, registration):
+        self.registration = registration
+        self._scheduleFlush()
+
+    def tokenAdded(self, pushToken):
+        self._removed.discard(pushToken)
+        self._added.add(pushToken)
+        self._scheduleFlush()
+
+    def tokenRemoved(self, pushToken):
+        self._added.discard(pushToken)
+        self._removed.add(pushToken)
+        self._scheduleFlush()
+
+    def _scheduleFlush(self):
+        if self.registration is not None and self._delayedFlush is None and \
+           (self._added or self._removed):
+            self._delayedFlush = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        self._delayedFlush = None
+        added, removed = list(self._added), list(self._removed)
+        self._added.clear()
+        self._removed.clear()
+        while added or removed:
+            d = self.registration.callRemote('updateTokens',
+                                             added[:self.batchSize],
+                                             removed[:self.batchSize])
+            d.addErrback(log.err, 'Reporting push tokens failed')
+            added = added[self.batchSize:]
+            removed = removed[self.batchSize:]
+
+
+class WorkerRoot(pb.Root):
+    """Root object a worker serves to the supervisor."""
+
+    def __init__(self, notificationSender, tokenPublisher):
+        self.notificationSender = notificationSender
+        self.tokenPublisher = tokenPublisher
+
+    def remote_setRegistration(self, registration):
+        self.tokenPublisher.setRegistration(registration)
+
+    def remote_sendNotification(self, pushToken, topic, payload):
+        """Send a notification if the device is connected to this worker.
+
+        Returns None if it isn't.
+        """
+        if not self.notificationSender.isConnected(pushToken):
+            return None
+        return self.notificationSender.remote_sendNotification(
+            pushToken, topic, payload)
+
+    def remote_sendNotifications(self, notifications):
+        return self.notificationSender.remote_sendNotifications(notifications)
+
+    def remote_sendFrames(self, frames):
+        return self.notificationSender.sendFrames(frames)
+
+
+class WorkerControlFactory(pb.PBServerFactory):
+    """Serves a WorkerRoot, stops the worker if the supervisor is gone."""
+
+    def buildProtocol(self, addr):
+        broker = pb.PBServerFactory.buildProtocol(self, addr)
+        broker.notifyOnDisconnect(self.supervisorLost)
+        return broker
+
+    def supervisorLost(self):
+        log.msg('Lost connection to supervisor, stopping')
+        try:
+            reactor.stop()
+        except error.ReactorNotRunning:
+            pass
+
+
+class WorkerService(service.Service):
+    """Accepts device connections on the socket inherited from the
+    supervisor, serves notificationSender to it and reports the push tokens
+    of tokenHandler.
+    """
+
+    def __init__(self, factory, contextFactory, notificationSender,
+                 tokenHandler):
+        self.factory = factory
+        self.contextFactory = contextFactory
+        self.notificationSender = notificationSender
+        self.tokenPublisher = TokenPublisher()
+        tokenHandler.listeners.append(self.tokenPublisher)
+        self._port = None
+
+    def startService(self):
+        service.Service.startService(self)
+        # Both descriptors are duplicated by the reactor
+        self._port = reactor.adoptStreamPort(
+            LISTEN_FD, socket.AF_INET,
+            TLSMemoryBIOFactory(self.contextFactory, False, self.factory))
+        os.close(LISTEN_FD)
+        reactor.adoptStreamConnection(
+            CONTROL_FD, socket.AF_UNIX,
+            WorkerControlFactory(WorkerRoot(self.notificationSender,
+                                            self.tokenPublisher)))
+        os.close(CONTROL_FD)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        return self._port.stopListening()
+
+
+def main(configPath):
+    from icl0ud.logger import workerLogger
+    log.startLoggingWithObserver(workerLogger(), setStdout=False)
+    application = service.loadApplication(configPath, 'python')
+    app.startApplication(application, False)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
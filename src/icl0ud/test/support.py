@@ -0,0 +1,58 @@
+"""Fakes and certificate helpers shared by the tests."""
+from OpenSSL import crypto
+from twisted.test.proto_helpers import StringTransport
+
+
+KEY_BITS = 2048
+
+
+class CountingTransport(StringTransport):
+    writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        StringTransport.write(self, data)
+
+
+class FakeDeviceProtocol(object):
+    """Stands in for the InterceptServer of a device."""
+
+    def __init__(self):
+        self.transport = CountingTransport()
+        self.logged = []
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def log(self, msg):
+        self.logged.append(msg)
+
+
+def createCertificate(commonName, issuer=None, serial=1):
+    """Create a key and a certificate signed by issuer, a (cert, key) tuple.
+
+    The certificate is self-signed if issuer is None.
+    """
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, KEY_BITS)
+    cert = crypto.X509()
+    cert.set_version(2)
+    cert.set_serial_number(serial)
+    cert.get_subject().CN = commonName
+    cert.gmtime_adj_notBefore(-3600)
+    cert.gmtime_adj_notAfter(24 * 3600)
+    cert.set_pubkey(key)
+    if issuer is None:
+        cert.add_extensions([crypto.X509Extension('basicConstraints', True,
+                                                  'CA:TRUE')])
+        issuer = (cert, key)
+    cert.set_issuer(issuer[0].get_subject())
+    cert.sign(issuer[1], 'sha256')
+    return cert, key
+
+
+def writePem(path, cert, key=None):
+    with open(path, 'w') as f:
+        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+        if key is not None:
+            f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
@@ -0,0 +1,101 @@
+from StringIO import StringIO
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from icl0ud.push import capture
+from icl0ud.push.capture import (CaptureFormatError, CaptureHandler,
+                                 CaptureReader, CaptureWriter)
+from icl0ud.push.parser import APSParser
+from icl0ud.test.sample_messages import NOTIFICATION_MARSHALLED
+
+
+KEEPALIVE_RESPONSE = '\x0d\x00\x00\x00\x00'
+
+
+class FakeReactor(task.Clock):
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.triggers = []
+
+    def addSystemEventTrigger(self, phase, eventType, f):
+        self.triggers.append((phase, eventType, f))
+
+
+class UnclosableStringIO(StringIO):
+    def close(self):
+        pass
+
+
+class TestCapture(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.fd = UnclosableStringIO()
+
+    def read(self):
+        return list(CaptureReader(StringIO(self.fd.getvalue())))
+
+    def writeRecords(self, writer):
+        writer.write(1, capture.DIRECTION_DEVICE, NOTIFICATION_MARSHALLED,
+                     timestamp=1.5)
+        writer.write(2, capture.DIRECTION_SERVER, KEEPALIVE_RESPONSE,
+                     timestamp=2.5)
+
+    def test_round_trip(self):
+        writer = CaptureWriter(self.fd, clock=self.clock)
+        self.writeRecords(writer)
+        writer.close()
+
+        self.assertEquals(self.read(), [
+            (1.5, 1, capture.DIRECTION_DEVICE, NOTIFICATION_MARSHALLED),
+            (2.5, 2, capture.DIRECTION_SERVER, KEEPALIVE_RESPONSE)])
+
+    def test_compressed_round_trip(self):
+        writer = CaptureWriter(self.fd, compress=True, clock=self.clock)
+        self.writeRecords(writer)
+        writer.close()
+
+        self.assertEquals([record.frame for record in self.read()],
+                          [NOTIFICATION_MARSHALLED, KEEPALIVE_RESPONSE])
+
+    def test_block_written_after_interval(self):
+        writer = CaptureWriter(self.fd, flushInterval=1.0, clock=self.clock)
+        self.writeRecords(writer)
+        self.assertEquals(self.read(), [])
+
+        self.clock.advance(1)
+        self.assertEquals(len(self.read()), 2)
+
+    def test_block_written_when_full(self):
+        writer = CaptureWriter(self.fd, blockSize=50, clock=self.clock)
+        self.writeRecords(writer)
+        self.assertEquals(len(self.read()), 1)
+
+    def test_appended_capture(self):
+        for i in range(2):
+            writer = CaptureWriter(self.fd, clock=self.clock)
+            self.writeRecords(writer)
+            writer.close()
+        self.assertEquals(len(self.read()), 4)
+
+    def test_unknown_format(self):
+        self.assertRaises(CaptureFormatError, list,
+                          CaptureReader(StringIO('not a capture')))
+
+    def test_handler(self):
+        reactor = FakeReactor()
+        reactor.advance(10)
+        handler = CaptureHandler(self.fd, reactor=reactor)
+        message, _ = APSParser(lazy=True).parseMessage(
+            NOTIFICATION_MARSHALLED)
+
+        class FakeDeviceProtocol(object):
+            class transport(object):
+                sessionno = 3
+        handler.handle('server', message, FakeDeviceProtocol())
+        self.assertEquals(reactor.triggers,
+                          [('before', 'shutdown', handler.close)])
+        handler.close()
+
+        self.assertEquals(self.read(), [
+            (10, 3, capture.DIRECTION_SERVER, NOTIFICATION_MARSHALLED)])
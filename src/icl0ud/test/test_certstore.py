@@ -0,0 +1,99 @@
+import os
+
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial import unittest
+
+from icl0ud.push.certstore import DeviceCertificateStore
+from icl0ud.test.support import createCertificate, writePem
+
+
+class FakeNotifier(object):
+    def loseConnection(self):
+        pass
+
+
+class TestDeviceCertificateStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = self.mktemp()
+        os.mkdir(self.directory)
+        self.ca = createCertificate('CA')
+        self.addDevice('device1')
+        self.clock = Clock()
+        self.store = DeviceCertificateStore(self.directory,
+                                            rescanInterval=60,
+                                            reactor=self.clock)
+        # The clock can't watch files, use rescans only
+        self.store._watch = lambda: None
+        self.store.start()
+        self.addCleanup(self.store.stop)
+
+    def addDevice(self, commonName):
+        path = os.path.join(self.directory, commonName + '.pem')
+        writePem(path, *createCertificate(commonName, self.ca, serial=2))
+        return path
+
+    def test_indexed_on_start(self):
+        certificate = self.store.get('device1')
+        self.assertEquals(certificate.certificate.get_subject().CN,
+                          'device1')
+        self.assertEquals(certificate.privateKey.bits(), 2048)
+        self.assertIdentical(self.store.get('device2'), None)
+        self.assertEquals(len(self.store), 1)
+
+    def test_lookup_without_disk_access(self):
+        os.remove(os.path.join(self.directory, 'device1.pem'))
+        self.assertNotIdentical(self.store.get('device1'), None)
+
+    def test_lookup_miss_without_disk_access(self):
+        self.addDevice('device2')
+        self.assertIdentical(self.store.get('device2'), None)
+
+    def test_rescan(self):
+        certificate = self.store.get('device1')
+        os.remove(os.path.join(self.directory, 'device1.pem'))
+        self.addDevice('device2')
+        self.clock.advance(60)
+
+        self.assertIdentical(self.store.get('device1'), None)
+        self.assertNotIdentical(self.store.get('device2'), None)
+        self.assertNotIdentical(certificate, self.store.get('device2'))
+
+    def test_modified_file_reloaded(self):
+        certificate = self.store.get('device1')
+        self.store.scan()
+        self.assertIdentical(self.store.get('device1'), certificate)
+
+        path = self.addDevice('device1')
+        os.utime(path, (certificate.mtime + 10, certificate.mtime + 10))
+        self.store.scan()
+        self.assertNotIdentical(self.store.get('device1'), certificate)
+
+    def test_other_files_ignored(self):
+        FilePath(self.directory).child('.keep').touch()
+        self.store.scan()
+        self.assertEquals(len(self.store), 1)
+
+    def test_invalid_file(self):
+        FilePath(self.directory).child('device2.pem').setContent('invalid')
+        self.store.scan()
+        self.assertIdentical(self.store.get('device2'), None)
+        # Not loaded again until it changes
+        self.store.scan()
+        self.assertEquals(len(self.flushLoggedErrors()), 1)
+
+    def test_no_rescans_while_watching(self):
+        clock = Clock()
+        store = DeviceCertificateStore(self.directory, rescanInterval=60,
+                                       reactor=clock)
+        store._watch = lambda: setattr(store, '_notifier', FakeNotifier())
+        store.start()
+        self.addCleanup(store.stop)
+        self.assertEquals(len(store), 1)
+        self.assertEquals(clock.getDelayedCalls(), [])
+
+    def test_changed_file(self):
+        self.addDevice('device2')
+        self.store._changed(None, FilePath(self.directory).child(
+            'device2.pem'), 0)
+        self.assertNotIdentical(self.store.get('device2'), None)
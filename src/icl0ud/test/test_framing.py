@@ -0,0 +1,66 @@
+from twisted.trial import unittest
+
+from icl0ud.push.framing import APSFrameBuffer
+from icl0ud.test.sample_messages import NOTIFICATION_MARSHALLED
+
+
+KEEPALIVE_RESPONSE = '\x0d\x00\x00\x00\x00'
+
+
+class TestFrameBuffer(unittest.TestCase):
+    def setUp(self):
+        self.buffer = APSFrameBuffer()
+
+    def frames(self):
+        return [frame.tobytes() for frame in self.buffer.frames()]
+
+    def test_single_frame(self):
+        self.buffer.append(NOTIFICATION_MARSHALLED)
+        self.assertEquals(self.frames(), [NOTIFICATION_MARSHALLED])
+        self.assertEquals(len(self.buffer), 0)
+
+    def test_multiple_frames_in_one_chunk(self):
+        self.buffer.append(KEEPALIVE_RESPONSE + NOTIFICATION_MARSHALLED +
+                           KEEPALIVE_RESPONSE)
+        self.assertEquals(self.frames(), [KEEPALIVE_RESPONSE,
+                                          NOTIFICATION_MARSHALLED,
+                                          KEEPALIVE_RESPONSE])
+
+    def test_byte_by_byte(self):
+        stream = NOTIFICATION_MARSHALLED + KEEPALIVE_RESPONSE
+        frames = []
+        for byte in stream:
+            self.buffer.append(byte)
+            frames.extend(self.frames())
+        self.assertEquals(frames, [NOTIFICATION_MARSHALLED,
+                                   KEEPALIVE_RESPONSE])
+        self.assertEquals(len(self.buffer), 0)
+
+    def test_incomplete_frame_is_kept(self):
+        self.buffer.append(KEEPALIVE_RESPONSE + NOTIFICATION_MARSHALLED[:10])
+        self.assertEquals(self.frames(), [KEEPALIVE_RESPONSE])
+        self.assertEquals(len(self.buffer), 10)
+        self.buffer.append(NOTIFICATION_MARSHALLED[10:])
+        self.assertEquals(self.frames(), [NOTIFICATION_MARSHALLED])
+
+    def test_pending_frame_length(self):
+        self.assertIdentical(self.buffer.pendingFrameLength(), None)
+        self.buffer.append(KEEPALIVE_RESPONSE + NOTIFICATION_MARSHALLED[:5])
+        self.assertEquals(self.buffer.pendingFrameLength(), 0)
+        self.frames()
+        self.assertEquals(self.buffer.pendingFrameLength(),
+                          len(NOTIFICATION_MARSHALLED) - 5)
+
+    def test_stop_at_long_frame(self):
+        self.buffer.append(KEEPALIVE_RESPONSE + NOTIFICATION_MARSHALLED)
+        frames = [frame.tobytes() for frame in self.buffer.frames(
+            maxLength=len(NOTIFICATION_MARSHALLED) - 6)]
+        self.assertEquals(frames, [KEEPALIVE_RESPONSE])
+        self.assertEquals(len(self.buffer), len(NOTIFICATION_MARSHALLED))
+
+    def test_retained_view_stays_valid(self):
+        self.buffer.append(NOTIFICATION_MARSHALLED + KEEPALIVE_RESPONSE[:3])
+        frame = next(self.buffer.frames())
+        self.buffer.append(KEEPALIVE_RESPONSE[3:])
+        self.assertEquals(frame.tobytes(), NOTIFICATION_MARSHALLED)
+        self.assertEquals(self.frames(), [KEEPALIVE_RESPONSE])
@@ -0,0 +1,132 @@
+from datetime import datetime
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from icl0ud.push.framing import HEADER
+from icl0ud.push.injection import (InjectionFactory, STATUS_INVALID,
+                                   marshalNotification, parseFrame)
+from icl0ud.push.messages import APSKeepAlive, APSNotification
+from icl0ud.push.notification_sender import (PushNotificationSender,
+                                             STATUS_SENT,
+                                             STATUS_UNKNOWN_TOKEN)
+from icl0ud.push.parser import APSParser
+from icl0ud.push.pushtoken_handler import PushTokenHandler
+from icl0ud.test.support import FakeDeviceProtocol
+
+
+TOKEN = '\x01' * 32
+OTHER_TOKEN = '\x02' * 32
+TOPIC = '\x03' * 20
+
+
+class DeferredSender(object):
+    def __init__(self):
+        self.calls = []
+
+    def sendFrames(self, frames):
+        d = defer.Deferred()
+        self.calls.append((frames, d))
+        return d
+
+
+class TestParseFrame(unittest.TestCase):
+    def test_valid(self):
+        frame = marshalNotification(TOKEN, TOPIC, '{}')
+        pushToken, fields = parseFrame(memoryview(frame))
+        self.assertEquals(pushToken, TOKEN)
+        self.assertEquals(fields, frame[HEADER.size:])
+
+    def test_other_message_type(self):
+        frame = APSKeepAlive(keepAliveInterval='10').marshal()
+        self.assertIdentical(parseFrame(frame), None)
+
+    def test_missing_field(self):
+        frame = APSNotification(recipientPushToken=TOKEN,
+                                payload='{}').marshal()
+        self.assertIdentical(parseFrame(frame), None)
+
+    def test_generated_field(self):
+        frame = APSNotification(recipientPushToken=TOKEN, topic=TOPIC,
+                                payload='{}', messageId='\x00' * 4).marshal()
+        self.assertIdentical(parseFrame(frame), None)
+
+    def test_truncated_field(self):
+        fields = marshalNotification(TOKEN, TOPIC, '{}')[HEADER.size:]
+        frame = HEADER.pack(APSNotification.type, len(fields) + 2) + \
+                fields + '\x03\x00'
+        self.assertIdentical(parseFrame(frame), None)
+
+
+class TestInjectionProtocol(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(1300000000)
+        self.tokenHandler = PushTokenHandler()
+        self.sender = PushNotificationSender(self.tokenHandler,
+                                             clock=self.clock)
+        self.device = FakeDeviceProtocol()
+        self.tokenHandler.updatePushToken(self.device, TOKEN)
+
+    def connect(self, sender):
+        factory = InjectionFactory(sender)
+        factory.maxFrameLength = 1024
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        return protocol
+
+    def test_notification_sent(self):
+        protocol = self.connect(self.sender)
+        data = (marshalNotification(TOKEN, TOPIC, '{"a": 1}') +
+                APSKeepAlive(keepAliveInterval='10').marshal() +
+                marshalNotification(OTHER_TOKEN, TOPIC, '{}'))
+        protocol.dataReceived(data[:10])
+        self.assertEquals(protocol.transport.value(), '')
+        protocol.dataReceived(data[10:])
+        self.assertEquals(protocol.transport.value(),
+                          '\x00' + STATUS_INVALID + '\x01')
+        notification, length = APSParser().parseMessage(
+            self.device.transport.value())
+        self.assertEquals(notification.recipientPushToken, TOKEN)
+        self.assertEquals(notification.topic, TOPIC)
+        self.assertEquals(notification.payload, '{"a": 1}')
+        self.assertEquals(notification.timestamp,
+                          datetime.fromtimestamp(1300000000))
+        self.assertTrue(notification.messageId in self.sender._messageIds)
+
+    def test_statuses_in_order(self):
+        sender = DeferredSender()
+        protocol = self.connect(sender)
+        protocol.dataReceived(marshalNotification(TOKEN, TOPIC, '1'))
+        protocol.dataReceived(marshalNotification(TOKEN, TOPIC, '2'))
+        (first, firstDeferred), (second, secondDeferred) = sender.calls
+        secondDeferred.callback([STATUS_UNKNOWN_TOKEN])
+        self.assertEquals(protocol.transport.value(), '')
+        firstDeferred.callback([STATUS_SENT])
+        self.assertEquals(protocol.transport.value(), '\x00\x01')
+
+    def test_frame_too_long(self):
+        protocol = self.connect(self.sender)
+        protocol.dataReceived(HEADER.pack(APSNotification.type, 2048) +
+                              'x' * 1100)
+        self.assertTrue(protocol.transport.disconnecting)
+
+    def test_first_complete_frame_too_long(self):
+        protocol = self.connect(self.sender)
+        protocol.dataReceived(marshalNotification(TOKEN, TOPIC, 'x' * 2048))
+        self.assertTrue(protocol.transport.disconnecting)
+        self.assertEquals(protocol.transport.value(), '')
+        self.assertEquals(self.device.transport.value(), '')
+
+    def test_complete_frame_too_long(self):
+        protocol = self.connect(self.sender)
+        protocol.dataReceived(marshalNotification(TOKEN, TOPIC, '{}') +
+                              HEADER.pack(APSNotification.type, 2048) +
+                              'x' * 2048)
+        self.assertTrue(protocol.transport.disconnecting)
+        # Frames before it are answered, the long one isn't parsed
+        self.assertEquals(protocol.transport.value(), '\x00')
+        protocol.dataReceived(marshalNotification(TOKEN, TOPIC, '{}'))
+        self.assertEquals(protocol.transport.value(), '\x00')
@@ -0,0 +1,609 @@
+import os
+
+from OpenSSL import SSL
+from twisted.internet import error, protocol, ssl
+from twisted.internet.task import Clock
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import MemoryReactorClock, StringTransport
+from twisted.trial import unittest
+
+from icl0ud.push.dispatch import BaseHandler
+from icl0ud.push import intercept
+from icl0ud.push.certstore import DeviceCertificateStore
+from icl0ud.push.intercept import (ClientContextCache,
+                                   InterceptClientContextFactory,
+                                   InterceptServer,
+                                   InterceptServerContextFactory,
+                                   MessageProxy, WriteQueue,
+                                   dispatchSSLInfo, keepSessionResumable)
+from icl0ud.push.messages import APSKeepAliveResponse, APSNotification
+from icl0ud.push.upstream import UpstreamSelector
+from icl0ud.test.sample_messages import (NOTIFICATION_DICT,
+                                         NOTIFICATION_MARSHALLED)
+from icl0ud.test.support import createCertificate, writePem
+from icl0ud.test.test_upstream import FirstTwo
+
+
+KEEPALIVE_RESPONSE = '\x0d\x00\x00\x00\x00'
+
+
+class RecordingHandler(BaseHandler):
+    def __init__(self, messageTypes=None):
+        self.messageTypes = messageTypes
+        self.messages = []
+
+    def handle(self, source, message, deviceProtocol):
+        self.messages.append(message)
+
+    def connectionLost(self, source, deviceProtocol, reason):
+        self.messages.append((source, deviceProtocol))
+
+
+class FakePeer(object):
+    def __init__(self):
+        self.transport = StringTransport()
+
+    def write(self, data):
+        self.transport.write(data)
+
+
+class TestMessageProxy(MessageProxy):
+    peer_type = 'server'
+
+    def getDeviceProtocol(self):
+        return self.peer
+
+
+class TestForwarding(unittest.TestCase):
+    def setUp(self):
+        self.proxy = TestMessageProxy()
+        self.proxy.setPeer(FakePeer())
+
+    def received(self):
+        return self.proxy.peer.transport.value()
+
+    def test_forward_in_order(self):
+        handler = RecordingHandler()
+        self.proxy.addHandler(handler)
+        self.proxy.dataReceived(KEEPALIVE_RESPONSE + NOTIFICATION_MARSHALLED)
+
+        self.assertEquals(self.received(),
+                          KEEPALIVE_RESPONSE + NOTIFICATION_MARSHALLED)
+        self.assertEquals([m.__class__ for m in handler.messages],
+                          [APSKeepAliveResponse, APSNotification])
+
+    def test_skip_parsing_unsubscribed_types(self):
+        handler = RecordingHandler(messageTypes=(APSNotification.type,))
+        self.proxy.addHandler(handler)
+        self.proxy.dataReceived(KEEPALIVE_RESPONSE + NOTIFICATION_MARSHALLED +
+                                KEEPALIVE_RESPONSE)
+
+        self.assertEquals(self.received(),
+                          KEEPALIVE_RESPONSE + NOTIFICATION_MARSHALLED +
+                          KEEPALIVE_RESPONSE)
+        self.assertEquals([m.__class__ for m in handler.messages],
+                          [APSNotification])
+
+    def test_forward_modified_message(self):
+        class ChangingHandler(BaseHandler):
+            def handle(self, source, message, deviceProtocol):
+                message.payload = '{}'
+                return True
+        self.proxy.addHandler(ChangingHandler())
+        self.proxy.dataReceived(NOTIFICATION_MARSHALLED)
+
+        notification = APSNotification(**NOTIFICATION_DICT)
+        notification.payload = '{}'
+        self.assertEquals(self.received(), notification.marshal())
+
+    def test_subscriptions_are_combined(self):
+        self.proxy.addHandlers([
+            RecordingHandler(messageTypes=(APSNotification.type,)),
+            RecordingHandler(messageTypes=(APSKeepAliveResponse.type,))])
+
+        self.assertTrue(self.proxy.isDispatched(APSNotification.type))
+        self.assertTrue(self.proxy.isDispatched(APSKeepAliveResponse.type))
+        self.assertFalse(self.proxy.isDispatched(0x0c))
+
+        self.proxy.addHandler(RecordingHandler())
+        self.assertTrue(self.proxy.isDispatched(0x0c))
+
+
+class SequenceTransport(StringTransport):
+    def __init__(self):
+        StringTransport.__init__(self)
+        self.sequences = []
+
+    def writeSequence(self, data):
+        self.sequences.append(list(data))
+        StringTransport.writeSequence(self, data)
+
+
+class TestWriteQueue(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.transport = SequenceTransport()
+
+    def test_written_at_end_of_iteration(self):
+        queue = WriteQueue(self.transport, clock=self.clock)
+        queue.write('a')
+        queue.write('b')
+        self.assertEquals(self.transport.value(), '')
+        self.clock.advance(0)
+        self.assertEquals(self.transport.sequences, [['a', 'b']])
+
+    def test_max_delay(self):
+        queue = WriteQueue(self.transport, maxDelay=0.01, clock=self.clock)
+        queue.write('a')
+        self.clock.advance(0.005)
+        queue.write('b')
+        self.clock.advance(0.005)
+        self.assertEquals(self.transport.sequences, [['a', 'b']])
+
+    def test_max_size(self):
+        queue = WriteQueue(self.transport, maxSize=4, clock=self.clock)
+        queue.write('ab')
+        queue.write('cd')
+        queue.write('e')
+        self.assertEquals(self.transport.sequences, [['ab', 'cd']])
+        self.clock.advance(0)
+        self.assertEquals(self.transport.sequences, [['ab', 'cd'], ['e']])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_discard(self):
+        queue = WriteQueue(self.transport, clock=self.clock)
+        queue.write('a')
+        queue.discard()
+        self.clock.advance(0)
+        self.assertEquals(self.transport.value(), '')
+
+
+class TestDispatchTable(unittest.TestCase):
+    def setUp(self):
+        self.proxy = TestMessageProxy()
+        self.notificationHandler = RecordingHandler(
+            messageTypes=(APSNotification.type,))
+        self.allHandler = RecordingHandler()
+        self.proxy.addHandlers([self.notificationHandler, self.allHandler])
+
+    def test_handlers_for_type(self):
+        self.assertEquals(
+            set(self.proxy.handlersForType(APSNotification.type)),
+            set([self.notificationHandler, self.allHandler]))
+        self.assertEquals(self.proxy.handlersForType(0x0c),
+                          [self.allHandler])
+
+    def test_remove_handler(self):
+        self.proxy.removeHandler(self.allHandler)
+
+        self.assertEquals(self.proxy.handlersForType(APSNotification.type),
+                          [self.notificationHandler])
+        self.assertEquals(self.proxy.handlersForType(0x0c), [])
+
+    def test_dispatch_only_to_subscribed_handlers(self):
+        keepAliveResponse = APSKeepAliveResponse()
+        self.proxy.dispatch('server', keepAliveResponse)
+
+        self.assertEquals(self.notificationHandler.messages, [])
+        self.assertEquals(self.allHandler.messages, [keepAliveResponse])
+
+
+class FakeTLSConnection(object):
+    def __init__(self, appData):
+        self.appData = appData
+
+    def get_app_data(self):
+        return self.appData
+
+
+class TestSSLInfoCallback(unittest.TestCase):
+    def test_dispatched_to_connection_protocol(self):
+        calls = []
+
+        class Protocol(object):
+            def __init__(self, name):
+                self.name = name
+
+            def SSLInfoCallback(self, conn, where, ret):
+                calls.append((self.name, where))
+
+        # The context callback is shared, the connection decides
+        dispatchSSLInfo(FakeTLSConnection(Protocol('first')), 0x20, 1)
+        dispatchSSLInfo(FakeTLSConnection(Protocol('second')), 0x20, 1)
+        self.assertEquals(calls, [('first', 0x20), ('second', 0x20)])
+
+
+def handshake(client, server):
+    """Run a TLS handshake between two memory BIO connections."""
+    for i in range(10):
+        for conn, peer in ((client, server), (server, client)):
+            try:
+                # Also reads TLS 1.3 session tickets after the handshake
+                conn.recv(1)
+            except SSL.WantReadError:
+                pass
+            try:
+                peer.bio_write(conn.bio_read(65536))
+            except SSL.WantReadError:
+                pass
+
+
+class CertificateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = self.mktemp()
+        os.mkdir(self.directory)
+        self.ca = createCertificate('CA')
+        self.chain = os.path.join(self.directory, 'ca.pem')
+        writePem(self.chain, self.ca[0])
+        self.serverCert = os.path.join(self.directory, 'server.pem')
+        writePem(self.serverCert,
+                 *createCertificate('server', self.ca, serial=2))
+        self.deviceDir = os.path.join(self.directory, 'device')
+        os.mkdir(self.deviceDir)
+        self.deviceCert = os.path.join(self.deviceDir, 'device.pem')
+        writePem(self.deviceCert,
+                 *createCertificate('device', self.ca, serial=3))
+        self.clock = Clock()
+
+
+class TestSessionResumption(CertificateTestCase):
+
+    def contextFactory(self, **kwargs):
+        return InterceptServerContextFactory(self.serverCert, self.chain,
+                                             clock=self.clock, **kwargs)
+
+    def connect(self, contextFactory, session=None):
+        """Handshake in memory, return the client and server connection."""
+        client = SSL.Connection(
+            InterceptClientContextFactory(self.deviceCert,
+                                          self.chain).getContext(),
+            None)
+        client.set_connect_state()
+        if session is not None:
+            client.set_session(session)
+        server = SSL.Connection(contextFactory.getContext(), None)
+        server.set_accept_state()
+        handshake(client, server)
+        contextFactory.recordHandshake(server)
+        return client, server
+
+    def test_resumption(self):
+        contextFactory = self.contextFactory()
+        client, server = self.connect(contextFactory)
+        client, server = self.connect(contextFactory, client.get_session())
+
+        self.assertEquals(contextFactory.resetStats(), (2, 1))
+        self.assertEquals(contextFactory.resetStats(), (0, 0))
+        self.assertEquals(server.get_peer_certificate().get_subject().CN,
+                          'device')
+
+    def test_session_reused_api(self):
+        class Connection(object):
+            def session_reused(self):
+                return 1
+        self.assertIdentical(intercept.sessionReused(Connection()), True)
+
+    def test_context_is_shared(self):
+        contextFactory = self.contextFactory()
+        self.assertIdentical(contextFactory.getContext(),
+                             contextFactory.getContext())
+
+    def test_ticket_key_rotation(self):
+        contextFactory = self.contextFactory(ticketKeyLifetime=60)
+        context = contextFactory.getContext()
+        client, server = self.connect(contextFactory)
+        self.clock.advance(60)
+        self.assertNotIdentical(contextFactory.getContext(), context)
+
+        self.connect(contextFactory, client.get_session())
+        self.assertEquals(contextFactory.resetStats(), (2, 0))
+
+    def test_session_cache_disabled(self):
+        contextFactory = self.contextFactory(sessionCache=False)
+        client, server = self.connect(contextFactory)
+        self.connect(contextFactory, client.get_session())
+        self.assertEquals(contextFactory.resetStats(), (2, 0))
+
+
+class FakeTLSTransport(object):
+    def __init__(self, tlsConnection):
+        self.tlsConnection = tlsConnection
+
+    def getHandle(self):
+        return self.tlsConnection
+
+
+class TestClientContexts(CertificateTestCase):
+    def setUp(self):
+        CertificateTestCase.setUp(self)
+        self.store = DeviceCertificateStore(self.deviceDir, reactor=self.clock)
+        self.store.scan()
+        self.cache = ClientContextCache(self.store, self.chain)
+        self.serverContextFactory = InterceptServerContextFactory(
+            self.serverCert, self.chain, clock=self.clock)
+
+    def connect(self, clientContextFactory):
+        client = clientContextFactory.clientConnectionForTLS(None)
+        client.set_connect_state()
+        server = SSL.Connection(self.serverContextFactory.getContext(), None)
+        server.set_accept_state()
+        handshake(client, server)
+        self.serverContextFactory.recordHandshake(server)
+        clientContextFactory.saveSession(FakeTLSTransport(client))
+        keepSessionResumable(FakeTLSTransport(client))
+        keepSessionResumable(FakeTLSTransport(server))
+
+    def test_cached_by_common_name(self):
+        contextFactory = self.cache.getContextFactory('device')
+        self.assertIdentical(self.cache.getContextFactory('device'),
+                             contextFactory)
+        self.assertIdentical(contextFactory.getContext(),
+                             contextFactory.getContext())
+
+    def test_modified_certificate(self):
+        contextFactory = self.cache.getContextFactory('device')
+        mtime = os.stat(self.deviceCert).st_mtime
+        os.utime(self.deviceCert, (mtime + 10, mtime + 10))
+        self.store.scan()
+        self.assertNotIdentical(self.cache.getContextFactory('device'),
+                                contextFactory)
+
+    def test_missing_certificate(self):
+        self.cache.getContextFactory('device')
+        os.remove(self.deviceCert)
+        self.store.scan()
+        self.assertRaises(Exception, self.cache.getContextFactory, 'device')
+        self.assertRaises(Exception, self.cache.getContextFactory, 'other')
+
+    def test_upstream_session_reused(self):
+        contextFactory = self.cache.getContextFactory('device')
+        self.connect(contextFactory)
+        self.connect(contextFactory)
+        self.assertEquals(self.serverContextFactory.resetStats(), (2, 1))
+
+
+CONTEXT_FACTORY = object()
+
+
+class FakeServerFactory(object):
+    port = 5223
+    connectTimeout = 10
+    maxConnectAttempts = 2
+    maxPendingBytes = 10
+    writeBufferSize = 1024
+    writeDelay = 0
+    writeBatchSize = 16
+    dispatchHandlers = []
+
+    def __init__(self, hosts, clock):
+        self.hosts = hosts
+        self.upstream = UpstreamSelector(hosts, clock=clock,
+                                         random=FirstTwo())
+
+
+class TestInterceptServer(InterceptServer):
+    def getClientContextFactory(self):
+        self.clientContextFactory = CONTEXT_FACTORY
+        return self.clientContextFactory
+
+
+class FakeTCPTransport(StringTransport):
+    tlsContextFactory = None
+
+    def startTLS(self, contextFactory):
+        self.tlsContextFactory = contextFactory
+
+
+class FailedConnector(object):
+    """Like Twisted's connectors once connecting failed."""
+
+    def stopConnecting(self):
+        raise error.NotConnectingError()
+
+
+class TestUpstreamConnect(unittest.TestCase):
+    def setUp(self):
+        self.reactor = MemoryReactorClock()
+        self.patch(intercept, 'reactor', self.reactor)
+        self.device = TestInterceptServer()
+        self.device.factory = FakeServerFactory(['a', 'b', 'c'],
+                                                self.reactor)
+        self.device.transport = StringTransport()
+        self.device.transport.sessionno = 0
+
+    def connectAttempt(self, index):
+        host, port, factory, timeout, bindAddress = \
+            self.reactor.tcpClients[index]
+        return host, factory
+
+    def connectClient(self, clientFactory):
+        clientFactory.setDispatchHandlers([])
+        client = clientFactory.buildProtocol(None)
+        client.makeConnection(FakeTCPTransport())
+        return client
+
+    def test_retry_other_host(self):
+        self.device.connectToServer()
+        host, clientFactory = self.connectAttempt(0)
+        self.assertEquals(host, 'a')
+        self.reactor.advance(1)
+        clientFactory.clientConnectionFailed(None, Failure(Exception()))
+
+        host, clientFactory = self.connectAttempt(1)
+        self.assertEquals(host, 'b')
+        self.assertFalse(self.device.transport.disconnecting)
+        self.assertEquals(
+            self.device.factory.upstream.hosts[0].consecutiveFailures, 1)
+
+    def test_drop_device_after_attempts(self):
+        handler = RecordingHandler()
+        self.device.addHandler(handler)
+        self.device.connectToServer()
+        for i in range(2):
+            host, clientFactory = self.connectAttempt(i)
+            clientFactory.connector = FailedConnector()
+            clientFactory.clientConnectionFailed(clientFactory.connector,
+                                                 Failure(Exception()))
+        self.assertEquals(len(self.reactor.tcpClients), 2)
+        self.assertTrue(self.device.transport.disconnecting)
+
+        self.device.connectionLost(Failure(Exception()))
+        self.assertEquals(handler.messages, [('device', self.device)])
+
+    def test_connected(self):
+        self.device.connectToServer()
+        host, clientFactory = self.connectAttempt(0)
+        self.reactor.advance(0.2)
+        client = self.connectClient(clientFactory)
+        self.assertIdentical(client.transport.tlsContextFactory,
+                             self.device.clientContextFactory)
+        self.reactor.advance(0.3)
+        client.handshakeCompleted()
+
+        self.assertIdentical(self.device.peer, client)
+        self.assertIdentical(client.peer, self.device)
+        self.assertAlmostEqual(self.device.factory.upstream.hosts[0].latency,
+                               0.5)
+        # Each side reads only while the other can write
+        self.assertIdentical(self.device.transport.producer, client.transport)
+        self.assertIdentical(client.transport.producer,
+                             self.device.transport)
+        self.assertTrue(self.device.transport.streaming)
+        self.assertEquals(client.transport.bufferSize, 1024)
+        # A connection lost later is no connect failure
+        clientFactory.clientConnectionLost(None, Failure(Exception()))
+        self.assertEquals(len(self.reactor.tcpClients), 1)
+
+    def test_tls_device_transport(self):
+        # Workers wrap device connections in TLSMemoryBIOProtocol
+        tlsFactory = TLSMemoryBIOFactory(
+            ssl.ClientContextFactory(), True,
+            protocol.Factory.forProtocol(protocol.Protocol))
+        tlsProtocol = tlsFactory.buildProtocol(None)
+        tcpTransport = StringTransport()
+        tcpTransport.sessionno = 0
+        tlsProtocol.makeConnection(tcpTransport)
+        self.device.transport = tlsProtocol
+        self.device.connectToServer()
+        host, clientFactory = self.connectAttempt(0)
+        client = self.connectClient(clientFactory)
+        client.handshakeCompleted()
+
+        self.assertEquals(tcpTransport.bufferSize, 1024)
+        self.assertNotIdentical(tcpTransport.producer, None)
+
+    def test_speculative_connect(self):
+        self.device.connectUpstream()
+        host, clientFactory = self.connectAttempt(0)
+        client = self.connectClient(clientFactory)
+        self.reactor.advance(1)
+        self.assertIdentical(client.transport.tlsContextFactory, None)
+
+        self.device.connectToServer()
+        self.assertIdentical(client.transport.tlsContextFactory,
+                             self.device.clientContextFactory)
+        self.reactor.advance(0.5)
+        client.handshakeCompleted()
+        self.assertIdentical(self.device.peer, client)
+        # The time waiting for the device isn't latency
+        self.assertAlmostEqual(self.device.factory.upstream.hosts[0].latency,
+                               0.5)
+
+    def test_retry_starts_tls(self):
+        self.device.connectToServer()
+        host, clientFactory = self.connectAttempt(0)
+        clientFactory.clientConnectionFailed(None, Failure(Exception()))
+        host, clientFactory = self.connectAttempt(1)
+        client = self.connectClient(clientFactory)
+        self.assertIdentical(client.transport.tlsContextFactory,
+                             self.device.clientContextFactory)
+
+    def test_device_disconnected_while_connecting(self):
+        self.device.connectToServer()
+        self.device.connectionLost(Failure(Exception()))
+        host, clientFactory = self.connectAttempt(0)
+        client = self.connectClient(clientFactory)
+        client.handshakeCompleted()
+
+        self.assertTrue(client.transport.disconnecting)
+        self.assertIdentical(self.device.peer, None)
+
+    def test_device_disconnected_before_upstream_connected(self):
+        self.device.connectUpstream()
+        host, clientFactory = self.connectAttempt(0)
+        self.device.connectionLost(Failure(Exception()))
+        self.assertTrue(clientFactory.connector.stoppedConnecting)
+        clientFactory.clientConnectionFailed(None, Failure(Exception()))
+        # Not the host's fault
+        self.assertEquals(
+            self.device.factory.upstream.hosts[0].consecutiveFailures, 0)
+        self.assertEquals(len(self.reactor.tcpClients), 1)
+
+    def test_missing_device_certificate(self):
+        class MissingCertificates(object):
+            def getContextFactory(self, commonName):
+                raise Exception('Device certificate is missing')
+        device = InterceptServer()
+        device.factory = self.device.factory
+        device.factory.clientContexts = MissingCertificates()
+        device.transport = self.device.transport
+        device.deviceCommonName = '00000000-0000-0000-0000-000000000000'
+        device.connectUpstream()
+        host, clientFactory = self.connectAttempt(0)
+        client = self.connectClient(clientFactory)
+
+        self.assertRaises(Exception, device.connectToServer)
+        self.assertTrue(client.transport.disconnecting)
+        clientFactory.clientConnectionLost(None, Failure(Exception()))
+        self.assertEquals(len(self.reactor.tcpClients), 1)
+
+    def test_pending_data_sent_once_connected(self):
+        self.device.connectToServer()
+        self.device.sendToPeer('abc')
+        self.device.sendToPeer('def')
+        host, clientFactory = self.connectAttempt(0)
+        client = self.connectClient(clientFactory)
+        client.handshakeCompleted()
+        self.device.sendToPeer('ghi')
+        self.reactor.advance(0)
+        self.assertEquals(client.transport.value(), 'abcdefghi')
+
+    def test_pending_data_bounded(self):
+        self.device.connectToServer()
+        self.device.sendToPeer('0123456789')
+        self.assertFalse(self.device.transport.disconnecting)
+        self.device.sendToPeer('a')
+        self.assertTrue(self.device.transport.disconnecting)
+        self.device.sendToPeer('b')
+        self.assertEquals(self.device._peerSendBuffer, ['0123456789'])
+
+    def test_pending_writes_sent_before_closing(self):
+        self.device.connectToServer()
+        host, clientFactory = self.connectAttempt(0)
+        client = self.connectClient(clientFactory)
+        client.handshakeCompleted()
+        client.sendToPeer('abc')
+        client.connectionLost(Failure(Exception()))
+        self.assertEquals(self.device.transport.value(), 'abc')
+        self.assertTrue(self.device.transport.disconnecting)
+
+    def test_upstream_lost_first(self):
+        self.device.connectToServer()
+        host, clientFactory = self.connectAttempt(0)
+        client = self.connectClient(clientFactory)
+        client.handshakeCompleted()
+
+        client.transport.disconnected = True
+        client.connectionLost(Failure(Exception()))
+        self.assertTrue(self.device.transport.disconnecting)
+        self.assertIdentical(self.device.transport.producer, None)
+        # The closed transport isn't touched
+        self.device.connectionLost(Failure(Exception()))
+        self.assertIdentical(client.transport.producer, self.device.transport)
+
+    def test_handlers_notified_of_lost_connection(self):
+        handler = RecordingHandler()
+        self.device.addHandler(handler)
+        self.device.connectionLost(Failure(Exception()))
+        self.assertEquals(handler.messages, [('device', self.device)])
@@ -0,0 +1,181 @@
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from StringIO import StringIO
+
+from twisted.internet import task
+from twisted.python import runtime, threadable
+from twisted.trial import unittest
+
+from icl0ud.logger import BufferedPushLogObserver
+from icl0ud.push import messages
+from icl0ud.push.dispatch import LoggingHandler, LOG_FULL, LOG_METADATA
+from icl0ud.push.parser import APSParser
+from icl0ud.test.sample_messages import NOTIFICATION_MARSHALLED
+from icl0ud.test.support import FakeDeviceProtocol
+
+
+class CountingNotification(messages.APSNotification):
+    __slots__ = ('strCalls',)
+
+    def __str__(self):
+        self.strCalls += 1
+        return 'notification'
+
+
+class TestLoggingHandler(unittest.TestCase):
+    def setUp(self):
+        self.deviceProtocol = FakeDeviceProtocol()
+
+    def test_formatting_is_deferred(self):
+        message = CountingNotification()
+        message.strCalls = 0
+        LoggingHandler().handle('server', message, self.deviceProtocol)
+
+        self.assertEquals(message.strCalls, 0)
+        self.assertEquals(str(self.deviceProtocol.logged[0]),
+                          '<- notification')
+        self.assertEquals(message.strCalls, 1)
+
+    def test_metadata_level(self):
+        message, _ = APSParser(lazy=True).parseMessage(
+            NOTIFICATION_MARSHALLED)
+        LoggingHandler(level=LOG_METADATA).handle('device', message,
+                                                  self.deviceProtocol)
+
+        self.assertEquals(str(self.deviceProtocol.logged[0]),
+                          '-> APSNotification(0x0a) 91 bytes ' +
+                          'token: 66616b65')
+
+    def test_sampling(self):
+        handler = LoggingHandler(level=LOG_FULL, sampleRate=0)
+        handler.handle('device', messages.APSKeepAliveResponse(),
+                       self.deviceProtocol)
+
+        self.assertEquals(self.deviceProtocol.logged, [])
+
+
+class TestBufferedPushLogObserver(unittest.TestCase):
+    def setUp(self):
+        self.file = StringIO()
+        self.clock = task.Clock()
+        self.observer = BufferedPushLogObserver(self.file, bufferSize=100,
+                                                flushInterval=1.0,
+                                                clock=self.clock)
+
+    def emit(self, text):
+        self.observer.emit({'message': (text,), 'isError': 0,
+                            'time': 0, 'system': '-'})
+
+    def lines(self):
+        return [line.split(' ', 2)[2]
+                for line in self.file.getvalue().splitlines()]
+
+    def test_flush_after_interval(self):
+        self.emit('first')
+        self.emit('second')
+        self.assertEquals(self.lines(), [])
+
+        self.clock.advance(1)
+        self.assertEquals(self.lines(), ['first', 'second'])
+
+    def test_flush_when_buffer_full(self):
+        self.emit('x' * 100)
+        self.assertEquals(self.lines(), ['x' * 100])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_flush_on_stop(self):
+        self.emit('last')
+        self.observer.stop()
+        self.assertEquals(self.lines(), ['last'])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_writer_thread(self):
+        self.observer._writer = threading.Thread(
+            target=self.observer._writeBatches)
+        self.observer._writer.start()
+        self.emit('threaded')
+        self.observer.stop()
+        self.assertEquals(self.lines(), ['threaded'])
+
+    def test_buffer_full_in_other_thread(self):
+        self.emit('first')
+        delayedFlush, = self.clock.getDelayedCalls()
+        self.patch(threadable, 'ioThread', threadable.getThreadID())
+        thread = threading.Thread(target=self.emit, args=('x' * 100,))
+        thread.start()
+        thread.join()
+        self.assertEquals(self.lines(), ['first', 'x' * 100])
+        # Left to the reactor thread
+        self.assertTrue(delayedFlush.active())
+        self.clock.advance(1)
+        self.assertEquals(self.lines(), ['first', 'x' * 100])
+
+
+# Before trial changes into its temporary directory
+SOURCE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+DAEMON_TAC = """
+from twisted.application import service
+from twisted.internet import reactor
+from twisted.python import log
+
+application = service.Application('logtest')
+reactor.callWhenRunning(log.msg, 'daemon running')
+reactor.callLater(30, reactor.stop)
+"""
+
+
+class TestFileLoggerDaemon(unittest.TestCase):
+    """Runs twistd with fileLogger like runpush.sh in production."""
+
+    if not runtime.platform.isLinux():
+        skip = 'twistd daemonizes on POSIX only'
+
+    def setUp(self):
+        self.directory = os.path.abspath(self.mktemp())
+        os.makedirs(os.path.join(self.directory, 'data'))
+        with open(os.path.join(self.directory, 'logtest.tac'), 'w') as f:
+            f.write(DAEMON_TAC)
+        self.pidFile = os.path.join(self.directory, 'twistd.pid')
+        self.addCleanup(self.stopDaemon)
+
+    def stopDaemon(self):
+        if not os.path.exists(self.pidFile):
+            return
+        with open(self.pidFile) as f:
+            pid = int(f.read())
+        os.kill(pid, signal.SIGTERM)
+        self.waitFor(lambda: not os.path.exists(self.pidFile))
+
+    def waitFor(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def logContents(self):
+        try:
+            with open(os.path.join(self.directory, 'data', 'push.log')) as f:
+                return f.read()
+        except IOError:
+            return ''
+
+    def test_flushed_by_daemon(self):
+        env = dict(os.environ, PYTHONPATH=SOURCE_DIRECTORY)
+        subprocess.check_call(
+            [sys.executable, '-c',
+             'from twisted.scripts.twistd import run; run()',
+             '--logger=icl0ud.logger.fileLogger',
+             '--pidfile', self.pidFile, '-y', 'logtest.tac'],
+            cwd=self.directory, env=env)
+        # Written by the writer thread while the daemon keeps running
+        self.assertTrue(self.waitFor(
+            lambda: 'daemon running' in self.logContents()),
+            self.logContents())
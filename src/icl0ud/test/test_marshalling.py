@@ -1,6 +1,8 @@
+from twisted.python import log
 from twisted.trial import unittest
 
 from icl0ud.push import messages
+from icl0ud.push.framing import HEADER, HEADER_LENGTH
 from icl0ud.push.parser import APSParser
 from icl0ud.test.sample_messages import (NOTIFICATION_MARSHALLED,
                                               NOTIFICATION_DICT)
@@ -31,3 +33,149 @@ class TestMessages(unittest.TestCase):
                           NOTIFICATION_DICT['timestamp'])
         self.assertEquals(message.storageFlags,
                           NOTIFICATION_DICT['storageFlags'])
+
+    def test_messages_use_slots(self):
+        notification = messages.APSNotification(**NOTIFICATION_DICT)
+
+        self.assertFalse(hasattr(notification, '__dict__'))
+        self.assertIn('payload', messages.APSNotification.__slots__)
+        self.assertIn('pushToken', messages.APSConnectBase.__slots__ +
+                                   messages.APSConnect.__slots__)
+        self.assertRaises(AttributeError, setattr, notification, 'foo', 1)
+        self.assertIdentical(messages.APSConnect().state, None)
+
+    def test_marshal_plan(self):
+        self.assertEquals([type_ for type_, name, encode
+                           in messages.APSNotification._marshalPlan],
+                          [1, 2, 3, 4, 5, 6, 7, 9])
+        self.assertIdentical(messages.APSNotification._marshalPlan[4][2],
+                             messages.encodeDatetime32)
+
+    def test_unchanged_message_reuses_frame(self):
+        # With an unknown field, which isn't marshalled
+        fields = NOTIFICATION_MARSHALLED[HEADER_LENGTH:] + '\x0f\x00\x01\x00'
+        frame = HEADER.pack(messages.APSNotification.type, len(fields)) + \
+                fields
+        for parser in (APSParser(), APSParser(lazy=True)):
+            message, length = parser.parseMessage(frame)
+            self.assertIdentical(message.marshal(), message.rawData)
+
+    def test_modified_message_is_marshalled(self):
+        message, length = APSParser().parseMessage(NOTIFICATION_MARSHALLED)
+        message.payload = '{}'
+        expected = dict(NOTIFICATION_DICT, payload='{}')
+        self.assertEquals(message.marshal(),
+                          messages.APSNotification(**expected).marshal())
+        self.assertEquals(message.rawData, NOTIFICATION_MARSHALLED)
+
+    def test_patched_frame_keeps_order_and_unknown_fields(self):
+        frame = ('\x0b\x00\x00\x00\x0c' +
+                 '\x08\x00\x01\x00' +  # deliveryStatus
+                 '\x0f\x00\x01\x42' +  # unknown
+                 '\x04\x00\x01\x01')  # messageId
+        for parser in (APSParser(), APSParser(lazy=True)):
+            message, length = parser.parseMessage(frame)
+            message.messageId = '\xde\xad\xbe\xef'
+            self.assertEquals(message.marshal(),
+                              '\x0b\x00\x00\x00\x0f' +
+                              '\x08\x00\x01\x00' +
+                              '\x0f\x00\x01\x42' +
+                              '\x04\x00\x04\xde\xad\xbe\xef')
+
+    def test_patched_frame_field_removed_and_added(self):
+        message, length = APSParser(lazy=True).parseMessage(
+            '\x0b\x00\x00\x00\x04' + '\x04\x00\x01\x01')
+        message.messageId = None
+        message.deliveryStatus = '\x00'
+        self.assertEquals(message.marshal(),
+                          '\x0b\x00\x00\x00\x04' + '\x08\x00\x01\x00')
+
+    def test_patched_repeated_fields(self):
+        message, length = APSParser(lazy=True).parseMessage(
+            '\x09\x00\x00\x00\x0c' +
+            '\x02\x00\x01a' + '\x03\x00\x01b' + '\x02\x00\x01c')
+        message.enabledTopics = ['d', 'e']
+        self.assertEquals(message.marshal(),
+                          '\x09\x00\x00\x00\x0c' +
+                          '\x02\x00\x01d' + '\x02\x00\x01e' +
+                          '\x03\x00\x01b')
+
+    def test_parse_notification_from_view(self):
+        parser = APSParser()
+        data = bytearray(NOTIFICATION_MARSHALLED + '\x0d\x00\x00\x00\x00')
+        message, length = parser.parseMessage(memoryview(data))
+
+        self.assertEquals(length, len(NOTIFICATION_MARSHALLED))
+        self.assertEquals(message.rawData, NOTIFICATION_MARSHALLED)
+        self.assertEquals(message.payload, NOTIFICATION_DICT['payload'])
+
+    def test_parse_unknown_message_type(self):
+        parser = APSParser()
+        message, length = parser.parseMessage(
+            '\x42\x00\x00\x00\x07\x01\x00\x01\x23\x02\x00\x00')
+
+        self.assertEquals(length, 12)
+        self.assertEquals(message.__class__, messages.APSMessage)
+        self.assertEquals(message.type, 0x42)
+        self.assertEquals(message.fields, [(1, '\x23'), (2, '')])
+
+
+def isDecoded(message, name):
+    try:
+        # bypasses __getattr__, which decodes the field
+        object.__getattribute__(message, name)
+    except AttributeError:
+        return False
+    return True
+
+
+class TestLazyParsing(unittest.TestCase):
+    def setUp(self):
+        self.parser = APSParser(lazy=True)
+
+    def test_unmapped_field_reported_when_parsed(self):
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+        fields = NOTIFICATION_MARSHALLED[HEADER_LENGTH:] + '\x0f\x00\x01\x42'
+        self.parser.parseMessage(
+            HEADER.pack(messages.APSNotification.type, len(fields)) + fields)
+
+        errors = [log.textFromEventDict(event) for event in events
+                  if event['isError']]
+        self.assertEquals(len(errors), 1)
+        self.assertIn('unknown field: f value: 42', errors[0])
+
+    def test_fields_decoded_on_access(self):
+        message, length = self.parser.parseMessage(NOTIFICATION_MARSHALLED)
+
+        self.assertEquals(length, len(NOTIFICATION_MARSHALLED))
+        self.assertFalse(isDecoded(message, 'timestamp'))
+        self.assertEquals(message.timestamp, NOTIFICATION_DICT['timestamp'])
+        self.assertTrue(isDecoded(message, 'timestamp'))
+        self.assertFalse(isDecoded(message, 'payload'))
+
+    def test_lazy_equals_eager(self):
+        lazy, _ = self.parser.parseMessage(NOTIFICATION_MARSHALLED)
+        eager, _ = APSParser().parseMessage(NOTIFICATION_MARSHALLED)
+
+        self.assertEquals(lazy.fieldsAsDict(), eager.fieldsAsDict())
+        self.assertEquals(lazy.fields, eager.fields)
+        self.assertEquals(str(lazy), str(eager))
+        self.assertEquals(lazy.marshal(), NOTIFICATION_MARSHALLED)
+
+    def test_missing_field_is_none(self):
+        message, _ = self.parser.parseMessage('\x0b\x00\x00\x00\x07' +
+                                              '\x04\x00\x04\xde\xad\xbe\xef')
+
+        self.assertEquals(message.messageId, '\xde\xad\xbe\xef')
+        self.assertIdentical(message.deliveryStatus, None)
+        self.assertRaises(AttributeError, getattr, message, 'noSuchField')
+
+    def test_repeated_topic_fields(self):
+        message, _ = self.parser.parseMessage('\x09\x00\x00\x00\x0c' +
+                                              '\x02\x00\x03abc' +
+                                              '\x02\x00\x03def')
+
+        self.assertEquals(message.enabledTopics, ['abc', 'def'])
+        self.assertEquals(message.disabledTopics, [])
@@ -0,0 +1,153 @@
+from datetime import datetime
+from struct import unpack
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from icl0ud.push.messages import APSNotificationResponse
+from icl0ud.push.notification_sender import (MessageIdTracker,
+                                             PushNotificationSender,
+                                             STATUS_INVALID, STATUS_SENT,
+                                             STATUS_UNKNOWN_TOKEN)
+from icl0ud.push.parser import APSParser
+from icl0ud.push.pushtoken_handler import PushTokenHandler
+from icl0ud.test.support import FakeDeviceProtocol
+
+
+TOKEN = '\x01' * 32
+OTHER_TOKEN = '\x02' * 32
+
+
+class TestMessageIdTracker(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.tracker = MessageIdTracker(bucketSize=60, clock=self.clock)
+
+    def test_remove(self):
+        self.tracker.add('a', 2000)
+        self.assertTrue('a' in self.tracker)
+        self.assertTrue(self.tracker.remove('a'))
+        self.assertFalse(self.tracker.remove('a'))
+        self.assertEquals(len(self.tracker), 0)
+
+    def test_expire(self):
+        self.tracker.add('a', 1030)
+        self.tracker.add('b', 1100)
+        self.clock.advance(30)
+        self.tracker.expire()
+        # Kept until the end of its bucket
+        self.assertTrue('a' in self.tracker)
+        self.clock.advance(50)
+        self.tracker.expire()
+        self.assertFalse('a' in self.tracker)
+        self.assertTrue('b' in self.tracker)
+
+    def test_expired_on_add(self):
+        self.tracker.add('a', 1010)
+        self.clock.advance(100)
+        self.tracker.add('b', 2000)
+        self.assertEquals(len(self.tracker), 1)
+
+    def test_add_again(self):
+        self.tracker.add('a', 1010)
+        self.tracker.add('a', 5000)
+        self.clock.advance(100)
+        self.tracker.expire()
+        self.assertTrue('a' in self.tracker)
+
+
+class TestPushNotificationSender(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(1300000000)
+        self.tokenHandler = PushTokenHandler()
+        self.sender = PushNotificationSender(self.tokenHandler,
+                                             clock=self.clock)
+        self.device = FakeDeviceProtocol()
+        self.tokenHandler.updatePushToken(self.device, TOKEN)
+
+    def sent(self):
+        message, length = APSParser().parseMessage(
+            self.device.transport.value())
+        return message
+
+    def test_message_ids_are_sequential(self):
+        first = unpack('!L', self.sender.generatemessageId())[0]
+        second = unpack('!L', self.sender.generatemessageId())[0]
+        self.assertEquals(second, (first + 1) % 2 ** 32)
+
+    def test_message_ids_wrap(self):
+        self.sender._nextMessageId = 2 ** 32 - 1
+        self.assertEquals(self.sender.generatemessageId(), '\xff' * 4)
+        self.assertEquals(self.sender.generatemessageId(), '\x00' * 4)
+
+    def test_send_notification(self):
+        self.sender.remote_sendNotification(TOKEN, 'topic', '{}')
+        notification = self.sent()
+        self.assertEquals(notification.recipientPushToken, TOKEN)
+        self.assertEquals(notification.expires,
+                          datetime.fromtimestamp(1300000000 + 24 * 3600))
+        self.assertTrue(notification.messageId in self.sender._messageIds)
+
+    def test_response_to_injected_notification_is_dropped(self):
+        self.sender.remote_sendNotification(TOKEN, 'topic', '{}')
+        messageId = self.sent().messageId
+        response = APSNotificationResponse(messageId=messageId,
+                                           deliveryStatus='\x00')
+        self.assertFalse(self.sender.handle('device', response, self.device))
+        self.assertEquals(len(self.sender._messageIds), 0)
+        # Responses to notifications of the push server are forwarded
+        self.assertTrue(self.sender.handle('device', response, self.device))
+
+    def test_unanswered_notifications_expire(self):
+        self.sender.remote_sendNotification(TOKEN, 'topic', '{}')
+        self.clock.advance(24 * 3600 + 60)
+        self.sender._messageIds.expire()
+        self.assertEquals(self.sender.describe(),
+                          ['0 sent notifications awaiting a response'])
+
+    def test_send_notifications(self):
+        other = FakeDeviceProtocol()
+        self.tokenHandler.updatePushToken(other, OTHER_TOKEN)
+        d = self.sender.remote_sendNotifications([
+            (TOKEN, 'topic', '{"a": 1}'),
+            ('\x03' * 32, 'topic', '{}'),
+            (OTHER_TOKEN, 'topic', '{}'),
+            (TOKEN, 'topic', '{"a": 2}'),
+        ])
+        self.clock.advance(0)
+        self.assertEquals(self.successResultOf(d),
+                          [STATUS_SENT, STATUS_UNKNOWN_TOKEN, STATUS_SENT,
+                           STATUS_SENT])
+        self.assertEquals(self.device.transport.writes, 1)
+        parser = APSParser()
+        data = self.device.transport.value()
+        first, length = parser.parseMessage(data)
+        second, length = parser.parseMessage(data[length:])
+        self.assertEquals((first.payload, second.payload),
+                          ('{"a": 1}', '{"a": 2}'))
+        self.assertNotEquals(first.messageId, second.messageId)
+        self.assertEquals(len(self.sender._messageIds), 3)
+
+    def test_send_notifications_in_batches(self):
+        self.sender.batchSize = 2
+        d = self.sender.remote_sendNotifications([(TOKEN, 'topic', '{}')] * 5)
+        while not d.called:
+            self.clock.advance(0)
+        self.assertEquals(self.successResultOf(d), [STATUS_SENT] * 5)
+        self.assertEquals(self.device.transport.writes, 3)
+
+    def test_invalid_notifications_skipped(self):
+        d = self.sender.remote_sendNotifications([
+            (TOKEN, 'topic', 'x' * 0x10000),
+            (TOKEN, 'topic', '{"a": 1}'),
+            ('', 'topic', '{}'),
+            (TOKEN, 'topic'),
+            (TOKEN, None, '{}'),
+        ])
+        self.clock.advance(0)
+        self.assertEquals(self.successResultOf(d),
+                          [STATUS_INVALID, STATUS_SENT, STATUS_INVALID,
+                           STATUS_INVALID, STATUS_INVALID])
+        self.assertEquals(self.sent().payload, '{"a": 1}')
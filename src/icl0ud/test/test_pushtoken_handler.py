@@ -0,0 +1,64 @@
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+
+from icl0ud.push.pushtoken_handler import PushTokenHandler
+from icl0ud.test.support import FakeDeviceProtocol
+
+
+TOKEN = '\x01' * 32
+OTHER_TOKEN = '\x02' * 32
+
+
+class RecordingListener(object):
+    def __init__(self):
+        self.events = []
+
+    def tokenAdded(self, pushToken):
+        self.events.append(('added', pushToken))
+
+    def tokenRemoved(self, pushToken):
+        self.events.append(('removed', pushToken))
+
+
+class TestPushTokenHandler(unittest.TestCase):
+    def setUp(self):
+        self.handler = PushTokenHandler(maxTokensPerDevice=2)
+        self.listener = RecordingListener()
+        self.handler.listeners.append(self.listener)
+        self.device = FakeDeviceProtocol()
+
+    def lost(self, source, deviceProtocol):
+        self.handler.connectionLost(source, deviceProtocol,
+                                    Failure(Exception()))
+
+    def test_removed_when_device_disconnects(self):
+        self.handler.updatePushToken(self.device, TOKEN)
+        self.lost('server', self.device)
+        self.assertTrue(self.handler.hasToken(TOKEN))
+        self.lost('device', self.device)
+        self.assertFalse(self.handler.hasToken(TOKEN))
+        self.assertEquals(len(self.handler), 0)
+        self.assertEquals(self.listener.events,
+                          [('added', TOKEN), ('removed', TOKEN)])
+
+    def test_device_reconnected(self):
+        self.handler.updatePushToken(self.device, TOKEN)
+        newDevice = FakeDeviceProtocol()
+        self.handler.updatePushToken(newDevice, TOKEN)
+        self.lost('device', self.device)
+        self.assertIdentical(self.handler.deviceProtocolForToken(TOKEN),
+                             newDevice)
+        self.assertEquals(self.listener.events, [('added', TOKEN)])
+
+    def test_least_recently_used_token_evicted(self):
+        thirdToken = '\x03' * 32
+        self.handler.updatePushToken(self.device, TOKEN)
+        self.handler.updatePushToken(self.device, OTHER_TOKEN)
+        self.handler.updatePushToken(self.device, TOKEN)
+        self.handler.updatePushToken(self.device, thirdToken)
+        self.assertTrue(self.handler.hasToken(TOKEN))
+        self.assertFalse(self.handler.hasToken(OTHER_TOKEN))
+        self.assertTrue(self.handler.hasToken(thirdToken))
+        self.assertIn(('removed', OTHER_TOKEN), self.listener.events)
+        self.assertEquals(self.handler.describe(),
+                          ['2 push tokens of 1 devices, 1 evicted'])
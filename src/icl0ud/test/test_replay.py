@@ -0,0 +1,23 @@
+from twisted.trial import unittest
+
+from icl0ud.benchmark.replay import (StageTimer, buildHandlers, replay,
+                                     syntheticRecords)
+from icl0ud.push.dispatch import LOG_METADATA
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.records = list(syntheticRecords(connections=3, notifications=4))
+        self.byteCount = sum([len(r.frame) for r in self.records])
+
+    def test_all_frames_forwarded(self):
+        forwarded = replay(self.records, buildHandlers(None))
+        self.assertEquals(forwarded, self.byteCount)
+
+    def test_stage_timer(self):
+        timer = StageTimer()
+        replay(self.records, buildHandlers(LOG_METADATA), timer)
+        self.assertEquals(len(timer.samples['framing']), len(self.records))
+        self.assertEquals(len(timer.samples['forward']), len(self.records))
+        # Every message type has a LoggingHandler subscribed
+        self.assertEquals(len(timer.samples['parse']), len(self.records))
@@ -0,0 +1,84 @@
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from icl0ud.push.upstream import UpstreamSelector
+
+
+class FirstTwo(object):
+    """random replacement, sample() returns the first items."""
+
+    def sample(self, population, k):
+        return population[:k]
+
+
+class TestUpstreamSelector(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.selector = UpstreamSelector(['a', 'b', 'c'], clock=self.clock,
+                                         random=FirstTwo())
+
+    def test_prefers_lower_latency(self):
+        self.selector.connectSucceeded('a', 0.2)
+        self.selector.connectSucceeded('b', 0.1)
+        self.assertEquals(self.selector.choose(), 'b')
+
+    def test_unmeasured_hosts_are_tried(self):
+        self.selector.connectSucceeded('a', 0.2)
+        self.assertEquals(self.selector.choose(), 'b')
+
+    def test_latency_average(self):
+        self.selector.connectSucceeded('a', 1.0)
+        self.selector.connectSucceeded('a', 2.0)
+        self.assertAlmostEqual(self.selector.hosts[0].latency, 1.3)
+
+    def test_errors_are_penalized(self):
+        self.selector.connectSucceeded('a', 0.1)
+        self.selector.connectSucceeded('b', 0.5)
+        self.selector.connectFailed('a')
+        self.assertEquals(self.selector.choose(), 'b')
+
+    def test_exclude(self):
+        self.assertEquals(self.selector.choose(exclude=['a', 'b']), 'c')
+        self.assertIdentical(self.selector.choose(exclude=['a', 'b', 'c']),
+                             None)
+
+    def test_quarantine(self):
+        for i in range(3):
+            self.selector.connectFailed('a')
+        self.assertTrue(self.selector.isQuarantined(self.selector.hosts[0]))
+        self.assertEquals(self.selector.choose(exclude=['b']), 'c')
+
+        self.clock.advance(30)
+        self.assertEquals(self.selector.choose(exclude=['c']), 'b')
+        self.selector.connectSucceeded('b', 1.0)
+        self.assertEquals(self.selector.choose(exclude=['b', 'c']), 'a')
+
+    def test_quarantine_is_extended(self):
+        for i in range(4):
+            self.selector.connectFailed('a')
+        self.clock.advance(30)
+        self.assertTrue(self.selector.isQuarantined(self.selector.hosts[0]))
+        self.clock.advance(30)
+        self.assertFalse(self.selector.isQuarantined(self.selector.hosts[0]))
+
+    def test_success_ends_quarantine(self):
+        for i in range(3):
+            self.selector.connectFailed('a')
+        self.selector.connectSucceeded('a', 0.1)
+        self.assertFalse(self.selector.isQuarantined(self.selector.hosts[0]))
+
+    def test_all_quarantined(self):
+        for host, failures in (('a', 4), ('b', 3), ('c', 5)):
+            for i in range(failures):
+                self.selector.connectFailed(host)
+        # b is released first
+        self.assertEquals(self.selector.choose(), 'b')
+
+    def test_describe(self):
+        self.selector.connectSucceeded('a', 0.1)
+        for i in range(3):
+            self.selector.connectFailed('b')
+        self.assertEquals(self.selector.describe(), [
+            'a: latency 100ms, error rate 0%',
+            'b: latency -, error rate 66%, quarantined for 30s',
+            'c: latency -, error rate 0%'])
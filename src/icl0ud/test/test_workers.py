@@ -0,0 +1,234 @@
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+
+from icl0ud.push import workers
+from icl0ud.push.notification_sender import (PushNotificationSender,
+                                             STATUS_INVALID, STATUS_SENT,
+                                             STATUS_UNKNOWN_TOKEN)
+from icl0ud.push.pushtoken_handler import PushTokenHandler
+from icl0ud.push.workers import (NotificationRouter, TokenPublisher,
+                                 TokenRegistry, WorkerProcess, WorkerRoot,
+                                 WorkerSupervisor)
+from icl0ud.test.support import FakeDeviceProtocol
+
+
+TOKEN = '\x01' * 32
+OTHER_TOKEN = '\x02' * 32
+
+
+class FakeRoot(object):
+    def __init__(self, result):
+        self.result = result
+        self.calls = []
+
+    def callRemote(self, method, *args):
+        self.calls.append((method,) + args)
+        if isinstance(self.result, Exception):
+            return defer.fail(self.result)
+        return defer.succeed(self.result)
+
+
+class FakeWorker(object):
+    def __init__(self, index, root):
+        self.index = index
+        self.root = root
+
+
+class FakeSupervisor(object):
+    def __init__(self, *roots):
+        self.workers = dict([(i, FakeWorker(i, root))
+                             for i, root in enumerate(roots)])
+        self.tokens = TokenRegistry()
+
+
+class TestNotificationRouter(unittest.TestCase):
+    def test_sent_by_connected_worker(self):
+        supervisor = FakeSupervisor(FakeRoot(None),
+                                    FakeRoot('notification sent'),
+                                    None)
+        router = NotificationRouter(supervisor)
+        d = router.remote_sendNotification(TOKEN, 'topic', 'payload')
+        self.assertEquals(self.successResultOf(d), 'notification sent')
+        self.assertEquals(supervisor.workers[0].root.calls,
+                          [('sendNotification', TOKEN, 'topic', 'payload')])
+
+    def test_sent_to_registered_worker(self):
+        supervisor = FakeSupervisor(FakeRoot('sent'), FakeRoot('sent'))
+        supervisor.tokens.update(1, [TOKEN], [])
+        router = NotificationRouter(supervisor)
+        d = router.remote_sendNotification(TOKEN, 'topic', 'payload')
+        self.assertEquals(self.successResultOf(d), 'sent')
+        self.assertEquals(supervisor.workers[0].root.calls, [])
+        self.assertEquals(len(supervisor.workers[1].root.calls), 1)
+
+    def test_unknown_token(self):
+        router = NotificationRouter(FakeSupervisor(FakeRoot(None),
+                                                   FakeRoot(None)))
+        d = router.remote_sendNotification(TOKEN, 'topic', 'payload')
+        self.failureResultOf(d, KeyError)
+
+    def test_send_notifications(self):
+        supervisor = FakeSupervisor(
+            FakeRoot([STATUS_SENT, STATUS_UNKNOWN_TOKEN]),
+            FakeRoot([STATUS_SENT, STATUS_UNKNOWN_TOKEN,
+                      STATUS_UNKNOWN_TOKEN]))
+        supervisor.tokens.update(1, [TOKEN], [])
+        router = NotificationRouter(supervisor)
+        notifications = [(TOKEN, 'topic', '1'),
+                         (OTHER_TOKEN, 'topic', '2'),
+                         ('\x03' * 32, 'topic', '3')]
+        d = router.remote_sendNotifications(notifications)
+        self.assertEquals(self.successResultOf(d),
+                          [STATUS_SENT, STATUS_SENT, STATUS_UNKNOWN_TOKEN])
+        # Unregistered tokens are sent to all workers
+        self.assertEquals(supervisor.workers[0].root.calls,
+                          [('sendNotifications', notifications[1:])])
+        self.assertEquals(supervisor.workers[1].root.calls,
+                          [('sendNotifications', notifications)])
+
+    def test_invalid_notifications_not_sent(self):
+        supervisor = FakeSupervisor(FakeRoot([STATUS_SENT]))
+        router = NotificationRouter(supervisor)
+        notifications = [(TOKEN, 'topic', 'x' * 0x10000),
+                         (TOKEN, 'topic', '1')]
+        d = router.remote_sendNotifications(notifications)
+        self.assertEquals(self.successResultOf(d),
+                          [STATUS_INVALID, STATUS_SENT])
+        self.assertEquals(supervisor.workers[0].root.calls,
+                          [('sendNotifications', notifications[1:])])
+
+    def test_send_frames(self):
+        supervisor = FakeSupervisor(FakeRoot([]), FakeRoot([STATUS_SENT]))
+        supervisor.tokens.update(1, [TOKEN], [])
+        router = NotificationRouter(supervisor)
+        d = router.sendFrames([(TOKEN, 'fields')])
+        self.assertEquals(self.successResultOf(d), [STATUS_SENT])
+        self.assertEquals(supervisor.workers[1].root.calls,
+                          [('sendFrames', [(TOKEN, 'fields')])])
+
+    def test_failed_worker(self):
+        router = NotificationRouter(FakeSupervisor(FakeRoot(Exception()),
+                                                   FakeRoot('sent')))
+        d = router.remote_sendNotification(TOKEN, 'topic', 'payload')
+        self.assertEquals(self.successResultOf(d), 'sent')
+        self.assertEquals(len(self.flushLoggedErrors(Exception)), 1)
+
+
+class TestTokenRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = TokenRegistry()
+
+    def test_update(self):
+        self.registry.update(0, [TOKEN, OTHER_TOKEN], [])
+        self.registry.update(0, [], [OTHER_TOKEN])
+        self.assertEquals(self.registry.get(TOKEN), 0)
+        self.assertIdentical(self.registry.get(OTHER_TOKEN), None)
+        self.assertEquals(len(self.registry), 1)
+
+    def test_device_moved_to_other_worker(self):
+        self.registry.update(0, [TOKEN], [])
+        self.registry.update(1, [TOKEN], [])
+        # The old connection is closed later
+        self.registry.update(0, [], [TOKEN])
+        self.assertEquals(self.registry.get(TOKEN), 1)
+        self.registry.removeWorker(0)
+        self.assertEquals(self.registry.get(TOKEN), 1)
+
+    def test_remove_worker(self):
+        self.registry.update(0, [TOKEN], [])
+        self.registry.update(1, [OTHER_TOKEN], [])
+        self.registry.removeWorker(0)
+        self.assertIdentical(self.registry.get(TOKEN), None)
+        self.assertEquals(self.registry.get(OTHER_TOKEN), 1)
+
+
+class TestTokenPublisher(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(workers, 'reactor', self.clock)
+        self.publisher = TokenPublisher()
+        self.registration = FakeRoot(None)
+
+    def test_batched_once_registered(self):
+        tokenHandler = PushTokenHandler()
+        tokenHandler.listeners.append(self.publisher)
+        tokenHandler.updatePushToken(FakeDeviceProtocol(), TOKEN)
+        tokenHandler.updatePushToken(FakeDeviceProtocol(), TOKEN)
+        self.publisher.setRegistration(self.registration)
+        self.publisher.tokenAdded(OTHER_TOKEN)
+        self.publisher.tokenRemoved(OTHER_TOKEN)
+        self.assertEquals(self.registration.calls, [])
+        self.clock.advance(0)
+        self.assertEquals(self.registration.calls,
+                          [('updateTokens', [TOKEN], [OTHER_TOKEN])])
+
+    def test_batch_size(self):
+        self.publisher.batchSize = 1
+        self.publisher.setRegistration(self.registration)
+        self.publisher.tokenAdded(TOKEN)
+        self.publisher.tokenAdded(OTHER_TOKEN)
+        self.clock.advance(0)
+        self.assertEquals(len(self.registration.calls), 2)
+
+
+class TestWorkerRoot(unittest.TestCase):
+    def setUp(self):
+        self.tokenHandler = PushTokenHandler()
+        self.sender = PushNotificationSender(self.tokenHandler)
+        self.root = WorkerRoot(self.sender, TokenPublisher())
+
+    def test_not_connected(self):
+        self.assertIdentical(
+            self.root.remote_sendNotification(TOKEN, 'topic', '{}'), None)
+        self.assertEquals(len(self.sender._messageIds), 0)
+
+    def test_connected(self):
+        device = FakeDeviceProtocol()
+        self.tokenHandler.updatePushToken(device, TOKEN)
+        self.root.remote_sendNotification(TOKEN, 'topic', '{}')
+        self.assertNotEquals(device.transport.value(), '')
+
+
+class TestWorkerProcess(unittest.TestCase):
+    def test_output_logged_by_line(self):
+        messages = []
+        log.addObserver(messages.append)
+        self.addCleanup(log.removeObserver, messages.append)
+        worker = WorkerProcess(None, 3)
+        worker.childDataReceived(1, 'first\nsec')
+        worker.childDataReceived(2, 'error\n')
+        worker.childDataReceived(1, 'ond\n')
+        self.assertEquals([''.join(m['message']) for m in messages],
+                          ['[worker 3] first', '[worker 3] error',
+                           '[worker 3] second'])
+
+
+class TestWorkerSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(workers, 'reactor', self.clock)
+        self.supervisor = WorkerSupervisor(5223, 2, 'pushserver.py')
+        self.started = []
+        self.supervisor.startWorker = self.started.append
+        self.supervisor.running = True
+
+    def test_restart(self):
+        worker = WorkerProcess(self.supervisor, 1)
+        self.supervisor.workers[1] = worker
+        self.supervisor.tokens.update(1, [TOKEN], [])
+        worker.processEnded(Failure(Exception('crashed')))
+        self.assertEquals(self.supervisor.workers, {})
+        self.assertIdentical(self.supervisor.tokens.get(TOKEN), None)
+        self.clock.advance(1)
+        self.assertEquals(self.started, [1])
+
+    def test_no_restart_when_stopped(self):
+        worker = WorkerProcess(self.supervisor, 1)
+        self.supervisor.workers[1] = worker
+        worker.processEnded(Failure(Exception('crashed')))
+        self.supervisor.running = False
+        self.clock.advance(1)
+        self.assertEquals(self.started, [])
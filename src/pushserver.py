@@ -6,9 +6,11 @@ from twisted.python import log
 from twisted.spread import pb
 
 from icl0ud.push.dispatch import LoggingHandler, HexdumpHandler
+from icl0ud.push.injection import InjectionFactory
 from icl0ud.push.notification_sender import PushNotificationSender
 from icl0ud.push.pushtoken_handler import PushTokenHandler
 from icl0ud.push.intercept import InterceptServerFactory
+from icl0ud.push import workers
 
 
 SERVER_CERT_PATH = os.path.join(os.path.curdir,
@@ -22,13 +24,28 @@ CA_CERT_CHAIN_PATH = os.path.join(os.path.curdir,
 # log_file = open('data/error.log', 'a')
 pushTokenHandler = PushTokenHandler()
 pushNotificationSender = PushNotificationSender(pushTokenHandler)
+# Use LoggingHandler(level=LOG_METADATA, sampleRate=0.1) to only log message
+# types, sizes and token prefixes of a tenth of all messages, LOG_METADATA is
+# in icl0ud.push.dispatch. CaptureHandler is in icl0ud.push.capture.
 DISPATCH_HANDLERS = [LoggingHandler(),
                      pushTokenHandler,
                      pushNotificationSender,
                      # HexdumpHandler(sys.stdout),
+                     # CaptureHandler(open('data/push.apscap', 'ab'),
+                     #                compress=True),
                      ]
 
 
+# Processes accepting device connections, 0 accepts them in this process.
+# Set it to the number of cores to spread TLS over them. Each worker has its
+# own TLS session cache and ticket keys, a reconnecting device only resumes
+# its session if it is accepted by the same worker again.
+WORKERS = 0
+
+# Path of a Unix socket local producers inject notifications on, see
+# src/icl0ud/push/injection.py. None disables it.
+INJECTION_SOCKET = None
+
 APPLE_PUSH_IPS = (
         '17.172.232.218',
         '17.172.232.59',
@@ -52,10 +69,28 @@ contextFactory = factory.getServerContextFactory()
 
 application = service.Application('i4d-push')
 serviceCollection = service.IServiceCollection(application)
-internet.SSLServer(5223, factory, contextFactory) \
-                  .setServiceParent(serviceCollection)
+if not WORKERS:
+    internet.SSLServer(5223, factory, contextFactory) \
+                      .setServiceParent(serviceCollection)
+    notificationRoot = pushNotificationSender
+elif workers.workerIndex() is not None:
+    # This is a worker started by the supervisor below
+    workers.WorkerService(factory, contextFactory, pushNotificationSender,
+                          pushTokenHandler) \
+                         .setServiceParent(serviceCollection)
+    notificationRoot = None
+else:
+    supervisor = workers.WorkerSupervisor(5223, WORKERS, __file__)
+    supervisor.setServiceParent(serviceCollection)
+    notificationRoot = supervisor.router
 
-internet.TCPServer(1234,
-                   pb.PBServerFactory(pushNotificationSender),
-                   interface='127.0.0.1') \
-                  .setServiceParent(serviceCollection)
+if notificationRoot is not None:
+    internet.TCPServer(1234,
+                       pb.PBServerFactory(notificationRoot),
+                       interface='127.0.0.1') \
+                      .setServiceParent(serviceCollection)
+    if INJECTION_SOCKET is not None:
+        internet.UNIXServer(INJECTION_SOCKET,
+                            InjectionFactory(notificationRoot),
+                            wantPID=True) \
+                           .setServiceParent(serviceCollection)